@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 
-from typing import List
+from typing import Iterator, List
 
 
 class AbstractLLMClient(ABC):
@@ -21,3 +21,14 @@ class AbstractLLMClient(ABC):
     @abstractmethod
     def generate_embeddings(self, sentence: str, embedding_model: str) -> List[float]:
         pass
+
+    def stream(
+        self, prompt: str, sys_prompt: str, temperature: float = 0.2
+    ) -> Iterator[str]:
+        """
+        Yields a text response as it's generated. Clients that can't stream
+        yield the whole response at once.
+        """
+        yield self.query(
+            prompt, sys_prompt=sys_prompt, is_json=False, temperature=temperature
+        )
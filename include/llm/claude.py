@@ -1,4 +1,4 @@
-from typing import List
+from typing import Iterator, List
 from . import base
 import os
 from dotenv import load_dotenv
@@ -49,3 +49,22 @@ class ClaudeClient(base.AbstractLLMClient):
             return json.loads(text)
 
         return text
+
+    def stream(
+        self,
+        prompt: str,
+        sys_prompt: str,
+        temperature: float = 0.2,
+        model: str = MODEL,
+    ) -> Iterator[str]:
+        """Streams the text of a claude response as it's generated"""
+
+        with self._client.messages.stream(
+            model=model,
+            temperature=temperature,
+            max_tokens=4096,
+            system=sys_prompt,
+            messages=[{"role": "user", "content": prompt}],
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
@@ -33,3 +33,31 @@ def hash_str(input_string: str) -> str:
     hashed_string = sha256.hexdigest()
 
     return hashed_string
+
+
+# Rough token estimate, close enough for budgeting prompts without a tokenizer
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of llm tokens in the provided text.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = "\n...\n") -> str:
+    """
+    Truncates text to roughly max_tokens, keeping the head and the tail
+    since both usually carry the most information.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    if max_chars <= len(marker):
+        return text[: max(max_chars, 0)]
+
+    head = (max_chars - len(marker)) * 2 // 3
+    tail = max_chars - len(marker) - head
+
+    return text[:head] + marker + text[len(text) - tail :]
@@ -1,9 +1,12 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from uuid import UUID
 
 from src.server.wrappers import query_wrapper
+from src.server.jobs import get_job_queue, DeploymentInProgressException
+from src.server.drift import get_drift_scheduler, DRIFT_SCHEDULER_ENABLED
+from src.actions.tf_workspace import get_default_pool
 
 load_dotenv()
 
@@ -17,6 +20,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_background_jobs():
+    get_default_pool().prewarm_in_background()
+    if DRIFT_SCHEDULER_ENABLED:
+        get_drift_scheduler().start()
+
 # Synchronous endpoints
 @app.get("/query")
 def query(user_query: str, user_id: str, chat_session_id: str):
@@ -24,6 +33,26 @@ def query(user_query: str, user_id: str, chat_session_id: str):
     chat_session_uuid = UUID(chat_session_id.strip())
     return {"result": query_wrapper(user_query, user_uuid, chat_session_uuid)}
 
+# Asynchronous endpoints. Deployments run in a worker pool, poll for their status.
+@app.post("/deployments/{chat_session_id}", status_code=202)
+def enqueue_deployment(chat_session_id: str, user_id: str):
+    user_uuid = UUID(user_id)
+    chat_session_uuid = UUID(chat_session_id.strip())
+    try:
+        job_id = get_job_queue().enqueue(user_uuid, chat_session_uuid)
+    except DeploymentInProgressException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"result": {"job_id": job_id}}
+
+@app.get("/deployments/{chat_session_id}")
+def deployment_status(chat_session_id: str, user_id: str):
+    user_uuid = UUID(user_id)
+    chat_session_uuid = UUID(chat_session_id.strip())
+    status = get_job_queue().status(user_uuid, chat_session_uuid)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No deployment for this chat session")
+    return {"result": status}
+
 @app.get("/health")
 def test():
     return {"message": "Healthy"}
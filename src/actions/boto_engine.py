@@ -0,0 +1,472 @@
+from typing import Any, Dict, List, Tuple, Union
+from datetime import datetime
+import threading
+import json
+
+import boto3
+import jmespath
+from botocore import xform_name
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ParamValidationError
+from botocore.model import OperationModel, Shape
+
+from src.actions.runner import CommandResult, DEFAULT_TIMEOUT_S
+
+AWS = "aws"
+JSON_OUTPUT = "json"
+
+# Exit codes the aws cli uses, so callers can treat both backends the same
+CLI_SERVICE_ERROR = 254
+CLI_PARAM_ERROR = 252
+
+# CLI service names which don't match their boto3 name. Everything else is 1:1.
+CLI_TO_BOTO_SERVICE = {
+    "s3api": "s3",
+    "configservice": "config",
+    "deploy": "codedeploy",
+}
+
+# High level cli customizations with no api operation behind them
+UNSUPPORTED_SERVICES = {"s3", "ddb", "configure", "history", "help"}
+
+GLOBAL_VALUE_OPTIONS = {"region", "profile", "output", "query", "endpoint-url"}
+GLOBAL_FLAG_OPTIONS = {"no-paginate", "no-cli-pager"}
+
+# Cli options driving its own pagination or input handling. We let the cli handle these.
+UNSUPPORTED_OPTIONS = {
+    "cli-input-json",
+    "cli-input-yaml",
+    "generate-cli-skeleton",
+    "max-items",
+    "starting-token",
+    "page-size",
+    "debug",
+    "no-verify-ssl",
+    "color",
+}
+
+SCALAR_TYPES = {"string", "integer", "long", "float", "double", "boolean", "timestamp"}
+
+
+class UnsupportedCommandException(Exception):
+    """
+    Represents a cli command the boto3 engine can't faithfully reproduce.
+    Callers should fall back to running the actual aws cli.
+    """
+
+    pass
+
+
+class ParsedCommand:
+    """
+    A cli command broken into the pieces needed to make the equivalent boto3 call.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        operation: str,
+        params: Dict[str, Any],
+        region: Union[str, None],
+        profile: Union[str, None],
+        query: Union[str, None],
+        endpoint_url: Union[str, None],
+        paginate: bool,
+    ) -> None:
+        self.service = service
+        self.operation = operation
+        self.params = params
+        self.region = region
+        self.profile = profile
+        self.query = query
+        self.endpoint_url = endpoint_url
+        self.paginate = paginate
+
+
+class BotoClientPool:
+    """
+    Keeps boto3 sessions and clients alive between calls. Sessions are cached per
+    profile, and clients per (profile, region, service, endpoint). Clients are
+    thread safe once built, sessions are not, so construction happens under a lock.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT_S) -> None:
+        self._sessions: Dict[Union[str, None], boto3.session.Session] = {}
+        self._clients: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+        self._config = Config(
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            retries={"max_attempts": 3, "mode": "standard"},
+        )
+
+    def get_session(self, profile: Union[str, None]) -> boto3.session.Session:
+        """
+        Returns the cached session for a profile, creating it if needed.
+        """
+        with self._lock:
+            if profile not in self._sessions:
+                self._sessions[profile] = boto3.session.Session(profile_name=profile)
+
+            return self._sessions[profile]
+
+    def get_client(
+        self,
+        service: str,
+        profile: Union[str, None],
+        region: Union[str, None],
+        endpoint_url: Union[str, None] = None,
+    ) -> Any:
+        """
+        Returns the cached client for the given service, profile and region.
+        """
+        key = (profile, region, service, endpoint_url)
+        if key in self._clients:
+            return self._clients[key]
+
+        session = self.get_session(profile)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = session.client(
+                    service,
+                    region_name=region,
+                    endpoint_url=endpoint_url,
+                    config=self._config,
+                )
+
+            return self._clients[key]
+
+    def clear(self):
+        """
+        Drops all cached sessions and clients.
+        """
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+
+
+def _split_options(tokens: List[str]) -> List[Tuple[str, List[str]]]:
+    """
+    Groups tokens into (option name, values) pairs, in order.
+    """
+    options = []
+    for token in tokens:
+        if token.startswith("--"):
+            options.append((token[2:], []))
+        elif len(options) == 0:
+            raise UnsupportedCommandException(f"Unexpected positional arg {token}")
+        else:
+            options[-1][1].append(token)
+
+    return options
+
+
+def _split_options_with_positionals(
+    tokens: List[str],
+) -> Tuple[List[str], List[Tuple[str, List[str]]]]:
+    """
+    Splits cli tokens into the leading positionals (service and operation) and
+    the grouped options. Global options may precede the positionals.
+    """
+    positionals = []
+    rest = []
+    i = 0
+    while i < len(tokens) and len(positionals) < 2:
+        token = tokens[i]
+        if token.startswith("--"):
+            name = token[2:]
+            rest.append(token)
+            if name in GLOBAL_VALUE_OPTIONS and i + 1 < len(tokens):
+                rest.append(tokens[i + 1])
+                i += 1
+            elif name not in GLOBAL_FLAG_OPTIONS:
+                raise UnsupportedCommandException(f"Unexpected option {token}")
+        else:
+            positionals.append(token)
+        i += 1
+
+    return positionals, _split_options(rest + tokens[i:])
+
+
+def _convert_scalar(value: str, shape: Shape) -> Any:
+    """
+    Converts a single cli token into the python type the shape expects.
+    """
+    type_name = shape.type_name
+    if type_name in ("integer", "long"):
+        return int(value)
+    if type_name in ("float", "double"):
+        return float(value)
+    if type_name == "boolean":
+        return value.lower() == "true"
+
+    return value
+
+
+def _parse_shorthand(value: str, shape: Shape) -> Dict[str, Any]:
+    """
+    Parses flat cli shorthand, e.g. Name=instance-state-name,Values=running,stopped
+    into a dict for the provided structure shape. Nested shorthand isn't supported.
+    """
+    if any(char in value for char in "[]{}"):
+        raise UnsupportedCommandException(f"Nested shorthand isn't supported: {value}")
+
+    parsed: Dict[str, List[str]] = {}
+    current = None
+    for part in value.split(","):
+        key, sep, item = part.partition("=")
+        if sep and key in shape.members:
+            current = key
+            parsed[current] = [item]
+        elif current is not None:
+            parsed[current].append(part)
+        else:
+            raise UnsupportedCommandException(f"Couldn't parse shorthand: {value}")
+
+    result = {}
+    for key, items in parsed.items():
+        member = shape.members[key]
+        if member.type_name == "list":
+            result[key] = [_convert_scalar(item, member.member) for item in items]
+        elif member.type_name in SCALAR_TYPES:
+            result[key] = _convert_scalar(",".join(items), member)
+        else:
+            raise UnsupportedCommandException(f"Couldn't parse shorthand: {value}")
+
+    return result
+
+
+def _convert_param(name: str, values: List[str], shape: Shape) -> Any:
+    """
+    Converts the tokens passed to a cli option into a boto3 parameter value.
+    """
+    type_name = shape.type_name
+
+    if type_name == "boolean" and len(values) == 0:
+        return True
+
+    if len(values) == 0:
+        raise UnsupportedCommandException(f"Missing value for --{name}")
+
+    # JSON input is accepted for any complex parameter
+    if len(values) == 1 and values[0][:1] in ("{", "["):
+        try:
+            return json.loads(values[0])
+        except json.JSONDecodeError:
+            raise UnsupportedCommandException(f"Invalid JSON for --{name}")
+
+    if type_name in SCALAR_TYPES:
+        if len(values) != 1:
+            raise UnsupportedCommandException(f"Too many values for --{name}")
+        return _convert_scalar(values[0], shape)
+
+    if type_name == "list":
+        member = shape.member
+        if member.type_name in SCALAR_TYPES:
+            return [_convert_scalar(value, member) for value in values]
+        if member.type_name == "structure":
+            return [_parse_shorthand(value, member) for value in values]
+    elif type_name == "structure" and len(values) == 1:
+        return _parse_shorthand(values[0], shape)
+
+    raise UnsupportedCommandException(
+        f"Can't convert --{name} of type {type_name} from the cli"
+    )
+
+
+def _json_default(obj: Any) -> str:
+    """
+    Serializes the non JSON types boto3 returns, the same way the cli does.
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode("utf8", errors="replace")
+
+    return str(obj)
+
+
+class Boto3ExecutionEngine:
+    """
+    Executes generated aws cli commands in process with boto3, rather than
+    spawning the cli. The command is parsed into its service, operation and
+    parameters using botocore's service models, dispatched to a pooled client,
+    and the response is formatted like the cli's JSON output.
+
+    Anything the engine can't reproduce faithfully raises UnsupportedCommandException,
+    so the caller can fall back to the cli. Since every client comes from botocore,
+    the engine runs unchanged against moto's mock_aws, or a moto server via endpoint_url.
+    """
+
+    def __init__(self, pool: Union[BotoClientPool, None] = None) -> None:
+        self.pool = pool if pool is not None else BotoClientPool()
+        self._operation_names: Dict[str, Dict[str, str]] = {}
+
+    def _resolve_operation(self, client: Any, service: str, cli_op: str) -> str:
+        """
+        Maps a cli operation name (describe-instances) to its api name (DescribeInstances).
+        """
+        if service not in self._operation_names:
+            service_model = client.meta.service_model
+            self._operation_names[service] = {
+                xform_name(op, "-"): op for op in service_model.operation_names
+            }
+
+        operation = self._operation_names[service].get(cli_op)
+        if operation is None:
+            raise UnsupportedCommandException(f"Unknown operation {service} {cli_op}")
+
+        return operation
+
+    def _parse_params(
+        self, operation_model: OperationModel, options: List[Tuple[str, List[str]]]
+    ) -> Dict[str, Any]:
+        """
+        Converts cli options into boto3 call parameters using the operation's input shape.
+        """
+        params = {}
+        input_shape = operation_model.input_shape
+        members = input_shape.members if input_shape is not None else {}
+        cli_names = {xform_name(member, "-"): member for member in members}
+
+        for name, values in options:
+            if name in cli_names:
+                member = cli_names[name]
+                params[member] = _convert_param(name, values, members[member])
+            elif name.startswith("no-") and name[3:] in cli_names:
+                member = cli_names[name[3:]]
+                if members[member].type_name != "boolean" or len(values) > 0:
+                    raise UnsupportedCommandException(f"Unknown option --{name}")
+                params[member] = False
+            else:
+                raise UnsupportedCommandException(f"Unknown option --{name}")
+
+        return params
+
+    def parse(self, argv: List[str]) -> ParsedCommand:
+        """
+        Parses a split cli command. Raises UnsupportedCommandException if the
+        command can't be run through boto3.
+        """
+        if len(argv) == 0 or argv[0].split("/")[-1] != AWS:
+            raise UnsupportedCommandException(f"Not an aws cli command: {argv}")
+
+        positionals, options = _split_options_with_positionals(argv[1:])
+
+        if len(positionals) != 2:
+            raise UnsupportedCommandException(
+                f"Expected a service and operation: {argv}"
+            )
+
+        cli_service, cli_op = positionals
+        if cli_service in UNSUPPORTED_SERVICES:
+            raise UnsupportedCommandException(f"Cli only service {cli_service}")
+
+        global_opts: Dict[str, Union[str, None]] = {}
+        paginate = True
+        op_options = []
+        for name, values in options:
+            if name in UNSUPPORTED_OPTIONS:
+                raise UnsupportedCommandException(f"Unsupported option --{name}")
+            elif name in GLOBAL_VALUE_OPTIONS:
+                if len(values) != 1:
+                    raise UnsupportedCommandException(f"Bad value for --{name}")
+                global_opts[name] = values[0]
+            elif name in GLOBAL_FLAG_OPTIONS:
+                paginate = paginate and name != "no-paginate"
+            else:
+                op_options.append((name, values))
+
+        if global_opts.get("output", JSON_OUTPUT) != JSON_OUTPUT:
+            raise UnsupportedCommandException("Only JSON output is supported")
+
+        service = CLI_TO_BOTO_SERVICE.get(cli_service, cli_service)
+        profile = global_opts.get("profile")
+        region = global_opts.get("region")
+        endpoint_url = global_opts.get("endpoint-url")
+
+        try:
+            client = self.pool.get_client(service, profile, region, endpoint_url)
+        except BotoCoreError as e:
+            raise UnsupportedCommandException(f"Couldn't create client: {e}")
+
+        operation = self._resolve_operation(client, service, cli_op)
+        operation_model = client.meta.service_model.operation_model(operation)
+        params = self._parse_params(operation_model, op_options)
+
+        return ParsedCommand(
+            service,
+            operation,
+            params,
+            region,
+            profile,
+            global_opts.get("query"),
+            endpoint_url,
+            paginate,
+        )
+
+    def call(self, command: ParsedCommand) -> Any:
+        """
+        Makes the boto3 call for a parsed command, paginating like the cli does,
+        and applies the --query expression to the result.
+        """
+        client = self.pool.get_client(
+            command.service, command.profile, command.region, command.endpoint_url
+        )
+        method_name = xform_name(command.operation)
+
+        if command.paginate and client.can_paginate(method_name):
+            paginator = client.get_paginator(method_name)
+            result = paginator.paginate(**command.params).build_full_result()
+        else:
+            result = getattr(client, method_name)(**command.params)
+
+        result.pop("ResponseMetadata", None)
+
+        if command.query is not None:
+            result = jmespath.search(command.query, result)
+
+        return result
+
+    def execute(self, argv: List[str]) -> CommandResult:
+        """
+        Runs a split cli command through boto3, returning the same kind of result
+        as the subprocess runner. Api errors are reported with the cli's exit codes.
+        """
+        try:
+            command = self.parse(argv)
+        except (ValueError, TypeError) as e:
+            # e.g. --max-results abc, which the cli rejects as a bad parameter
+            return CommandResult(
+                argv, CLI_PARAM_ERROR, "", f"Invalid parameter value: {e}"
+            )
+
+        try:
+            result = self.call(command)
+        except ParamValidationError as e:
+            return CommandResult(argv, CLI_PARAM_ERROR, "", str(e))
+        except (ClientError, BotoCoreError) as e:
+            return CommandResult(argv, CLI_SERVICE_ERROR, "", str(e))
+
+        output = ""
+        if result is not None:
+            output = json.dumps(result, indent=4, default=_json_default) + "\n"
+
+        return CommandResult(argv, 0, output, "")
+
+
+_default_engine: Union[Boto3ExecutionEngine, None] = None
+_default_engine_lock = threading.Lock()
+
+
+def get_default_engine() -> Boto3ExecutionEngine:
+    """
+    Returns the process wide engine, so clients are reused across executions.
+    """
+    global _default_engine
+
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = Boto3ExecutionEngine()
+
+    return _default_engine
@@ -1,14 +1,47 @@
-from typing import Any, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
+import time
+import os
+import re
 
 from . import base
 
 from src.model.stack import TerraformConfig
+from src.model.compact import compact, minify
+from src.model.hcl import get_parse_cache
+from src.actions.template_index import get_template_index
+from src.actions.construct_search import (
+    ConstructionCandidate,
+    ConstructionSearch,
+    CONSTRUCT_CANDIDATES,
+    CONSTRUCT_TEMPERATURES,
+    PLACEHOLDER,
+)
+from src.actions.tf_workspace import TFWorkspacePool, get_default_pool
 from include.llm.base import AbstractLLMClient
 
 from include.utils import prompt_with_file, BASE_PROMPT_PATH
 
 COALESCE_CONSTRUCTION_RESPONSE = "coalesce_response.txt"
 
+# Longest reference template shown to construction
+MAX_REFERENCE_CHARS = 4000
+
+# Cleans the user's description with its own llm call first, instead of
+# leaving it to the construction call
+CONSTRUCT_CLEAN_INPUT = os.environ.get("CONSTRUCT_CLEAN_INPUT", "false") == "true"
+
+# Output blocks usually trail a config's resources, so the summary starts
+# once the first one streams in, overlapping the rest of the config.
+TRAILING_BLOCK_REGEX = re.compile(r"^\s*output\s+\"", re.MULTILINE)
+
+# Stage timing keys
+CLEAN_INPUT_STAGE = "clean_input"
+FIRST_TOKEN_STAGE = "first_token"
+CONSTRUCT_STAGE = "construct"
+SUMMARY_STAGE = "summary"
+TOTAL_STAGE = "total"
+
 
 class ConstructTFConfigAction(base.AbstractAction):
     """
@@ -16,11 +49,62 @@ class ConstructTFConfigAction(base.AbstractAction):
     test_client to test different models.
     """
 
-    def __init__(self, test_client: Union[AbstractLLMClient, None] = None) -> None:
+    def __init__(
+        self,
+        test_client: Union[AbstractLLMClient, None] = None,
+        candidates: int = CONSTRUCT_CANDIDATES,
+        workspace_pool: Union[TFWorkspacePool, None] = None,
+    ) -> None:
+        """
+        candidates is how many configs are sampled and checked per construction.
+        They're validated in working dirs from workspace_pool, by default the
+        process wide one.
+        """
         self.tf_config = None
         self.test_client = test_client
+        self.candidates = candidates
+        self.workspace_pool = workspace_pool
+        # The scores of the last construction's candidates, best first
+        self.candidate_scores: List[Dict[str, Any]] = []
+        # Seconds spent in each stage of the last construction
+        self.stage_timings: Dict[str, float] = {}
         super().__init__()
 
+    def _timed(self, stage: str, fn: Callable, *args) -> Any:
+        """
+        Runs fn, recording how long it took as a stage timing.
+        """
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.stage_timings[stage] = time.perf_counter() - start
+
+    def reference_templates(self, user_query: str) -> str:
+        """
+        The vetted templates from the corpus nearest the user's description,
+        formatted as few shot references. Empty if none are close enough.
+        """
+        references = []
+        for path, template in get_template_index().examples(
+            user_query, self.gpt_client
+        ):
+            references.append(
+                f'<reference name="{path}">\n{minify(template)[:MAX_REFERENCE_CHARS]}\n</reference>'
+            )
+
+        if len(references) == 0:
+            return ""
+
+        joined = "\n".join(references)
+        return f"""
+        Here are vetted templates for similar architectures. Follow their structure and conventions where they
+        fit, but only build what the description asks for:
+        <reference_templates>
+        {joined}
+        </reference_templates>
+        """
+
     def get_construction_prompt(self, user_query: str) -> str:
         """
         Constructs a construction prompt from the provided user query
@@ -29,10 +113,14 @@ class ConstructTFConfigAction(base.AbstractAction):
         You are a skilled cloud engineer tasked with creating a Terraform configuration file based on a user's description. Your goal is to construct a complete, deployable Terraform template that matches the described architecture's functionality.
         Assume that if the user does not describe some resource, it does not exist. You must create everything from complete scratch.
 
+        The description comes straight from the user, so it may be messy, misspelled or vague. Read past that,
+        and settle on specific requirements before building.
+
         Here is the description of the Terraform template to be created:
         <terraform_description>
         {user_query}
         </terraform_description>
+        {self.reference_templates(user_query)}
 
         Follow these steps to create the Terraform configuration:
 
@@ -55,26 +143,197 @@ class ConstructTFConfigAction(base.AbstractAction):
         Begin your output with the provider block (if necessary) and continue with the resource blocks. Do not include any other text or formatting outside of the Terraform configuration syntax.
         """
 
-    def _extract_template(self, input: str, retries: int = 3) -> TerraformConfig:
+    def _extract_template(
+        self,
+        input: str,
+        retries: int = 3,
+        temperature: float = CONSTRUCT_TEMPERATURES[0],
+        prompt: Union[str, None] = None,
+    ) -> TerraformConfig:
         """
         helper fn to extract a cf template from an input
         """
+        if prompt is None:
+            prompt = self.get_construction_prompt(input)
+
         try:
             if self.test_client is None:
                 self.test_client = self.claude_client
 
             tf_template = self.claude_client.query(
-                self.get_construction_prompt(input), "", False, temperature=0.8
+                prompt, "", False, temperature=temperature
             )
         except Exception as e:
+            if retries <= 0:
+                raise
             print(f"Couldn't extract config because of {e}. Retrying...")
 
-            return self._extract_template(input, retries - 1)
+            return self._extract_template(input, retries - 1, temperature, prompt)
 
         return TerraformConfig(
             tf_template, str(hash(input))
         )  # TODO need to figure out how to get this value somehow
 
+    def construct_best(
+        self, input: str, original_query: str
+    ) -> Tuple[TerraformConfig, List[Dict[str, Any]], str]:
+        """
+        Samples several configs concurrently at varied temperatures, checks
+        each locally and with terraform validate, and returns the best with
+        every candidate's scores, best first, and its summary. Bad samples are
+        weeded out here, in parallel, instead of one at a time in the deploy
+        fix loop. The summary starts on the best candidate by the local checks,
+        overlapping validation, and is redone if validation picks a config it
+        doesn't cover.
+        """
+        start = time.perf_counter()
+        prompt = self.get_construction_prompt(input)
+        temperatures = [
+            CONSTRUCT_TEMPERATURES[i % len(CONSTRUCT_TEMPERATURES)]
+            for i in range(self.candidates)
+        ]
+
+        def sample(temperature: float) -> Union[TerraformConfig, None]:
+            try:
+                return self._extract_template(input, 1, temperature, prompt)
+            except Exception as e:
+                print(f"Couldn't sample config at {temperature}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(temperatures)) as executor:
+            sampled = list(executor.map(sample, temperatures))
+
+        candidates, seen = [], set()
+        for temperature, config in zip(temperatures, sampled):
+            if config is not None and config.template not in seen:
+                seen.add(config.template)
+                candidates.append(ConstructionCandidate(config, temperature))
+
+        if len(candidates) == 0:
+            # Every sample failed, so fall back to retrying one
+            config = self._extract_template(input, prompt=prompt)
+            self.stage_timings[CONSTRUCT_STAGE] = time.perf_counter() - start
+            return (
+                config,
+                [],
+                self._timed(
+                    SUMMARY_STAGE, self._coalesce_response, config, original_query
+                ),
+            )
+
+        pool = self.workspace_pool
+        if pool is None:
+            pool = get_default_pool()
+
+        provisional: List[Tuple[TerraformConfig, Future]] = []
+        # Not waited on when exiting, since a stale summary is just dropped
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def start_summary(candidate: ConstructionCandidate):
+            future = executor.submit(
+                self._summarize_timed, candidate.config, original_query
+            )
+            provisional.append((candidate.config, future))
+
+        try:
+            ranked = ConstructionSearch(pool).rank(candidates, start_summary)
+        finally:
+            executor.shutdown(wait=False)
+
+        self.stage_timings[CONSTRUCT_STAGE] = time.perf_counter() - start
+        config, scores = ranked[0].config, [c.scores() for c in ranked]
+
+        if len(provisional) > 0:
+            summarized, summary_future = provisional[0]
+            if summarized is config or self._summary_covers(summarized, config):
+                response, self.stage_timings[SUMMARY_STAGE] = summary_future.result()
+                return config, scores, response
+
+            print("Validation picked another config. Summarizing it again.")
+
+        return (
+            config,
+            scores,
+            self._timed(SUMMARY_STAGE, self._coalesce_response, config, original_query),
+        )
+
+    def _summarize_timed(
+        self, config: TerraformConfig, original_query: str
+    ) -> Tuple[str, float]:
+        """
+        Summarizes a config for the user, with how long it took, for summaries
+        that run alongside construction.
+        """
+        summary_start = time.perf_counter()
+        response = self._coalesce_response(config, original_query)
+        return response, time.perf_counter() - summary_start
+
+    def construct_streaming(
+        self, input: str, original_query: str
+    ) -> Tuple[TerraformConfig, str]:
+        """
+        Streams a config, and starts summarizing it for the user as soon as its
+        trailing output blocks begin, so the summary overlaps the rest of the
+        stream. If the rest added resources or placeholders the summary didn't
+        see, it's redone on the whole config. Returns the config and summary.
+        """
+        prompt = self.get_construction_prompt(input)
+        name = str(hash(input))
+
+        start = time.perf_counter()
+        chunks: List[str] = []
+        scanned = 0
+        prefix, summary_future = None, None
+        # Not waited on when exiting, since a stale summary is just dropped
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for chunk in self.claude_client.stream(
+                prompt, "", temperature=CONSTRUCT_TEMPERATURES[0]
+            ):
+                if len(chunks) == 0:
+                    self.stage_timings[FIRST_TOKEN_STAGE] = time.perf_counter() - start
+                chunks.append(chunk)
+                if summary_future is not None:
+                    continue
+
+                text = "".join(chunks)
+                match = TRAILING_BLOCK_REGEX.search(text, max(scanned - 16, 0))
+                scanned = len(text)
+                if match is not None and match.start() > 0:
+                    prefix = TerraformConfig(text[: match.start()], name)
+                    summary_future = executor.submit(
+                        self._summarize_timed, prefix, original_query
+                    )
+        except Exception as e:
+            print(f"Couldn't stream config because of {e}. Retrying unstreamed.")
+            chunks = [self._extract_template(input, prompt=prompt).template]
+            summary_future = None
+        finally:
+            executor.shutdown(wait=False)
+
+        self.stage_timings[CONSTRUCT_STAGE] = time.perf_counter() - start
+        config = TerraformConfig("".join(chunks), name)
+
+        if summary_future is not None and self._summary_covers(prefix, config):
+            response, self.stage_timings[SUMMARY_STAGE] = summary_future.result()
+            return config, response
+
+        if summary_future is not None:
+            print("Config grew after the summary started. Summarizing it again.")
+
+        return config, self._timed(
+            SUMMARY_STAGE, self._coalesce_response, config, original_query
+        )
+
+    def _summary_covers(self, prefix: TerraformConfig, config: TerraformConfig) -> bool:
+        """
+        Whether a summary of prefix holds for the whole config: it has the
+        same resources, and asks for the same missing values.
+        """
+        return get_parse_cache().parse(prefix.template).resource_addresses() == (
+            get_parse_cache().parse(config.template).resource_addresses()
+        ) and prefix.template.count(PLACEHOLDER) == config.template.count(PLACEHOLDER)
+
     def _coalesce_response(self, stack: TerraformConfig, original_query: str) -> str:
         """
         Respond to the user abstractly in one final response. Ask them whether we should deploy,
@@ -87,7 +346,7 @@ class ConstructTFConfigAction(base.AbstractAction):
             {original_query}
 
             Constructed terraform configuration: 
-            {stack.template}
+            {compact(stack.template).text}
         """
 
         response = prompt_with_file(
@@ -101,16 +360,38 @@ class ConstructTFConfigAction(base.AbstractAction):
         For construction of a tf config file, this fn will input a response,
         and create + update a config in supabase.
         """
-        # 1. Clean up input with a gpt call.
-        cleaned_input = self.clean_input(infra_description)
-        # print(cleaned_input)
+        self.stage_timings = {}
+        start = time.perf_counter()
+
+        # 1. Clean up input with a gpt call, unless construction does it
+        cleaned_input = infra_description
+        if CONSTRUCT_CLEAN_INPUT:
+            cleaned_input = self._timed(
+                CLEAN_INPUT_STAGE, self.clean_input, infra_description
+            )
 
-        # 2. Run a gpt call to extract a terraform config
-        tf_config = self._extract_template(cleaned_input)
+        # 2. Extract a terraform config, picking the best of several if enabled.
+        # 4. Return a string with the detailed info regarding the terraform config's
+        # functionality. A single config streams, and its summary overlaps the
+        # stream. Several are ranked, and the summary of the best by local checks
+        # overlaps their validation.
+        if self.candidates > 1:
+            tf_config, self.candidate_scores, response = self.construct_best(
+                cleaned_input, infra_description
+            )
+        else:
+            tf_config, response = self.construct_streaming(
+                cleaned_input, infra_description
+            )
         print(tf_config.template)
 
         # 3. Check terraform config against original query. Removing for now.
         self.tf_config = tf_config
 
-        # 4. Return a string with the detailed info regarding the terraform config's functionality
-        return self._coalesce_response(tf_config, infra_description)
+        self.stage_timings[TOTAL_STAGE] = time.perf_counter() - start
+        print(
+            "Construction stage timings: "
+            + ", ".join(f"{k}={v:.2f}s" for k, v in self.stage_timings.items())
+        )
+
+        return response
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
+import tempfile
+import shutil
+import os
+
+from python_terraform import IsFlagged
+
+from src.model.stack import TerraformConfig
+from src.model.patch import unresolved_references
+from src.model.hcl import get_parse_cache, mask, OPENERS, CLOSERS
+from src.actions.precheck import (
+    parse_validate_output,
+    normalize_diagnostic,
+    ERROR_SEVERITY,
+    SEVERITY,
+    SUMMARY,
+    DETAIL,
+    VALIDATE,
+)
+from src.actions.tf_stream import StreamingTerraform
+from src.actions.tf_workspace import TFWorkspacePool
+from src.actions.lint import lint_errors
+
+# How many configs construction samples and checks at once. 1 disables the search.
+CONSTRUCT_CANDIDATES = int(os.environ.get("CONSTRUCT_CANDIDATES", "3"))
+# Sampling temperatures for candidates. The first is what a single sample uses.
+CONSTRUCT_TEMPERATURES = [0.8, 0.4, 1.0]
+
+# What construction is told to write for values it doesn't know
+PLACEHOLDER = "xxxxxx"
+
+# Score keys
+NAME = "name"
+TEMPERATURE = "temperature"
+VALID = "valid"
+ERRORS = "errors"
+UNRESOLVED = "unresolved"
+PLACEHOLDERS = "placeholders"
+RESOURCES = "resources"
+BALANCED = "balanced"
+LINT_ERRORS = "lint_errors"
+
+
+class ConstructionCandidate:
+    """
+    A sampled config, and how it did in local structural checks and in
+    terraform validate.
+    """
+
+    def __init__(self, config: TerraformConfig, temperature: float) -> None:
+        self.config = config
+        self.temperature = temperature
+        self.balanced = True
+        self.resources = 0
+        self.unresolved: List[str] = []
+        self.placeholders = 0
+        self.lint_errors: List[Dict[str, Any]] = []
+        # None until validated
+        self.valid: Union[bool, None] = None
+        self.diagnostics: List[Dict[str, Any]] = []
+
+    def errors(self) -> List[Dict[str, Any]]:
+        return [d for d in self.diagnostics if d[SEVERITY] == ERROR_SEVERITY]
+
+    def check_structure(self):
+        """
+        Cheap local checks: brackets balance, there are resources, references
+        resolve, the config lints against the provider schemas, and how many
+        values were left as placeholders.
+        """
+        template = self.config.template
+        masked = mask(template)
+        self.balanced = sum(masked.count(c) for c in OPENERS) == sum(
+            masked.count(c) for c in CLOSERS
+        )
+
+        parsed = get_parse_cache().parse(template)
+        self.resources = len(parsed.resources())
+        self.unresolved = sorted(unresolved_references(parsed))
+        self.placeholders = template.count(PLACEHOLDER)
+        self.lint_errors = lint_errors(template)
+
+    def rank(self) -> Tuple[int, int, int, int, int, int, int]:
+        """
+        Lower is better. Well formed configs with resources come first, then
+        those terraform validated, then those with fewer validate errors, lint
+        errors, dangling references and placeholders.
+        """
+        return (
+            0 if self.balanced and self.resources > 0 else 1,
+            0 if self.valid else 1,
+            len(self.errors()),
+            len(self.lint_errors),
+            len(self.unresolved),
+            self.placeholders,
+            0 if self.valid is not None else 1,
+        )
+
+    def scores(self) -> Dict[str, Any]:
+        return {
+            NAME: self.config.name,
+            TEMPERATURE: self.temperature,
+            VALID: self.valid,
+            ERRORS: [d[SUMMARY] for d in self.errors()],
+            UNRESOLVED: self.unresolved,
+            PLACEHOLDERS: self.placeholders,
+            RESOURCES: self.resources,
+            BALANCED: self.balanced,
+            LINT_ERRORS: [d[SUMMARY] for d in self.lint_errors],
+        }
+
+
+class ConstructionSearch:
+    """
+    Checks sampled configs concurrently and ranks them. Each is validated in
+    its own scratch working dir, initialized without a backend, so nothing
+    needs credentials or touches state.
+    """
+
+    def __init__(self, workspace_pool: Union[TFWorkspacePool, None] = None) -> None:
+        self.workspace_pool = workspace_pool
+
+    def _scratch_dir(self) -> str:
+        if self.workspace_pool is not None:
+            return self.workspace_pool.acquire()
+
+        return tempfile.mkdtemp(prefix="tf-construct-")
+
+    def _release(self, scratch: str):
+        if self.workspace_pool is not None:
+            self.workspace_pool.release(scratch)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def validate(self, candidate: ConstructionCandidate):
+        """
+        Runs `terraform validate` on a candidate.
+        """
+        scratch = self._scratch_dir()
+        try:
+            config_path = os.path.join(scratch, f"{candidate.config.name}.tf")
+            with open(config_path, "w", encoding="utf8") as fp:
+                fp.write(candidate.config.template)
+
+            tf = StreamingTerraform(working_dir=scratch)
+            return_code, _, stderr = tf.init(backend=False, input=False)
+            if return_code != 0:
+                candidate.valid = False
+                candidate.diagnostics = [
+                    normalize_diagnostic(
+                        {SUMMARY: "terraform init failed", DETAIL: stderr}, VALIDATE
+                    )
+                ]
+                return
+
+            _, stdout, stderr = tf.cmd("validate", json=IsFlagged, no_color=IsFlagged)
+            candidate.valid, candidate.diagnostics = parse_validate_output(
+                stdout or stderr
+            )
+        except Exception as e:
+            print(f"Couldn't validate candidate config: {e}")
+        finally:
+            self._release(scratch)
+
+    def validate_if_well_formed(
+        self, candidate: ConstructionCandidate
+    ) -> ConstructionCandidate:
+        """
+        Validates a structurally checked candidate if it's well formed and
+        lints clean. One that doesn't lint would fail validate anyway.
+        """
+        if (
+            candidate.balanced
+            and candidate.resources > 0
+            and len(candidate.lint_errors) == 0
+        ):
+            self.validate(candidate)
+
+        return candidate
+
+    def evaluate(self, candidate: ConstructionCandidate) -> ConstructionCandidate:
+        """
+        Structurally checks a candidate, then validates it if it's well formed.
+        """
+        candidate.check_structure()
+        return self.validate_if_well_formed(candidate)
+
+    def rank(
+        self,
+        candidates: List[ConstructionCandidate],
+        on_provisional_best: Union[
+            Callable[[ConstructionCandidate], None], None
+        ] = None,
+    ) -> List[ConstructionCandidate]:
+        """
+        Evaluates every candidate in parallel, and returns them best first.
+        on_provisional_best is called with the best candidate by the local
+        checks alone, before the slower terraform validate runs, so work on it
+        can overlap validation.
+        """
+        with ThreadPoolExecutor(max_workers=max(len(candidates), 1)) as executor:
+            list(executor.map(lambda c: c.check_structure(), candidates))
+            if on_provisional_best is not None and len(candidates) > 0:
+                on_provisional_best(min(candidates, key=lambda c: c.rank()))
+
+            evaluated = list(executor.map(self.validate_if_well_formed, candidates))
+
+        ranked = sorted(evaluated, key=lambda c: c.rank())
+        for candidate in ranked:
+            print(
+                f"Candidate config (temperature={candidate.temperature}): "
+                f"rank={candidate.rank()}"
+            )
+
+        return ranked
@@ -0,0 +1,342 @@
+from typing import Any, Dict, List, Tuple, Union
+import threading
+import json
+
+PRICING_PATH = "include/data/aws_pricing.json"
+
+# Pricing table keys
+VERSION = "version"
+CURRENCY = "currency"
+HOURS_PER_MONTH = "hours_per_month"
+BASE_REGION = "base_region"
+REGION_MULTIPLIERS = "region_multipliers"
+USAGE_BASED = "usage_based"
+FREE = "free"
+RESOURCES = "resources"
+
+# Price component keys and units
+UNIT = "unit"
+KEY = "key"
+DEFAULT_KEY = "default_key"
+PRICES = "prices"
+PRICE = "price"
+QUANTITY = "quantity"
+DEFAULT = "default"
+MULTIPLIERS = "multipliers"
+HOUR = "hour"
+MONTH = "month"
+GB_MONTH = "gb_month"
+
+# Estimated resource keys
+ADDRESS = "address"
+TYPE = "type"
+MONTHLY_COST = "monthly_cost"
+
+# Which check reported a diagnostic
+COST = "cost"
+
+MANAGED_MODE = "managed"
+DELETE_ACTIONS = ["delete"]
+
+
+class PricingTableException(Exception):
+    """
+    Represents a pricing table that can't be loaded.
+    """
+
+    pass
+
+
+def lookup_path(values: Any, path: Tuple[str, ...]) -> Any:
+    """
+    Looks up a dotted attribute path like root_block_device.0.volume_size in
+    a resource's planned values. Returns None if any part is missing.
+    """
+    for part in path:
+        if isinstance(values, dict):
+            values = values.get(part)
+        elif isinstance(values, list) and part.isdigit() and int(part) < len(values):
+            values = values[int(part)]
+        else:
+            return None
+
+    return values
+
+
+def _path(dotted: Union[str, None]) -> Union[Tuple[str, ...], None]:
+    return tuple(dotted.split(".")) if dotted else None
+
+
+def _as_key(value: Any) -> str:
+    """
+    A planned value as a price table key. Bools are lowercase, like in hcl.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+
+    return str(value)
+
+
+class PriceComponent:
+    """
+    One billed dimension of a resource type, e.g. an instance's hours or its
+    root volume's GB, compiled from the pricing table for fast lookups.
+    """
+
+    __slots__ = (
+        "hours",
+        "key",
+        "default_key",
+        "prices",
+        "price",
+        "quantity",
+        "default",
+        "multipliers",
+    )
+
+    def __init__(self, component: Dict[str, Any], hours_per_month: float) -> None:
+        self.hours = hours_per_month if component[UNIT] == HOUR else 1.0
+        self.key = _path(component.get(KEY))
+        self.default_key = component.get(DEFAULT_KEY)
+        self.prices = component.get(PRICES)
+        self.price = component.get(PRICE)
+        self.quantity = _path(component.get(QUANTITY))
+        self.default = component.get(DEFAULT, 1)
+        self.multipliers = tuple(
+            (_path(key), factors)
+            for key, factors in component.get(MULTIPLIERS, {}).items()
+        )
+
+    def monthly(self, values: Dict[str, Any]) -> Union[float, None]:
+        """
+        The monthly cost of this component given a resource's planned values,
+        or None if it can't be priced, e.g. for an unknown instance type.
+        """
+        if self.key is not None:
+            key = lookup_path(values, self.key)
+            key = self.default_key if key is None else _as_key(key)
+            price = self.prices.get(key) if key is not None else None
+        else:
+            price = self.price
+        if price is None:
+            return None
+
+        quantity = self.default
+        if self.quantity is not None:
+            planned = lookup_path(values, self.quantity)
+            if isinstance(planned, (int, float)) and not isinstance(planned, bool):
+                quantity = planned
+
+        cost = price * quantity * self.hours
+        for path, factors in self.multipliers:
+            cost *= factors.get(_as_key(lookup_path(values, path)), 1.0)
+
+        return cost
+
+
+class PricingTable:
+    """
+    A versioned table of on demand prices, per resource type, in the base
+    region. Other regions are priced with a flat multiplier.
+    """
+
+    def __init__(self, table: Dict[str, Any]) -> None:
+        self.version = table[VERSION]
+        self.currency = table.get(CURRENCY, "USD")
+        self.base_region = table[BASE_REGION]
+        self.region_multipliers = table.get(REGION_MULTIPLIERS, {})
+        self.usage_based = frozenset(table.get(USAGE_BASED, []))
+        self.free = frozenset(table.get(FREE, []))
+
+        hours_per_month = table.get(HOURS_PER_MONTH, 730)
+        self.components = {
+            rtype: tuple(PriceComponent(c, hours_per_month) for c in components)
+            for rtype, components in table[RESOURCES].items()
+        }
+
+    @classmethod
+    def load(cls, path: str = PRICING_PATH) -> "PricingTable":
+        """
+        Loads a pricing table from disk.
+        """
+        try:
+            with open(path, "r", encoding="utf8") as fp:
+                return cls(json.load(fp))
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            raise PricingTableException(f"Couldn't load pricing from {path}: {e}")
+
+    def monthly(self, rtype: str, values: Dict[str, Any]) -> Union[float, None]:
+        """
+        The monthly cost of a resource in the base region. Usage based
+        resources cost nothing until used, and free ones nothing at all.
+        Returns None if the resource type, or any of its billed dimensions,
+        isn't in the table, so the resource may be billed at any price.
+        """
+        if rtype in self.usage_based or rtype in self.free:
+            return 0.0
+
+        components = self.components.get(rtype)
+        if components is None:
+            return None
+
+        total = 0.0
+        for component in components:
+            cost = component.monthly(values)
+            if cost is None:
+                return None
+            total += cost
+
+        return total
+
+
+class CostEstimate:
+    """
+    The estimated monthly cost of everything a plan leaves deployed, with
+    the resources that couldn't be priced. Those aren't known to be free, so
+    the total is only a lower bound while there are any.
+    """
+
+    def __init__(
+        self,
+        resources: List[Dict[str, Any]],
+        unpriced: List[str],
+        region: str,
+        version: str,
+        currency: str,
+    ) -> None:
+        self.resources = resources
+        self.unpriced = unpriced
+        self.region = region
+        self.version = version
+        self.currency = currency
+        self.total = sum(r[MONTHLY_COST] for r in resources)
+
+    def summary(self, top: int = 5) -> str:
+        """
+        A short breakdown of the most expensive resources.
+        """
+        ranked = sorted(self.resources, key=lambda r: -r[MONTHLY_COST])[:top]
+        lines = [
+            f"{r[ADDRESS]}: {r[MONTHLY_COST]:.2f} {self.currency}/month" for r in ranked
+        ]
+        if len(self.unpriced) > 0:
+            lines.append(f"not priced: {', '.join(self.unpriced)}")
+
+        return "\n".join(lines)
+
+
+def plan_region(plan: Dict[str, Any]) -> Union[str, None]:
+    """
+    The aws provider's region, if it's set to a constant in the config.
+    """
+    provider = ((plan.get("configuration") or {}).get("provider_config") or {}).get(
+        "aws"
+    ) or {}
+    region = (provider.get("expressions") or {}).get("region") or {}
+
+    return region.get("constant_value")
+
+
+def planned_resources(plan: Dict[str, Any]) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    The (address, type, values) of every managed resource that's deployed once
+    a `terraform show -json` plan is applied: the planned values of resources
+    it creates or updates, and the current values of those it doesn't touch,
+    e.g. when the plan was limited to targets.
+    """
+    changed = {}
+    for change in plan.get("resource_changes", []):
+        if change.get("mode") != MANAGED_MODE:
+            continue
+        actions = change["change"]["actions"]
+        after = change["change"].get("after") or {}
+        changed[change[ADDRESS]] = (
+            None if actions == DELETE_ACTIONS else (change[TYPE], after)
+        )
+
+    resources = [
+        (address, *planned)
+        for address, planned in changed.items()
+        if planned is not None
+    ]
+
+    prior = ((plan.get("prior_state") or {}).get("values") or {}).get("root_module")
+    modules = [prior or {}]
+    while len(modules) > 0:
+        module = modules.pop()
+        for resource in module.get("resources", []):
+            if (
+                resource.get("mode") == MANAGED_MODE
+                and resource[ADDRESS] not in changed
+            ):
+                resources.append(
+                    (resource[ADDRESS], resource[TYPE], resource.get("values") or {})
+                )
+        modules.extend(module.get("child_modules", []))
+
+    return resources
+
+
+class CostEstimator:
+    """
+    Estimates the monthly cost of a terraform plan from a local pricing
+    table, without calling any pricing api, so it's cheap enough to run
+    before every apply.
+    """
+
+    def __init__(self, pricing: PricingTable) -> None:
+        self.pricing = pricing
+
+    def estimate(self, plan: Dict[str, Any], region: str) -> CostEstimate:
+        """
+        Estimates a parsed `terraform show -json` plan. The config's own region
+        takes precedence over region. In a region the table has no multiplier
+        for, only free resources are priced, since the rest could cost more
+        there than anywhere in the table.
+        """
+        region = plan_region(plan) or region
+        multiplier = self.pricing.region_multipliers.get(region)
+        if multiplier is None:
+            print(f"No pricing for region {region}. Billed resources are unpriced.")
+
+        resources, unpriced = [], []
+        for address, rtype, values in planned_resources(plan):
+            monthly = self.pricing.monthly(rtype, values)
+            if monthly is None or (multiplier is None and monthly > 0):
+                unpriced.append(address)
+                continue
+
+            if multiplier is not None:
+                monthly *= multiplier
+            resources.append({ADDRESS: address, TYPE: rtype, MONTHLY_COST: monthly})
+
+        return CostEstimate(
+            resources,
+            unpriced,
+            region,
+            self.pricing.version,
+            self.pricing.currency,
+        )
+
+    def estimate_json(self, plan_json: str, region: str) -> CostEstimate:
+        """
+        Estimates the raw output of `terraform show -json` on a saved plan.
+        """
+        return self.estimate(json.loads(plan_json), region)
+
+
+_default_estimator: Union[CostEstimator, None] = None
+_default_estimator_lock = threading.Lock()
+
+
+def get_cost_estimator() -> CostEstimator:
+    """
+    Returns the process wide cost estimator, loading the pricing table once.
+    """
+    global _default_estimator
+
+    with _default_estimator_lock:
+        if _default_estimator is None:
+            _default_estimator = CostEstimator(PricingTable.load())
+
+    return _default_estimator
@@ -0,0 +1,36 @@
+from typing import Dict, Union
+import threading
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+_account_ids: Dict[str, str] = {}
+_account_ids_lock = threading.Lock()
+
+
+def resolve_account_id(secret: str, access: str, region: str) -> Union[str, None]:
+    """
+    The aws account id a set of credentials belongs to, from sts
+    GetCallerIdentity. Cached per access key, since a key never changes
+    account. Returns None if it can't be resolved.
+    """
+    with _account_ids_lock:
+        if access in _account_ids:
+            return _account_ids[access]
+
+    try:
+        sts = boto3.client(
+            "sts",
+            aws_access_key_id=access,
+            aws_secret_access_key=secret,
+            region_name=region,
+        )
+        account = sts.get_caller_identity()["Account"]
+    except (ClientError, BotoCoreError, KeyError) as e:
+        print(f"Couldn't resolve the aws account of access key {access}: {e}")
+        return None
+
+    with _account_ids_lock:
+        _account_ids[access] = account
+
+    return account
@@ -1,22 +1,82 @@
-from typing import Any, Tuple, List
+from typing import Any, Dict, Tuple, List, Union
 import json
+import re
+import shutil
 from uuid import UUID
 from python_terraform import *
 from . import base
 from collections import deque
 
 from src.model.stack import TerraformConfig
+from src.model.hcl import get_parse_cache
+from src.model.compact import CompactConfig, compact, related_addresses, ELIDED_NOTE
+from src.actions.tf_workspace import (
+    TFWorkspacePool,
+    seed_working_dir,
+    select_workspace,
+    TF_FILE_SUFFIXES,
+    TF_STATE_DIR,
+    LOCK_FILE,
+)
+from src.actions.tf_backend import AbstractStateBackend, get_state_backend
+from src.actions.tf_logs import LogReducer
+from src.actions.fix_cache import FixCache, get_fix_cache, fix_scope
+from src.actions.credentials import resolve_account_id
+from src.actions.tf_logs import ADDRESSES
+from src.actions.fix_search import (
+    FixSearch,
+    FixCandidate,
+    FIX_SEARCH_CANDIDATES,
+    FIX_TEMPERATURES,
+)
+from concurrent.futures import ThreadPoolExecutor
+from src.actions.tf_stream import (
+    StreamingTerraform,
+    ProgressChannel,
+    credentials_env,
+    TYPE,
+    MESSAGE,
+    DIAGNOSTIC,
+    DIAGNOSTIC_EVENT,
+    is_error,
+)
+from src.actions.cost import (
+    CostEstimate,
+    get_cost_estimator,
+    PricingTableException,
+    COST,
+)
+from src.actions.precheck import (
+    PlanResult,
+    normalize_diagnostic,
+    SUMMARY,
+    DETAIL,
+    run_precheck,
+    parse_state_resources,
+    has_changes,
+    get_plan_cache,
+    format_diagnostic,
+    PLANS_DIR,
+    PLAN_SUFFIX,
+    VALIDATE,
+    SOURCE,
+)
 from src.db.supa import SupaClient, ChatSessionState
 
 from include.llm.base import AbstractLLMClient
-from include.utils import prompt_with_file, BASE_PROMPT_PATH
+from include.utils import prompt_with_file, hash_str, BASE_PROMPT_PATH
 from enum import Enum
 
 # TODO use this to validate whether a stack is valid or not before deployment: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation/client/validate_template.html
 
 NUM_RETRIES = 1
+# Cached fixes are cheap, so they're tried on top of the llm retries
+MAX_CACHED_FIXES = 2
 LOG_LIMIT = 100
 
+# Strips the instance key from an address, e.g. aws_instance.web[0] -> aws_instance.web
+INSTANCE_KEY_REGEX = re.compile(r"\[[^\]]*\]$")
+
 REQUEST_DEPLOYMENT_INFO_PROMPT = "request_deployment_info.txt"
 VERIFY_CONSTRUCTED_CONFIG = "verify_config.txt"
 USABILITY_AIDE = "return_how_to_use.txt"
@@ -30,6 +90,10 @@ ERROR_RESPONSE = (
     "Awe man, looks like something failed with the deployment. Please contact support."
 )
 DESTROY_SUCCESS = "Successfully destroyed and cleaned up your resources."
+ORPHANED_RESOURCES_RESPONSE = "\n\nSome resources from the failed deployment couldn't be cleaned up, and may still be running in your account: {}. Please delete them yourself, or ask me to try again."
+
+# Resources a failed deployment left behind that couldn't be destroyed, in the session dir
+ORPHANED_RESOURCES_FILE = "orphaned_resources.json"
 
 
 class DiagnoserState(Enum):
@@ -50,6 +114,14 @@ class TFConfigRequiresUserInfoException(Exception):
     pass
 
 
+class CostLimitExceededException(Exception):
+    """
+    Represents a plan whose estimated monthly cost is over the session's cost limiter.
+    """
+
+    pass
+
+
 class DeploymentBrokenException(Exception):
     """
     An exception that marks cases where a broken deployment can't be debugged.
@@ -58,6 +130,14 @@ class DeploymentBrokenException(Exception):
     pass
 
 
+class PrecheckFailedException(Exception):
+    """
+    Represents a config rejected by validate or plan, before anything was applied.
+    """
+
+    pass
+
+
 class Diagnoser:
     """
     A class that intakes a tf config, and diagnoses what is or isn't wrong with the template.
@@ -68,14 +148,57 @@ class Diagnoser:
         config: TerraformConfig,
         llm_client: AbstractLLMClient,
         log_cache_limit=LOG_LIMIT,
+        fix_cache: Union[FixCache, None] = None,
     ) -> None:
         self.config = config
         self.logs_cache = deque(maxlen=log_cache_limit)
         self.llm_client = llm_client
+        self.log_reducer = LogReducer()
+        self.fix_cache = fix_cache if fix_cache is not None else get_fix_cache()
+
+        # The credentials fix cache rules are scoped by, and the scope once it's
+        # resolved. The fix cache isn't used without them.
+        self.scope_credentials: Union[Tuple[Any, str, str, str], None] = None
+        self._fix_scope: Union[str, None] = None
+
+        # The errors the last fix addressed, and whether it came from the fix cache
+        self.fixed_errors: List[Dict[str, Any]] = []
+        self.last_fix_cached = False
 
-    def fix_broken_config(self, diagnosed_issue: DiagnoserState) -> TerraformConfig:
+    def set_scope_credentials(
+        self, user_id: Any, secret: str, access: str, region: str
+    ):
+        """
+        Sets the user and credentials fix cache rules are scoped to.
+        """
+        self.scope_credentials = (user_id, secret, access, region)
+        self._fix_scope = None
+
+    @property
+    def fix_scope(self) -> Union[str, None]:
+        """
+        The user, account and region fix cache rules are scoped to. The account
+        takes an sts call, so it's only resolved once a fix needs it.
+        """
+        if self._fix_scope is None and self.scope_credentials is not None:
+            user_id, secret, access, region = self.scope_credentials
+            account = resolve_account_id(secret, access, region) or access
+            self._fix_scope = fix_scope(user_id, account, region)
+
+        return self._fix_scope
+
+    def reduced_logs(self) -> str:
+        """
+        The distinct errors in the logs cache, deduplicated and within budget.
+        """
+        return self.log_reducer.reduce(self.logs_cache)
+
+    def fix_broken_config(
+        self, diagnosed_issue: DiagnoserState, use_cache: bool = True
+    ) -> TerraformConfig:
         """
         A helper fn to fix a broken config. Assumes that the provided config is broken as is.
+        Known errors are fixed from the fix cache without calling the llm, if use_cache.
         Returns the fixed config.
         """
 
@@ -83,14 +206,6 @@ class Diagnoser:
             print("no deployments attempted. Returning og stack.")
             return self.config
 
-        prompt = f"""
-            Terraform config:
-            {self.config.template}
-
-            Deployment logs:
-            {'Log Message:'.join(map(str, self.logs_cache))}
-        """
-
         if (
             diagnosed_issue == DiagnoserState.DEPLOYABLE
         ):  # No action. config is good as is.
@@ -99,24 +214,135 @@ class Diagnoser:
             diagnosed_issue == DiagnoserState.MISSING_OR_INVALID_DATA
             or diagnosed_issue == DiagnoserState.OTHER
         ):
-            # Need to basically verify that the tf config's info that is broken can be
-            # fixed/is a stupid mistake rather than user issue.
-            response = prompt_with_file(
-                BASE_PROMPT_PATH + VERIFY_CONSTRUCTED_CONFIG,
-                prompt,
-                self.llm_client,
-                is_json=False,
-            )
-
-            if len(response) == 0:
+            self.fixed_errors = self.log_reducer.errors(self.logs_cache)
+            self.last_fix_cached = False
+
+            if use_cache:
+                cached = self.fix_cache.lookup(
+                    self.fix_scope, self.config.template, self.fixed_errors
+                )
+                if cached is not None:
+                    self.last_fix_cached = True
+                    return TerraformConfig(cached, self.config.name)
+
+            fixed = self.llm_fix()
+            if fixed is None:
                 print("Stack reqires some info from user. Returning custom msg.")
                 raise TFConfigRequiresUserInfoException
 
-            print(f"Fixed tf config: {response}")
-            return TerraformConfig(response, self.config.name)
+            return fixed
 
         raise DeploymentBrokenException
 
+    def compacted_config(self) -> CompactConfig:
+        """
+        The config compacted for a fix prompt. If every error names the
+        resources it occurred on, only those and their neighbours keep their
+        bodies. Otherwise nothing is elided.
+        """
+        keep = None
+        if len(self.fixed_errors) > 0 and all(
+            len(error[ADDRESSES]) > 0 for error in self.fixed_errors
+        ):
+            addresses = {
+                INSTANCE_KEY_REGEX.sub("", address)
+                for error in self.fixed_errors
+                for address in error[ADDRESSES]
+            }
+            keep = related_addresses(self.config.parsed, addresses) or None
+
+        return compact(self.config.template, keep)
+
+    def llm_fix(self, temperature: float = 0.2) -> Union[TerraformConfig, None]:
+        """
+        Asks the llm to fix the config given the logged errors. Returns None if
+        it decided the config can't be fixed without the user's input.
+        """
+        compacted = self.compacted_config()
+        note = ELIDED_NOTE if len(compacted.stubs) > 0 else ""
+        prompt = f"""
+            Terraform config:
+            {compacted.text}
+            {note}
+
+            Deployment errors:
+            {self.reduced_logs()}
+        """
+
+        # Need to basically verify that the tf config's info that is broken can be
+        # fixed/is a stupid mistake rather than user issue.
+        response = prompt_with_file(
+            BASE_PROMPT_PATH + VERIFY_CONSTRUCTED_CONFIG,
+            prompt,
+            self.llm_client,
+            is_json=False,
+            temperature=temperature,
+        )
+
+        if len(response) == 0:
+            return None
+
+        fixed = compacted.expand(response)
+        print(f"Fixed tf config: {fixed}")
+        return TerraformConfig(fixed, self.config.name)
+
+    def fix_candidates(self, n: int, use_cache: bool = True) -> List[FixCandidate]:
+        """
+        Generates up to n distinct candidate fixes from the llm concurrently, at
+        varied temperatures, plus the fix cache's fix if there is one. Raises if
+        every llm response said the user's input is needed.
+        """
+        self.fixed_errors = self.log_reducer.errors(self.logs_cache)
+        self.last_fix_cached = False
+
+        candidates = []
+        if use_cache:
+            cached = self.fix_cache.lookup(
+                self.fix_scope, self.config.template, self.fixed_errors
+            )
+            if cached is not None:
+                candidates.append(
+                    FixCandidate(TerraformConfig(cached, self.config.name), True)
+                )
+
+        temperatures = [FIX_TEMPERATURES[i % len(FIX_TEMPERATURES)] for i in range(n)]
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            fixes = list(executor.map(self.llm_fix, temperatures))
+
+        seen = {c.config.template for c in candidates}
+        for fixed in fixes:
+            if fixed is not None and fixed.template not in seen:
+                seen.add(fixed.template)
+                candidates.append(FixCandidate(fixed, False))
+
+        if all(fixed is None for fixed in fixes) and len(candidates) == 0:
+            raise TFConfigRequiresUserInfoException
+
+        return candidates
+
+    def record_fix_result(self, fixed_template: str, succeeded: bool):
+        """
+        Updates the fix cache with how the last fix went. Cached fixes have their
+        track record updated, and llm fixes that worked are learned as rules.
+        """
+        if len(self.fixed_errors) == 0:
+            return
+
+        try:
+            if self.last_fix_cached:
+                self.fix_cache.record(self.fix_scope, self.fixed_errors, succeeded)
+            elif succeeded:
+                self.fix_cache.learn(
+                    self.fix_scope,
+                    self.config.template,
+                    fixed_template,
+                    self.fixed_errors,
+                )
+        except OSError as e:
+            print(f"Couldn't update fix cache: {e}")
+
+        self.fixed_errors = []
+
     def determine_config_deployability(
         self, current_state: ChatSessionState
     ) -> DiagnoserState:
@@ -149,9 +375,16 @@ class DeployTFConfigAction(base.AbstractAction):
         chat_session_id: UUID,
         state_manager: SupaClient,
         tf_file_dir: str,
+        workspace_pool: Union[TFWorkspacePool, None] = None,
+        progress: Union[ProgressChannel, None] = None,
+        state_backend: Union[AbstractStateBackend, None] = None,
     ) -> None:
         """
-        Constructs a user deployment action
+        Constructs a user deployment action. tf_file_dir holds the session's config,
+        and its state unless state_backend keeps state elsewhere. If a workspace_pool
+        is provided, terraform runs in a pre-initialized working dir leased from it,
+        and local state is synced back on release_workspace. Apply and destroy
+        events are published to progress as they stream in.
         """
         super().__init__()
 
@@ -159,24 +392,91 @@ class DeployTFConfigAction(base.AbstractAction):
         self.state_manager = state_manager
         self.chat_session_id = chat_session_id
         self.diagnoser = Diagnoser(self.user_config, self.claude_client)
+        self.progress = progress if progress is not None else ProgressChannel()
+        self.state_backend = (
+            state_backend if state_backend is not None else get_state_backend()
+        )
 
         self.tf_file_dir = tf_file_dir
-        self.tf_client = self.init_tf_workspace()
+        self.workspace_pool = workspace_pool
+        self.working_dir = self.lease_workspace()
+        try:
+            self.tf_client = self.init_tf_workspace()
+        except Exception:
+            # __exit__ never runs if construction fails, so the lease goes back here
+            self.release_workspace()
+            raise
 
-    def init_tf_workspace(self) -> Terraform:
+    def lease_workspace(self) -> str:
         """
-        Sets up the terraform workspace with proper credentials.
+        Returns the dir terraform runs in. With a pool, that's a leased working dir
+        seeded with the session's config files and state.
         """
-        tf = Terraform(working_dir=self.tf_file_dir)
-        tf.create_workspace(str(self.chat_session_id))
+        if self.workspace_pool is None:
+            return self.tf_file_dir
 
-        # Setting credentials
-        secret, access, region = self.state_manager.get_user_aws_preferences()
-        os.environ["AWS_SECRET_ACCESS_KEY"] = secret
-        os.environ["AWS_ACCESS_KEY_ID"] = access
-        os.environ["AWS_DEFAULT_REGION"] = region
+        working_dir = self.workspace_pool.acquire()
+        seed_working_dir(self.tf_file_dir, working_dir)
 
-        tf.init()
+        return working_dir
+
+    def release_workspace(self):
+        """
+        Syncs state and the dependency lock file back to tf_file_dir, and returns
+        the working dir to the pool.
+        A no-op without a pool, since terraform ran in tf_file_dir directly.
+        """
+        if self.workspace_pool is None or self.working_dir == self.tf_file_dir:
+            return
+
+        # The session keeps the provider versions its first init picked
+        lock_file = os.path.join(self.working_dir, LOCK_FILE)
+        if os.path.isfile(lock_file):
+            shutil.copy2(lock_file, self.tf_file_dir)
+
+        state_dir = os.path.join(self.working_dir, TF_STATE_DIR)
+        if os.path.isdir(state_dir):
+            shutil.copytree(
+                state_dir,
+                os.path.join(self.tf_file_dir, TF_STATE_DIR),
+                dirs_exist_ok=True,
+            )
+
+        self.workspace_pool.release(self.working_dir)
+        self.working_dir = self.tf_file_dir
+
+    def __enter__(self) -> "DeployTFConfigAction":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release_workspace()
+
+    def init_tf_workspace(self) -> StreamingTerraform:
+        """
+        Sets up the terraform workspace with proper credentials, against the
+        state backend. The credentials only go into the environment of this
+        action's terraform processes, so concurrent deployments for different
+        users can't see each other's.
+        """
+        secret, access, region = self.state_manager.get_user_aws_preferences()
+        self.diagnoser.set_scope_credentials(
+            self.state_manager.user_id, secret, access, region
+        )
+        self.tf_env = {
+            **self.state_backend.env(),
+            **credentials_env(secret, access, region),
+        }
+        self.state_backend.configure(self.working_dir)
+        backend_config = self.state_backend.backend_config()
+        tf = StreamingTerraform(working_dir=self.working_dir, env=self.tf_env)
+
+        # Pooled dirs already have providers installed, so this init is quick.
+        if self.workspace_pool is not None:
+            self.workspace_pool.init(self.working_dir, self.tf_env, backend_config)
+        else:
+            tf.init(backend_config=backend_config)
+
+        select_workspace(tf, str(self.chat_session_id))
 
         return tf
 
@@ -193,8 +493,8 @@ class DeployTFConfigAction(base.AbstractAction):
         ) as fp:
             sys_prompt = fp.read()
             sys_prompt = sys_prompt.format(
-                self.user_config.template,
-                json.dumps(", ".join(list(self.diagnoser.logs_cache))),
+                compact(self.user_config.template).text,
+                json.dumps(self.diagnoser.reduced_logs()),
                 memory,
             )
             response = self.claude_client.query(sys_prompt, "", False, temperature=0.3)
@@ -210,23 +510,272 @@ class DeployTFConfigAction(base.AbstractAction):
         Destroys the failed config deployed by self.tf_client
         """
         print("Destroying the failed configuration...")
-        return_code, _, destroy_stderr = self.tf_client.cmd("destroy", "-auto-approve")
+        return_code, errors = self.stream_tf("destroy", auto_approve=IsFlagged)
         if return_code != 0:
-            self.diagnoser.logs_cache.append(destroy_stderr)
-            return destroy_stderr
+            return "\n".join(e[MESSAGE] for e in errors)
 
         return DESTROY_SUCCESS
 
-    def does_maintain_cost_limiter(self) -> bool:
+    def abandon_recovery(self) -> str:
+        """
+        Destroys whatever a failed deployment created, once recovery is given up,
+        so partially deployed resources don't keep running in the user's account.
+        Resources that survive the destroy are recorded in the session dir.
+        Returns a note for the user naming them, or "" if there are none.
+        """
+        if len(self.state_resources()) == 0:
+            return ""
+
+        try:
+            self.destroy()
+        except Exception as e:
+            print(f"Error destroying the failed deployment: {e}")
+
+        remaining = sorted(self.state_resources())
+        path = os.path.join(self.tf_file_dir, ORPHANED_RESOURCES_FILE)
+        if len(remaining) == 0:
+            if os.path.exists(path):
+                os.remove(path)
+            return ""
+
+        print(f"Couldn't destroy resources of the failed deployment: {remaining}")
+        with open(path, "w", encoding="utf8") as fp:
+            json.dump(remaining, fp)
+
+        return ORPHANED_RESOURCES_RESPONSE.format(", ".join(remaining))
+
+    def state_resources(self) -> Dict[str, bool]:
+        """
+        Every resource address in the session's state, and whether it's tainted.
+        """
+        return_code, stdout, _ = self.tf_client.cmd(
+            "show", json=IsFlagged, no_color=IsFlagged
+        )
+        if return_code != 0:
+            return {}
+
+        return parse_state_resources(stdout)
+
+    def affected_addresses(self) -> Union[List[str], None]:
+        """
+        The resources a retry has to apply after a partial failure: those the
+        logged errors refer to, tainted ones, and configured ones that never made
+        it into state. Healthy resources are left alone. Returns None if nothing
+        was deployed yet, or the affected set can't be worked out, meaning a
+        full apply.
+        """
+        resources = self.state_resources()
+        if len(resources) == 0:
+            return None
+
+        affected = {address for address, tainted in resources.items() if tainted}
+        for error in self.diagnoser.log_reducer.errors(self.diagnoser.logs_cache):
+            affected.update(error[ADDRESSES])
+
+        deployed = {INSTANCE_KEY_REGEX.sub("", address) for address in resources}
+        for name in os.listdir(self.working_dir):
+            path = os.path.join(self.working_dir, name)
+            if not (name.endswith(".tf") and os.path.isfile(path)):
+                continue
+            with open(path, "r", encoding="utf8") as fp:
+                parsed = get_parse_cache().parse(fp.read())
+            for address in parsed.resource_addresses():
+                if address not in deployed:
+                    affected.add(address)
+
+        if len(affected) == 0:
+            return None
+
+        return sorted(affected)
+
+    def config_hash(self, targets: Union[List[str], None] = None) -> str:
+        """
+        Hashes the config files in the working dir, along with the session's
+        workspace, since a saved plan is only good for the state it was made from,
+        and the targets the plan is limited to.
+        """
+        contents = [str(self.chat_session_id), ",".join(targets or [])]
+        for name in sorted(os.listdir(self.working_dir)):
+            path = os.path.join(self.working_dir, name)
+            if name.endswith(TF_FILE_SUFFIXES) and os.path.isfile(path):
+                with open(path, "r", encoding="utf8") as fp:
+                    contents.append(f"{name}\n{fp.read()}")
+
+        return hash_str("\n".join(contents))
+
+    def precheck(self, targets: Union[List[str], None] = None) -> PlanResult:
+        """
+        Validates and plans the config before anything is applied, limited to
+        targets if given. Failed diagnostics go into the diagnoser's logs cache.
+        Results are cached by config hash. Validate failures are cached outright
+        since they only depend on the config, while plan failures can be
+        transient and aren't.
+        """
+        key = self.config_hash(targets)
+        plan_cache = get_plan_cache()
+
+        result = plan_cache.get(key)
+        if result is None:
+            plan_path = os.path.join(self.tf_file_dir, PLANS_DIR, key + PLAN_SUFFIX)
+            result = run_precheck(self.tf_client, plan_path, targets)
+
+            if result.ok or all(d[SOURCE] == VALIDATE for d in result.errors()):
+                plan_cache.put(key, result)
+        else:
+            print(f"Using cached precheck for config {key}")
+
+        if not result.ok:
+            for diagnostic in result.errors():
+                self.diagnoser.logs_cache.append(format_diagnostic(diagnostic))
+        else:
+            print(f"Precheck passed. Planned changes: {result.changes}")
+
+        return result
+
+    def handle_event(self, event: Dict[str, Any]):
+        """
+        Handles a streamed terraform event. Error diagnostics go straight into the
+        diagnoser's logs cache, and every event is published for progress.
+        """
+        if event[TYPE] == DIAGNOSTIC_EVENT and is_error(event):
+            self.diagnoser.logs_cache.append(format_diagnostic(event[DIAGNOSTIC]))
+
+        self.progress.publish(event)
+
+    def stream_tf(self, cmd: str, *args, **kwargs) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Streams a terraform command through handle_event. If it fails without
+        reporting a diagnostic, e.g. on a crash, its error output is logged instead.
+        Returns the return code and error events.
+        """
+        return_code, errors = self.tf_client.stream(
+            cmd, *args, on_event=self.handle_event, **kwargs
+        )
+
+        if return_code != 0 and not any(e[TYPE] == DIAGNOSTIC_EVENT for e in errors):
+            messages = [e[MESSAGE] for e in errors] or [
+                f"terraform {cmd} exited with {return_code}"
+            ]
+            self.diagnoser.logs_cache.append("\n".join(messages))
+
+        return return_code, errors
+
+    def apply_plan(self, result: PlanResult) -> int:
+        """
+        Applies a saved plan, stopping at the first error. A plan can only be
+        applied once, so it's dropped from the cache and disk afterwards.
+        Returns the return code.
+        """
+        try:
+            return_code, _ = self.stream_tf(
+                "apply", result.plan_path, input=False, stop_on_error=True
+            )
+        finally:
+            self.discard_plan(result)
+
+        return return_code
+
+    def discard_plan(self, result: PlanResult):
+        """
+        Drops a saved plan from the cache and disk.
+        """
+        key = os.path.basename(result.plan_path)[: -len(PLAN_SUFFIX)]
+        get_plan_cache().evict(key)
+        if os.path.exists(result.plan_path):
+            os.remove(result.plan_path)
+
+    def estimate_cost(self, result: PlanResult) -> CostEstimate:
+        """
+        Estimates the monthly cost of everything deployed once a saved plan is applied.
+        """
+        return_code, stdout, stderr = self.tf_client.cmd(
+            "show", result.plan_path, json=IsFlagged, no_color=IsFlagged
+        )
+        if return_code != 0:
+            raise PricingTableException(f"Couldn't read plan: {stderr}")
+
+        return get_cost_estimator().estimate_json(stdout, self.tf_env["AWS_REGION"])
+
+    def does_maintain_cost_limiter(self, result: PlanResult) -> bool:
         """
         Returns true if the cost remains within the cost limiter set by the user.
+        Sessions without a limiter always do. If the cost can't be estimated, or
+        some resources that may be billed can't be priced, the plan is treated as
+        over the limit, since applying it could cost anything.
         """
-        # TODO implement
+        limit = self.state_manager.get_chat_session_cost_limiter(self.chat_session_id)
+        if limit is None:
+            return True
+
+        try:
+            estimate = self.estimate_cost(result)
+        except (PricingTableException, ValueError) as e:
+            print(f"Couldn't estimate deployment cost: {e}")
+            self.diagnoser.logs_cache.append(
+                format_diagnostic(
+                    normalize_diagnostic(
+                        {SUMMARY: "Couldn't estimate deployment cost", DETAIL: str(e)},
+                        COST,
+                    )
+                )
+            )
+            return False
+
+        print(
+            f"Estimated monthly cost: {estimate.total:.2f} {estimate.currency} "
+            f"in {estimate.region} (pricing {estimate.version}), limit {limit}"
+        )
+        if len(estimate.unpriced) > 0:
+            self.diagnoser.logs_cache.append(
+                format_diagnostic(
+                    normalize_diagnostic(
+                        {
+                            SUMMARY: "Couldn't estimate the cost of "
+                            f"{len(estimate.unpriced)} resource(s) against the "
+                            f"cost limit of {limit}",
+                            DETAIL: "No price is known for: "
+                            f"{', '.join(estimate.unpriced)}",
+                        },
+                        COST,
+                    )
+                )
+            )
+            return False
+
+        if estimate.total <= float(limit):
+            return True
+
+        self.diagnoser.logs_cache.append(
+            format_diagnostic(
+                normalize_diagnostic(
+                    {
+                        SUMMARY: f"Estimated monthly cost {estimate.total:.2f} "
+                        f"{estimate.currency} exceeds the cost limit of {limit}",
+                        DETAIL: estimate.summary(),
+                    },
+                    COST,
+                )
+            )
+        )
         return False
 
-    def deploy_config(self) -> Tuple[str, ChatSessionState]:
+    def check_cost(self, result: PlanResult):
         """
-        Deploys user's tf config into their account
+        Blocks a plan that's over the cost limiter before it's applied.
+        """
+        if not self.does_maintain_cost_limiter(result):
+            self.discard_plan(result)
+            raise CostLimitExceededException
+
+    def deploy_config(
+        self, targets: Union[List[str], None] = None
+    ) -> Tuple[str, ChatSessionState]:
+        """
+        Deploys user's tf config into their account. If targets are given, only
+        those resources and their dependencies are applied first, then the rest
+        of the config is reconciled with a full plan, which only applies if the
+        fix changed anything else. A failed apply leaves healthy resources in
+        place, so a retry only has to apply the affected ones.
         """
 
         state: ChatSessionState
@@ -241,17 +790,33 @@ class DeployTFConfigAction(base.AbstractAction):
                 self.chat_session_id, ChatSessionState.DEPLOYMENT_IN_PROGRESS
             )
 
-            # Apply the changes and capture the output
-            return_code, _, apply_stderr = self.tf_client.apply(
-                skip_plan=True, capture_output=True, raise_on_error=False
-            )
+            # Reject broken configs before any resources are created
+            result = self.precheck(targets)
+            if not result.ok:
+                print("Terraform precheck failed.")
+                raise PrecheckFailedException
+            self.check_cost(result)
+
+            # Apply exactly what was planned
+            if targets is not None:
+                print(f"Re-applying only the affected resources: {targets}")
+            return_code = self.apply_plan(result)
 
             if return_code != 0:
                 print("Terraform apply failed.")
-                print(apply_stderr)
-                self.diagnoser.logs_cache.append(apply_stderr)
                 raise DeploymentBrokenException
 
+            if targets is not None:
+                result = self.precheck()
+                if not result.ok:
+                    raise PrecheckFailedException
+                if has_changes(result.changes):
+                    self.check_cost(result)
+                    if self.apply_plan(result) != 0:
+                        raise DeploymentBrokenException
+                else:
+                    self.discard_plan(result)
+
             print(f"Config {self.user_config.name} deployment complete.")
             state = ChatSessionState.DEPLOYMENT_SUCCEEDED
             response = SUCCESS_RESPONSE
@@ -263,7 +828,6 @@ class DeployTFConfigAction(base.AbstractAction):
             self.state_manager.update_chat_session_state(self.chat_session_id, state)
 
         if state == ChatSessionState.DEPLOYMENT_FAILED:
-            self.destroy()
             response = ERROR_RESPONSE
 
         return str(response), state
@@ -277,11 +841,34 @@ class DeployTFConfigAction(base.AbstractAction):
 
         with open(BASE_PROMPT_PATH + USABILITY_AIDE, "r", encoding="utf8") as fp:
             sys_prompt = fp.read()
-            sys_prompt = sys_prompt.format(self.user_config.template)
+            sys_prompt = sys_prompt.format(compact(self.user_config.template).text)
             response = self.claude_client.query(sys_prompt, "", False, temperature=0.3)
 
             return response
 
+    def search_fix(self, use_cache: bool = True) -> Union[TerraformConfig, None]:
+        """
+        Generates several candidate fixes at once, validates and plans each in
+        its own scratch working dir in parallel, and returns the best ranked.
+        Returns None if no candidate passed its precheck, so none is applied.
+        """
+        candidates = self.diagnoser.fix_candidates(FIX_SEARCH_CANDIDATES, use_cache)
+        # The failed apply's state is only in the leased working dir until release
+        search = FixSearch(
+            self.working_dir,
+            str(self.chat_session_id),
+            self.tf_env,
+            self.workspace_pool,
+            self.state_backend,
+        )
+        best = search.rank(self.diagnoser.config.template, candidates)[0]
+        if not best.result.ok:
+            print("No candidate fix passed its precheck.")
+            return None
+
+        self.diagnoser.last_fix_cached = best.cached
+        return best.config
+
     def handle_failed_deployment(self, diagnosed_issue: DiagnoserState) -> str:
         """
         Handles a failed deployment with the Diagnoser class.
@@ -290,25 +877,49 @@ class DeployTFConfigAction(base.AbstractAction):
 
         def return_user_request() -> str:
             """
-            A small helper that requests deployment info from the user.
+            A small helper that requests deployment info from the user, and
+            tears down what the failed deployment left behind.
             """
             print("Deployment requires user info. Returning specific request message.")
             ret_msg = self.request_deployment_info()
+            ret_msg += self.abandon_recovery()
             self.diagnoser.logs_cache.clear()
             return ret_msg
 
         try:
-            for i in range(NUM_RETRIES):
-                new_stack = self.diagnoser.fix_broken_config(diagnosed_issue)
+            attempts, cached_attempts = 0, 0
+            while attempts < NUM_RETRIES:
+                use_cache = cached_attempts < MAX_CACHED_FIXES
+                if (
+                    FIX_SEARCH_CANDIDATES > 1
+                    and diagnosed_issue != DiagnoserState.DEPLOYABLE
+                    and len(self.diagnoser.logs_cache) > 0
+                ):
+                    new_stack = self.search_fix(use_cache)
+                    if new_stack is None:
+                        # The search already tried the cached fix, if there was one
+                        new_stack = self.diagnoser.fix_broken_config(
+                            diagnosed_issue, use_cache=False
+                        )
+                else:
+                    new_stack = self.diagnoser.fix_broken_config(
+                        diagnosed_issue, use_cache=use_cache
+                    )
+                from_cache = self.diagnoser.last_fix_cached
 
-                # write new_stack back to file
-                file_path = os.path.join(self.tf_file_dir, new_stack.name)
-                with open(f"{file_path}.tf", "w", encoding="utf8") as file:
-                    file.write(new_stack.template)
+                # write new_stack back to file, and to the working dir if it's separate
+                for directory in {self.tf_file_dir, self.working_dir}:
+                    file_path = os.path.join(directory, new_stack.name)
+                    with open(f"{file_path}.tf", "w", encoding="utf8") as file:
+                        file.write(new_stack.template)
 
-                _, state = self.deploy_config()
-                print(f"state after {i} deployment: {state}")
+                # Only what failed, or never got created, is applied again
+                _, state = self.deploy_config(self.affected_addresses())
+                print(f"state after {attempts} deployment: {state}")
 
+                self.diagnoser.record_fix_result(
+                    new_stack.template, state == ChatSessionState.DEPLOYMENT_SUCCEEDED
+                )
                 if state == ChatSessionState.DEPLOYMENT_SUCCEEDED:
                     self.diagnoser.logs_cache.clear()
                     self.user_config = new_stack
@@ -318,6 +929,11 @@ class DeployTFConfigAction(base.AbstractAction):
 
                     return self.return_success_msg()
 
+                if from_cache:
+                    cached_attempts += 1
+                else:
+                    attempts += 1
+
             ret_msg = return_user_request()
         except TFConfigRequiresUserInfoException:
             ret_msg = return_user_request()
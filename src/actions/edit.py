@@ -1,12 +1,24 @@
-from typing import Any
+from typing import Any, Dict, List
 from . import base
 import json
+import os
 
 from src.model.stack import TerraformConfig
+from src.model.patch import PatchFailedException, apply_patch, parse_operations
+from src.model.diff import diff_configs
+from src.model.compact import compact
+from src.actions.lint import new_lint_errors, format_lint_errors
 from include.utils import BASE_PROMPT_PATH, prompt_with_file
 
 EDIT_CONFIG_EXAMPLES = "edit_stack_examples.txt"
 DESCRIBE_EDIT_PROMPT = "describe_edit.txt"
+PATCH_EDIT_PROMPT = "patch_edit.txt"
+
+# "patch" asks for block level operations and applies them locally, "full"
+# regenerates the whole file. Patch edits fall back to full ones if they fail.
+PATCH_EDIT_MODE = "patch"
+FULL_EDIT_MODE = "full"
+EDIT_MODE = os.environ.get("EDIT_MODE", PATCH_EDIT_MODE)
 
 
 class EditTFConfigAction(base.AbstractAction):
@@ -14,10 +26,18 @@ class EditTFConfigAction(base.AbstractAction):
     An action to edit the provided config
     """
 
-    def __init__(self, config_to_edit: TerraformConfig) -> None:
+    def __init__(
+        self, config_to_edit: TerraformConfig, edit_mode: str = EDIT_MODE
+    ) -> None:
         super().__init__()
         self.config_to_edit = config_to_edit
+        self.edit_mode = edit_mode
         self.new_config = None
+        # Prompts carry the config compacted. Patches apply to the original
+        # file, so theirs is minified too. A full edit replaces the file, so
+        # its prompt keeps the file's comments and layout for it to copy.
+        self.compacted = compact(config_to_edit.template)
+        self.laid_out = compact(config_to_edit.template, minified=False)
 
     def get_structured_edit_prompt(self, query: str) -> str:
         """
@@ -44,6 +64,7 @@ class EditTFConfigAction(base.AbstractAction):
         Remember:
         - Only make changes explicitly requested by the user.
         - Do not add any comments or explanations to the Terraform file.
+        - Keep the file's existing comments and formatting as they are.
         - Ensure the output is a valid Terraform file that can be deployed without issues.
         - Do not include any text before or after the Terraform file content in your output.
         - If anything is marked with an 'xxxxxx', that means that specific information is missing and is needed for a complete terraform file.
@@ -54,7 +75,7 @@ class EditTFConfigAction(base.AbstractAction):
 
         Here is the actual terraform file to analyze:
         <terraform_file>
-        {self.config_to_edit}
+        {self.laid_out.text}
         </terraform_file>
 
         And here is the desired change in architecture:
@@ -65,23 +86,103 @@ class EditTFConfigAction(base.AbstractAction):
 
         return sysprompt
 
+    def determine_patch(self, user_input: str) -> List[Dict[str, Any]]:
+        """
+        Asks for the block level operations that make the user's change, rather
+        than the whole edited file, so the response only grows with the change.
+        """
+        addresses = "\n".join(self.config_to_edit.parsed.by_address)
+        prompt = f"""
+        <terraform_file>
+        {self.compacted.text}
+        </terraform_file>
+
+        <block_addresses>
+        {addresses}
+        </block_addresses>
+
+        <desired_change>
+        {user_input}
+        </desired_change>
+        """
+
+        response = prompt_with_file(
+            BASE_PROMPT_PATH + PATCH_EDIT_PROMPT,
+            prompt,
+            self.claude_client,
+            is_json=True,
+            temperature=0.2,
+        )
+
+        return parse_operations(response)
+
+    def patch_edit(self, user_input: str) -> TerraformConfig:
+        """
+        Edits the config by applying llm chosen operations to it locally.
+        """
+        operations = self.determine_patch(user_input)
+        print(f"Applying {len(operations)} patch operation(s): {operations}")
+        patched = apply_patch(self.config_to_edit.template, operations)
+
+        errors = new_lint_errors(self.config_to_edit.template, patched)
+        if len(errors) > 0:
+            raise PatchFailedException(
+                f"Patch introduced lint errors:\n{format_lint_errors(errors)}"
+            )
+
+        return TerraformConfig(patched, self.config_to_edit.name)
+
     def determine_edit(self, user_input: str, retries: int = 3) -> TerraformConfig:
         """
         Alter the config_to_edit with the provided user input, and return the new config.
+        In patch mode, the whole file is only regenerated if the patch fails.
+        """
+
+        if self.edit_mode == PATCH_EDIT_MODE:
+            try:
+                return self.patch_edit(user_input)
+            except Exception as e:
+                # e.g. a PatchFailedException, or a response that isn't json
+                print(f"Patch edit failed: {e}. Regenerating the whole config.")
+
+        return self.full_edit(user_input, retries)
+
+    def full_edit(
+        self, user_input: str, retries: int = 3, feedback: str = ""
+    ) -> TerraformConfig:
+        """
+        Asks for the entire edited file. If it has lint errors the original
+        didn't, it's asked for once more with those errors as feedback.
         """
 
         try:
             sys_prompt = self.get_structured_edit_prompt(user_input)
 
             new_config = self.claude_client.query(
-                user_input, sys_prompt, is_json=False, temperature=0.7
+                user_input + feedback, sys_prompt, is_json=False, temperature=0.7
             )
 
         except Exception as e:
+            if retries <= 0:
+                raise
             print(f"Couldn't parse due to {e}. Retrying...")
-            return self.determine_edit(user_input, retries - 1)
+            return self.full_edit(user_input, retries - 1, feedback)
+
+        edited = TerraformConfig(
+            self.laid_out.expand(new_config), self.config_to_edit.name
+        )
 
-        return TerraformConfig(new_config, self.config_to_edit.name)
+        errors = new_lint_errors(self.config_to_edit.template, edited.template)
+        if len(errors) > 0 and retries > 0 and not feedback:
+            formatted = format_lint_errors(errors)
+            print(f"Edited config has lint errors:\n{formatted}\nRetrying...")
+            feedback = (
+                "\n\nA previous attempt at this edit had these problems, "
+                f"avoid them:\n{formatted}"
+            )
+            return self.full_edit(user_input, retries - 1, feedback)
+
+        return edited
 
     def describe_changes(
         self, s1: TerraformConfig, s2: TerraformConfig, original_prompt: str
@@ -89,13 +190,15 @@ class EditTFConfigAction(base.AbstractAction):
         """
         An appropriate response to the user regarding the edit they've made.
         """
+        diff = diff_configs(s1.parsed, s2.parsed)
+        resources = ", ".join(s2.parsed.resource_addresses()) or "None"
         diff_prompt = f"""
-        Original infrastructure:
-        {s1.template}
-        
-        New infrastructure:
-        {s2.template}
-        
+        Resources in the new infrastructure:
+        {resources}
+
+        Changes to the infrastructure:
+        {diff.format()}
+
         User's edit request:
         {original_prompt}
         """
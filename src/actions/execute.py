@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Dict, List, Union
 import shutil
 from . import base
 import logging
@@ -7,20 +7,68 @@ import os
 from uuid import UUID
 from include.llm.base import AbstractLLMClient
 from include.utils import BASE_PROMPT_PATH, QUERY_CLASSIFIERS_BASE
+from src.actions.runner import (
+    AsyncCommandRunner,
+    CommandResult,
+    UnsafeCommandException,
+    get_default_runner,
+    split_command,
+)
+from src.actions.boto_engine import (
+    Boto3ExecutionEngine,
+    UnsupportedCommandException,
+    get_default_engine,
+)
+from src.actions.reduce import OutputReducer
+from src.actions.intent_cache import IntentTemplateCache, get_intent_cache
+from src.actions.plan import (
+    ExecutionPlan,
+    InvalidExecutionPlanException,
+    PlanStep,
+    MAX_FAN_OUT,
+    expand_command,
+)
 import uuid
+import asyncio
+import json
+import shlex
 from collections import OrderedDict
+from datetime import datetime, timezone
 import re
 
 DEFAULT = "default"
 
 # prompts
 EXECUTE_FPATH = "execute/"
-GENERATE_API_CALL = "generate_api_call.txt"
+GENERATE_EXECUTION_PLAN = "generate_execution_plan.txt"
 CLEAN_RESPONSE = "clean_response.txt"
 IS_POINT_EXEC = "is_point_exec.txt"
 
 AWS = "aws"
 AWS_PATH = "/root/.local/bin/aws"
+PROFILE_OPTION = "--profile"
+
+# Previous executions given as context when generating a plan
+HISTORY_LIMIT = 5
+HISTORY_OUTPUT_CHARS = 2000
+
+# execution backends
+CLI_BACKEND = "cli"
+BOTO3_BACKEND = "boto3"
+EXECUTION_BACKEND = os.environ.get("AWS_EXECUTION_BACKEND", BOTO3_BACKEND)
+
+FAN_OUT_TRUNCATED = (
+    "Only the first {limit} of {total} values were used, "
+    "{left_out} were left out, so these results are partial."
+)
+
+
+class SkippedStepException(Exception):
+    """
+    Represents a plan step that wasn't run because a step it depends on failed.
+    """
+
+    pass
 
 
 class AWSApiCall:
@@ -45,45 +93,71 @@ class AWSExecutor:
     An execution engine to run aws commands from user's request.
     """
 
-    def __init__(self, profile_name: str, llm: AbstractLLMClient) -> None:
+    def __init__(
+        self,
+        profile_name: str,
+        llm: AbstractLLMClient,
+        runner: Union[AsyncCommandRunner, None] = None,
+        backend: str = EXECUTION_BACKEND,
+        engine: Union[Boto3ExecutionEngine, None] = None,
+        output_reducer: Union[OutputReducer, None] = None,
+        intent_cache: Union[IntentTemplateCache, None] = None,
+        embedding_client: Union[AbstractLLMClient, None] = None,
+    ) -> None:
         self.profile_name = profile_name
         self.api_call = AWSApiCall({}, {})
         self.llm = llm
+        self.runner = runner if runner is not None else get_default_runner()
+        self.backend = backend
+        self.engine = engine
+        if self.backend == BOTO3_BACKEND and self.engine is None:
+            self.engine = get_default_engine()
+        self.output_reducer = (
+            output_reducer if output_reducer is not None else OutputReducer()
+        )
+        self.intent_cache = intent_cache
+        self.embedding_client = embedding_client
 
-    def generate_api_call(self, prompt: str) -> UUID:
+    def _previous_executions(self) -> str:
         """
-        Generates api call with claude and appends the specific
-        profile being used.
-
-        Can optionally be given error_msgs and the previous_api_call as additional
-        context for generating the api call.
+        Formats the commands executed so far, with their outputs, as prompt context.
         """
-        # 1. generate new uuid for this api call
-        new_call_uuid = self.api_call.generate_new_uuid()
-
-        # 2. generate the api cli command with claude.
-        api_call_prompt: str
         if len(self.api_call.cli_changelog) == 0:
-            with open(
-                BASE_PROMPT_PATH + EXECUTE_FPATH + GENERATE_API_CALL,
-                "r",
-                encoding="utf8",
-            ) as fp:
-                sys_prompt = fp.read()
-                api_call_prompt = sys_prompt.format(prompt)
-        else:
-            # If nonzero changelog, need previous execution data integrated.
-            pass
+            return "None"
 
-        cli_command = self.llm.query(api_call_prompt, "", False, temperature=0.3)
+        history = ""
+        recent = list(self.api_call.cli_changelog.items())[-HISTORY_LIMIT:]
+        for call_uuid, command in recent:
+            output = self.api_call.outputs.get(call_uuid, "")
+            history += f"Command: {command}\nOutput: {output[:HISTORY_OUTPUT_CHARS]}\n"
 
-        # 3. append the profile name arg to the command
-        cli_command += f" --profile {self.profile_name}"
+        return history
 
-        # 4. set the changelog to the new command
-        self.api_call.cli_changelog[new_call_uuid] = cli_command
+    def generate_execution_plan(self, prompt: str) -> ExecutionPlan:
+        """
+        Generates a plan of one or more api calls with claude. Calls that don't
+        depend on each other are executed in parallel.
+
+        Commands already in the changelog, and their outputs, are given to
+        claude as additional context for generating the plan.
+        """
+        with open(
+            BASE_PROMPT_PATH + EXECUTE_FPATH + GENERATE_EXECUTION_PLAN,
+            "r",
+            encoding="utf8",
+        ) as fp:
+            sys_prompt = fp.read()
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            plan_prompt = sys_prompt.format(prompt, now, self._previous_executions())
 
-        return new_call_uuid
+        response = self.llm.query(plan_prompt, "", False, temperature=0.3)
+
+        # Only the json object matters, in case claude wraps it in anything.
+        start, end = response.find("{"), response.rfind("}")
+        if start == -1 or end == -1:
+            raise InvalidExecutionPlanException(f"No plan in response: {response}")
+
+        return ExecutionPlan.from_json(response[start : end + 1])
 
     def find_aws_executable(self) -> str:
         """Find the AWS CLI executable in the system."""
@@ -102,28 +176,88 @@ class AWSExecutor:
             "AWS CLI executable not found. Make sure it's installed correctly."
         )
 
-    def execute_api_call(self, call_uuid: UUID) -> str:
+    def with_profile(self, argv: List[str]) -> List[str]:
         """
-        Executes an api call and gets the output
+        Pins the command to this executor's profile, dropping any other
+        --profile so a command can never run with someone else's credentials.
         """
+        pinned = []
+        skip_next = False
+        for arg in argv:
+            if skip_next:
+                skip_next = False
+            elif arg == PROFILE_OPTION:
+                skip_next = True
+            elif not arg.startswith(PROFILE_OPTION + "="):
+                pinned.append(arg)
+
+        return pinned + [PROFILE_OPTION, self.profile_name]
+
+    async def run_argv_async(self, argv: List[str]) -> CommandResult:
+        """
+        Runs a split aws cli command on the configured backend. The boto3 engine
+        runs in process with pooled clients, and anything it can't reproduce
+        falls back to spawning the cli.
+        """
+        if self.backend == BOTO3_BACKEND:
+            try:
+                return await self.runner.run_blocking(self.engine.execute, argv)
+            except UnsupportedCommandException as e:
+                logging.warning(f"Falling back to the aws cli: {e}")
 
-        # 1. get api call
-        api_call = self.api_call.cli_changelog[call_uuid]
+        return await self.runner.run([self.find_aws_executable()] + argv[1:])
 
-        # 2. trigger call
-        # api_call_splitted = shlex.split(api_call)
+    def run_argv(self, argv: List[str]) -> CommandResult:
+        """
+        Blocking wrapper around run_argv_async.
+        """
+        return self.runner.submit(self.run_argv_async(argv))
 
-        # executable = self.find_aws_executable()
-        # for i, portion in enumerate(api_call_splitted):
-        #     if portion == AWS:
-        #         # Use the full path to the AWS CLI executable
-        #         api_call_splitted[i] = executable
+    def _parse_api_call(self, api_call: str) -> List[str]:
+        """
+        Splits a generated command, refusing anything that isn't a plain aws cli call.
+        """
+        try:
+            argv = split_command(api_call)
+            if argv[0] != AWS:
+                raise UnsafeCommandException(f"Not an aws cli command: {api_call}")
+        except UnsafeCommandException:
+            logging.exception(f"Refusing to run generated command: {api_call}")
+            raise
+
+        return argv
+
+    def _check_result(self, api_call: str, result: CommandResult) -> str:
+        """
+        Returns the output of a finished call, raising a CalledProcessError if it failed.
+        """
+        if result.stdout_truncated:
+            logging.warning(f"Output of {api_call} was truncated.")
 
         try:
-            # output = subprocess.check_output(api_call_splitted, stderr=subprocess.STDOUT)
-            output = os.popen(api_call).read()
-        except subprocess.CalledProcessError as e:
-            logging.exception(f"AWS CLI command failed: {e.output.decode()}")
+            result.check_returncode()
+        except subprocess.CalledProcessError:
+            logging.exception(
+                f"AWS CLI command failed with code {result.returncode}: {result.stderr}"
+            )
+            raise
+
+        return result.stdout
+
+    async def _execute_argv(self, argv: List[str]) -> str:
+        """
+        Records a single call in the changelog, runs it, and records its output.
+        """
+        argv = self.with_profile(argv)
+        api_call = shlex.join(argv)
+
+        call_uuid = self.api_call.generate_new_uuid()
+        self.api_call.cli_changelog[call_uuid] = api_call
+
+        try:
+            result = await self.run_argv_async(argv)
+        except subprocess.TimeoutExpired:
+            logging.exception(f"AWS CLI command timed out: {api_call}")
             raise
         except FileNotFoundError:
             logging.exception(
@@ -131,22 +265,157 @@ class AWSExecutor:
             )
             raise
 
+        output = self._check_result(api_call, result)
+        self.api_call.outputs[call_uuid] = output
+
+        return output
+
+    def execute_api_call(self, call_uuid: UUID) -> str:
+        """
+        Executes an api call from the changelog and gets the output. Raises a
+        CalledProcessError if the command exits nonzero, and a TimeoutExpired if it hangs.
+        """
+
+        # 1. get api call
+        api_call = self.api_call.cli_changelog[call_uuid]
+
+        # 2. trigger call, without a shell
+        argv = self._parse_api_call(api_call)
+        try:
+            result = self.run_argv(argv)
+        except subprocess.TimeoutExpired:
+            logging.exception(f"AWS CLI command timed out: {api_call}")
+            raise
+
         # 3. get output
+        output = self._check_result(api_call, result)
+        self.api_call.outputs[call_uuid] = output
+
         return output
 
-    def execute(self, prompt: str) -> str:
+    async def _execute_step(
+        self, step: PlanStep, step_outputs: Dict[str, str], notes: Dict[str, str]
+    ) -> str:
+        """
+        Runs a single plan step. If the step fans out over a previous step's
+        output, read only steps run every command concurrently, others in order.
+        A fan out cut short at MAX_FAN_OUT is recorded in notes for the user.
+        """
+        argv = self._parse_api_call(step.command)
+        commands, truncated = expand_command(argv, step_outputs)
+        if truncated > 0:
+            notes[step.step_id] = FAN_OUT_TRUNCATED.format(
+                limit=MAX_FAN_OUT, total=MAX_FAN_OUT + truncated, left_out=truncated
+            )
+            logging.warning(f"Step {step.step_id}: {notes[step.step_id]}")
+
+        if step.is_read_only():
+            outputs = await asyncio.gather(
+                *(self._execute_argv(command) for command in commands)
+            )
+        else:
+            outputs = [await self._execute_argv(command) for command in commands]
+
+        if len(outputs) == 1:
+            return outputs[0]
+
+        try:
+            return json.dumps([json.loads(output) for output in outputs])
+        except json.JSONDecodeError:
+            return "\n".join(outputs)
+
+    async def execute_plan_async(
+        self, plan: ExecutionPlan, notes: Dict[str, str]
+    ) -> Dict[str, Union[str, Exception]]:
         """
-        Call the execution engine to generate output back to user.
+        Executes a plan layer by layer. Independent read only steps in a layer run
+        in parallel, steps that change state run one at a time. Steps depending on
+        a failed step are skipped. Returns every step's output, or its exception,
+        and fills notes with anything the user should know about a step's output.
         """
+        results: Dict[str, Union[str, Exception]] = {}
+        step_outputs: Dict[str, str] = {}
+
+        async def run(step: PlanStep):
+            try:
+                results[step.step_id] = await self._execute_step(
+                    step, step_outputs, notes
+                )
+                step_outputs[step.step_id] = results[step.step_id]
+            except Exception as e:
+                results[step.step_id] = e
+
+        for layer in plan.layers():
+            runnable = []
+            for step in layer:
+                failed = [dep for dep in step.depends_on if dep not in step_outputs]
+                if len(failed) > 0:
+                    results[step.step_id] = SkippedStepException(
+                        f"Skipped, depends on failed step(s) {', '.join(failed)}"
+                    )
+                else:
+                    runnable.append(step)
+
+            await asyncio.gather(
+                *(run(step) for step in runnable if step.is_read_only())
+            )
+            for step in runnable:
+                if not step.is_read_only():
+                    await run(step)
 
-        # 1. Given the prompt, generate the api call nessecary, perfectly formatted with claude.
-        api_call_uuid = self.generate_api_call(prompt)
+        return results
 
-        # 2. Execute the api call, and get response
-        output = self.execute_api_call(api_call_uuid)
-        self.api_call.outputs[api_call_uuid] = output
+    def execute(self, prompt: str, intent: Union[str, None] = None) -> str:
+        """
+        Call the execution engine to generate output back to user. intent is the
+        user's bare request, without chat memory, used to key the template cache.
+        """
+
+        # 1. Reuse a cached plan for the intent if there is one, else generate the plan
+        # of api calls nessecary, perfectly formatted with claude.
+        plan = None
+        if self.intent_cache is not None and intent is not None:
+            plan = self.intent_cache.lookup(
+                self.profile_name, intent, self.embedding_client
+            )
+        if plan is None:
+            plan = self.generate_execution_plan(prompt)
+
+        # 2. Execute the plan, and get every step's response
+        notes: Dict[str, str] = {}
+        results = self.runner.submit(self.execute_plan_async(plan, notes))
+
+        errors = [r for r in results.values() if isinstance(r, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+
+        if len(errors) == 0 and self.intent_cache is not None and intent is not None:
+            self.intent_cache.learn(
+                self.profile_name, intent, plan, self.embedding_client
+            )
+
+        # 3. spit responses back out, reduced so they all fit the token budget
+        step_budget = self.output_reducer.token_budget // len(plan.steps)
+        if len(plan.steps) == 1:
+            step_id = plan.steps[0].step_id
+            output = self.output_reducer.reduce(results[step_id], prompt, step_budget)
+            if step_id in notes:
+                output += f"\n\nNote: {notes[step_id]}"
+            return output
+
+        output = ""
+        for step in plan.steps:
+            result = results[step.step_id]
+            if isinstance(result, subprocess.CalledProcessError):
+                result = f"Failed: {result.stderr}"
+            elif isinstance(result, Exception):
+                result = f"Failed: {result}"
+            result = self.output_reducer.reduce(result, prompt, step_budget)
+            output += f"Command: {step.command}\nOutput:\n{result}\n"
+            if step.step_id in notes:
+                output += f"Note: {notes[step.step_id]}\n"
+            output += "\n"
 
-        # 3. spit response back out
         return output
 
 
@@ -160,13 +429,21 @@ class ExecutionAction(base.AbstractAction):
 
     def __init__(self, profile_name: str) -> None:
         super().__init__()
-        self.aws_executor = AWSExecutor(profile_name, self.claude_client)
+        self.aws_executor = AWSExecutor(
+            profile_name,
+            self.claude_client,
+            intent_cache=get_intent_cache(),
+            embedding_client=self.gpt_client,
+        )
 
     def clean_ex_response(self, response: str, original_query: str) -> str:
         """
         Provided with the response form a goex fn, responds with a
-        user friendly, cleaned up response.
+        user friendly, cleaned up response. The response is reduced to
+        the output token budget before it's put in the prompt.
         """
+        response = self.aws_executor.output_reducer.reduce(response, original_query)
+
         with open(
             BASE_PROMPT_PATH + EXECUTE_FPATH + CLEAN_RESPONSE, "r", encoding="utf8"
         ) as fp:
@@ -177,14 +454,15 @@ class ExecutionAction(base.AbstractAction):
                 cleaned_response_prompt, "", False, temperature=0.4
             )
 
-    def trigger_action(self, input: str) -> Any:
+    def trigger_action(self, input: str, intent: Union[str, None] = None) -> Any:
         """
         Entry point to trigger an execution. The input should be the query representing
-        the api call to make
+        the api call to make. intent can optionally be the user's bare request, without
+        any chat memory, which lets common requests reuse a cached plan.
         """
 
         # 1. call goex engine
-        response = self.aws_executor.execute(input)
+        response = self.aws_executor.execute(input, intent)
 
         # 2. cleanup response for user.
         cleaned_response = self.clean_ex_response(response, input)
@@ -0,0 +1,352 @@
+from typing import Any, Dict, List, Tuple, Union
+import threading
+import fcntl
+import json
+import os
+import re
+import time
+
+from src.actions.precheck import SUMMARY, DETAIL
+from src.actions.tf_logs import SIGNATURE, RESOURCE_TYPE, ADDRESSES
+from src.model.hcl import Block, get_parse_cache
+from src.model.patch import PatchFailedException, set_attribute, remove_attribute
+
+FIX_CACHE_PATH = "include/data/fix_rules.json"
+MAX_RULES = 1000
+# How many independent llm fixes must have agreed on a rule before it's applied
+MIN_RULE_SUCCESSES = 2
+
+# Rule keys
+SCOPE = "scope"
+EDITS = "edits"
+SUCCESSES = "successes"
+FAILURES = "failures"
+LAST_USED = "last_used"
+
+# Edit keys and ops
+OP = "op"
+KEY = "key"
+VALUE = "value"
+SET = "set"
+REMOVE = "remove"
+
+ADDRESS_REGEX = re.compile(r"^([A-Za-z][\w\-]*)\.([A-Za-z_][\w\-]*)(?:\[[^\]]*\])?$")
+
+# Values a rule may set: plain literals, without interpolation or references
+LITERAL_REGEX = re.compile(r'^(?:true|false|null|-?\d+(?:\.\d+)?|"[^"$%{}\\]*")$')
+# Literals that differ between accounts or regions, e.g. ids, arns and regions
+ACCOUNT_SPECIFIC_REGEX = re.compile(
+    r"arn:aws|\b\d{12}\b|\b[a-z]+-[0-9a-f]{8,17}\b|\b[a-z]{2}(?:-gov)?-[a-z]+-\d\b"
+)
+# Attributes that name or identify something, so their values are unique to
+# an account, or globally, e.g. bucket names
+IDENTIFIER_KEYS = frozenset(
+    ["name", "name_prefix", "bucket", "bucket_prefix", "identifier", "ami", "role"]
+)
+IDENTIFIER_KEY_SUFFIXES = ("_name", "_arn", "_arns", "_id", "_ids")
+
+
+def parse_address(address: str) -> Union[Tuple[str, str], None]:
+    """
+    The (type, name) of a root module resource address like aws_instance.web[0].
+    Returns None for data sources and resources in modules, which aren't
+    defined in the config itself.
+    """
+    match = ADDRESS_REGEX.match(address)
+    if match is None or match.group(1) in ("data", "module"):
+        return None
+
+    return match.group(1), match.group(2)
+
+
+def block_attributes(block: Block) -> Dict[str, str]:
+    """
+    The single line, top level attributes of a block, e.g. ami = "ami-123".
+    Nested blocks and multi line values aren't included.
+    """
+    return {
+        name: attribute.value
+        for name, attribute in block.attributes.items()
+        if not attribute.is_multiline()
+    }
+
+
+def fix_scope(user_id: Any, account: Union[str, None], region: str) -> str:
+    """
+    The scope rules are learned and applied in. Rules never cross users,
+    accounts or regions, since a fix that worked in one needn't in another.
+    """
+    return f"{user_id}/{account}/{region}"
+
+
+def is_portable(edit: Dict[str, str]) -> bool:
+    """
+    Whether an edit would mean the same thing in another config: removing an
+    attribute, or setting one that doesn't identify anything to a literal
+    that doesn't vary by account or region.
+    """
+    if edit[OP] == REMOVE:
+        return True
+
+    key = edit[KEY]
+    value = edit[VALUE].strip()
+    return (
+        key not in IDENTIFIER_KEYS
+        and not key.endswith(IDENTIFIER_KEY_SUFFIXES)
+        and LITERAL_REGEX.match(value) is not None
+        and ACCOUNT_SPECIFIC_REGEX.search(value) is None
+    )
+
+
+def fixing_edits(
+    error: Dict[str, Any], edits: List[Dict[str, str]]
+) -> List[Dict[str, str]]:
+    """
+    The edits that fixed an error: those to attributes the error mentions, or
+    the only edit if it mentions none. Other edits the fix made to the
+    resource are incidental, and aren't learned. Empty unless every fixing
+    edit is portable.
+    """
+    message = f"{error.get(SUMMARY) or ''} {error.get(DETAIL) or ''}".lower()
+    mentioned = [
+        edit
+        for edit in edits
+        if re.search(rf"\b{re.escape(edit[KEY].lower())}\b", message) is not None
+    ]
+    if len(mentioned) == 0 and len(edits) == 1:
+        mentioned = edits
+
+    if len(mentioned) == 0 or not all(is_portable(edit) for edit in mentioned):
+        return []
+
+    return mentioned
+
+
+def apply_edit(template: str, rtype: str, name: str, edit: Dict[str, str]) -> str:
+    """
+    Applies a set or remove edit to a top level attribute of a resource.
+    Returns the template unchanged if the resource, or the attribute to
+    remove, isn't in it.
+    """
+    address = f"{rtype}.{name}"
+    try:
+        if edit[OP] == REMOVE:
+            return remove_attribute(template, address, edit[KEY])
+        return set_attribute(template, address, edit[KEY], edit[VALUE])
+    except PatchFailedException:
+        return template
+
+
+def diff_resource(
+    old_template: str, new_template: str, rtype: str, name: str
+) -> List[Dict[str, str]]:
+    """
+    The attribute edits that turn a resource in old_template into the same
+    resource in new_template.
+    """
+    address = f"{rtype}.{name}"
+    old_block = get_parse_cache().parse(old_template).get(address)
+    new_block = get_parse_cache().parse(new_template).get(address)
+    if old_block is None or new_block is None:
+        return []
+
+    old = block_attributes(old_block)
+    new = block_attributes(new_block)
+
+    edits = [
+        {OP: SET, KEY: key, VALUE: value}
+        for key, value in new.items()
+        if old.get(key) != value
+    ]
+    edits.extend({OP: REMOVE, KEY: key} for key in old if key not in new)
+
+    return edits
+
+
+class FixCache:
+    """
+    A persistent index from error signatures to attribute edits that fixed
+    them before, e.g. the unsupported attribute an error was fixed by removing.
+
+    Rules are learned from llm fixes that led to a successful deployment,
+    by diffing the failing resources before and after the fix. Only portable
+    edits to the attributes an error names are learned, and rules are scoped
+    to one user, account and region (see fix_scope). A rule is only used once
+    MIN_RULE_SUCCESSES llm fixes agreed on it, and while it has succeeded
+    more often than it failed. The file is shared by every worker process,
+    so updates are read, modified and written under a file lock.
+    """
+
+    def __init__(self, path: str = FIX_CACHE_PATH, max_rules: int = MAX_RULES) -> None:
+        self.path = path
+        self.max_rules = max_rules
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Loads rules from disk, if there are any.
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as fp:
+                return json.load(fp)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Couldn't load fix cache from {self.path}: {e}")
+            return {}
+
+    def _update(self, fn):
+        """
+        Loads the rules, applies fn to them, and writes them back atomically,
+        holding a lock across processes.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock, open(f"{self.path}.lock", "w", encoding="utf8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            rules = self._load()
+            fn(rules)
+
+            if len(rules) > self.max_rules:
+                stale = sorted(rules, key=lambda k: rules[k][LAST_USED])
+                for key in stale[: len(rules) - self.max_rules]:
+                    del rules[key]
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf8") as fp:
+                json.dump(rules, fp)
+            os.replace(tmp_path, self.path)
+
+    def _usable(self, rule: Union[Dict[str, Any], None]) -> bool:
+        """
+        Whether a rule has been confirmed, and has a better track record than not.
+        """
+        return (
+            rule is not None
+            and rule[SUCCESSES] >= MIN_RULE_SUCCESSES
+            and rule[SUCCESSES] > rule[FAILURES]
+        )
+
+    def _key(self, scope: str, signature: str) -> str:
+        return f"{scope}|{signature}"
+
+    def lookup(
+        self, scope: Union[str, None], template: str, errors: List[Dict[str, Any]]
+    ) -> Union[str, None]:
+        """
+        Applies known fixes for every error to the template. Returns the fixed
+        template, or None unless every error has a usable rule in the scope
+        that changed something on a resource in the template.
+        """
+        if scope is None or len(errors) == 0:
+            return None
+
+        rules = self._load()
+        fixed = template
+        for error in errors:
+            rule = rules.get(self._key(scope, error[SIGNATURE]))
+            if not self._usable(rule) or len(error[ADDRESSES]) == 0:
+                return None
+
+            for address in error[ADDRESSES]:
+                parsed = parse_address(address)
+                if parsed is None:
+                    return None
+
+                before = fixed
+                for edit in rule[EDITS]:
+                    fixed = apply_edit(fixed, *parsed, edit)
+                if fixed == before:
+                    return None
+
+        print(f"Fixed {len(errors)} known error(s) from the fix cache")
+        return fixed
+
+    def learn(
+        self,
+        scope: Union[str, None],
+        old_template: str,
+        new_template: str,
+        errors: List[Dict[str, Any]],
+    ):
+        """
+        Records the portable edits a successful fix made to the attributes
+        each error was about.
+        """
+        if scope is None:
+            return
+
+        learned = {}
+        for error in errors:
+            edits = []
+            for address in error[ADDRESSES]:
+                parsed = parse_address(address)
+                if parsed is not None:
+                    edits = diff_resource(old_template, new_template, *parsed)
+                if len(edits) > 0:
+                    break
+
+            edits = fixing_edits(error, edits)
+            if len(edits) > 0:
+                learned[error[SIGNATURE]] = (error[RESOURCE_TYPE], edits)
+
+        if len(learned) == 0:
+            return
+
+        def update(rules: Dict[str, Dict[str, Any]]):
+            for signature, (rtype, edits) in learned.items():
+                key = self._key(scope, signature)
+                rule = rules.get(key)
+                if rule is None or rule[EDITS] != edits:
+                    rule = {
+                        SCOPE: scope,
+                        SIGNATURE: signature,
+                        RESOURCE_TYPE: rtype,
+                        EDITS: edits,
+                        SUCCESSES: 0,
+                        FAILURES: 0,
+                    }
+                rule[SUCCESSES] += 1
+                rule[LAST_USED] = time.time()
+                rules[key] = rule
+
+        self._update(update)
+
+    def record(
+        self, scope: Union[str, None], errors: List[Dict[str, Any]], succeeded: bool
+    ):
+        """
+        Records whether the cached fixes for these errors worked.
+        """
+        if scope is None:
+            return
+
+        def update(rules: Dict[str, Dict[str, Any]]):
+            for error in errors:
+                rule = rules.get(self._key(scope, error[SIGNATURE]))
+                if rule is None:
+                    continue
+                rule[SUCCESSES if succeeded else FAILURES] += 1
+                rule[LAST_USED] = time.time()
+
+        self._update(update)
+
+
+_default_cache: Union[FixCache, None] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_fix_cache() -> FixCache:
+    """
+    Returns the process wide fix cache.
+    """
+    global _default_cache
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = FixCache()
+
+    return _default_cache
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+import tempfile
+import difflib
+import shutil
+import os
+
+from src.model.stack import TerraformConfig
+from src.actions.precheck import (
+    PlanResult,
+    run_precheck,
+    normalize_diagnostic,
+    SUMMARY,
+)
+from src.actions.tf_stream import StreamingTerraform
+from src.actions.tf_backend import AbstractStateBackend, LocalStateBackend
+from src.actions.tf_workspace import (
+    TFWorkspacePool,
+    WorkspaceInitException,
+    seed_working_dir,
+    select_workspace,
+)
+
+# How many candidate fixes are generated and checked at once. 1 disables the search.
+FIX_SEARCH_CANDIDATES = int(os.environ.get("FIX_SEARCH_CANDIDATES", "3"))
+# Sampling temperatures for candidates, so they don't all come back the same
+FIX_TEMPERATURES = [0.2, 0.6, 0.9]
+
+SCRATCH_PLAN_FILE = "candidate.tfplan"
+
+
+class FixCandidate:
+    """
+    A candidate fixed config, whether it came from the fix cache, and how it
+    did when validated and planned.
+    """
+
+    def __init__(self, config: TerraformConfig, cached: bool) -> None:
+        self.config = config
+        self.cached = cached
+        self.result: Union[PlanResult, None] = None
+        self.diff_size = 0
+
+    def rank(self) -> Tuple[int, int, int, int, int]:
+        """
+        Lower is better. Candidates that plan cleanly come first, then those with
+        fewer errors and warnings, then those destroying or replacing less, then
+        the smallest edits.
+        """
+        result = self.result
+        if result is None:
+            return (1, 1 << 30, 0, 0, self.diff_size)
+
+        errors = len(result.errors())
+        warnings = len(result.diagnostics) - errors
+        changes = result.changes or {}
+        destructive = changes.get("remove", 0) + changes.get("change", 0)
+
+        return (0 if result.ok else 1, errors, warnings, destructive, self.diff_size)
+
+
+def diff_size(old: str, new: str) -> int:
+    """
+    The number of changed lines between two templates.
+    """
+    return sum(
+        1
+        for line in difflib.unified_diff(old.splitlines(), new.splitlines(), n=0)
+        if line.startswith(("+", "-")) and not line.startswith(("+++", "---"))
+    )
+
+
+class FixSearch:
+    """
+    Validates and plans candidate fixes concurrently, each in its own scratch
+    working dir seeded with the session's config and state, and ranks them.
+    Nothing is applied, so the only cost of a bad candidate is its plan.
+    """
+
+    def __init__(
+        self,
+        source_dir: str,
+        workspace: str,
+        env: Dict[str, str],
+        workspace_pool: Union[TFWorkspacePool, None] = None,
+        state_backend: Union[AbstractStateBackend, None] = None,
+    ) -> None:
+        """
+        source_dir is the dir terraform last ran in, whose config and local state
+        scratch dirs are seeded from. env holds the credentials candidates are
+        planned with. Candidates are planned against the session's state in
+        state_backend.
+        """
+        self.source_dir = source_dir
+        self.workspace = workspace
+        self.env = env
+        self.workspace_pool = workspace_pool
+        self.state_backend = (
+            state_backend if state_backend is not None else LocalStateBackend()
+        )
+
+    def _scratch_dir(self) -> str:
+        """
+        A working dir for one candidate, leased from the pool if there is one.
+        """
+        if self.workspace_pool is not None:
+            return self.workspace_pool.acquire()
+
+        return tempfile.mkdtemp(prefix="tf-fix-")
+
+    def _release(self, scratch: str):
+        """
+        Returns a scratch dir to the pool, or removes it.
+        """
+        if self.workspace_pool is not None:
+            self.workspace_pool.release(scratch)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def evaluate(self, candidate: FixCandidate) -> FixCandidate:
+        """
+        Validates and plans a candidate against the session's current state.
+        """
+        scratch = self._scratch_dir()
+        try:
+            seed_working_dir(self.source_dir, scratch)
+            config_path = os.path.join(scratch, f"{candidate.config.name}.tf")
+            with open(config_path, "w", encoding="utf8") as fp:
+                fp.write(candidate.config.template)
+
+            self.state_backend.configure(scratch)
+            backend_config = self.state_backend.backend_config()
+            tf = StreamingTerraform(working_dir=scratch, env=self.env)
+            if self.workspace_pool is not None:
+                self.workspace_pool.init(scratch, self.env, backend_config)
+            else:
+                return_code, _, stderr = tf.init(
+                    backend_config=backend_config, input=False
+                )
+                if return_code != 0:
+                    raise WorkspaceInitException(stderr)
+            select_workspace(tf, self.workspace)
+
+            # Candidates are only planned, so they don't contend for the state lock
+            candidate.result = run_precheck(
+                tf, os.path.join(scratch, SCRATCH_PLAN_FILE), lock=False
+            )
+            # The saved plan goes with the scratch dir
+            candidate.result.plan_path = None
+        except Exception as e:
+            print(f"Couldn't evaluate candidate fix: {e}")
+            candidate.result = PlanResult(
+                False, [normalize_diagnostic({SUMMARY: str(e)}, "fix_search")]
+            )
+        finally:
+            self._release(scratch)
+
+        return candidate
+
+    def rank(
+        self, original_template: str, candidates: List[FixCandidate]
+    ) -> List[FixCandidate]:
+        """
+        Evaluates every candidate in parallel, and returns them best first.
+        """
+        for candidate in candidates:
+            candidate.diff_size = diff_size(
+                original_template, candidate.config.template
+            )
+
+        with ThreadPoolExecutor(max_workers=max(len(candidates), 1)) as executor:
+            evaluated = list(executor.map(self.evaluate, candidates))
+
+        ranked = sorted(evaluated, key=lambda c: c.rank())
+        for candidate in ranked:
+            print(
+                f"Candidate fix (cached={candidate.cached}): ok={candidate.result.ok} "
+                f"rank={candidate.rank()}"
+            )
+
+        return ranked
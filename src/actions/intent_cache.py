@@ -0,0 +1,363 @@
+from typing import Any, Dict, List, Tuple, Union
+import threading
+import shlex
+import json
+import math
+import os
+import re
+import time
+
+from include.llm.base import AbstractLLMClient
+from src.actions.plan import ExecutionPlan, InvalidExecutionPlanException
+
+INTENT_CACHE_PATH = "include/data/intent_templates.json"
+
+SIMILARITY_THRESHOLD = 0.93
+MAX_ENTRIES = 500
+
+# Entry keys
+SCOPE = "scope"
+INTENT = "intent"
+SLOTS = "slots"
+PLAN = "plan"
+EMBEDDING = "embedding"
+HITS = "hits"
+LAST_USED = "last_used"
+
+# Entities lifted out of queries, most specific first. Each is replaced by a
+# typed slot, e.g. "instances in us-west-2" -> "instances in <region>".
+ENTITY_PATTERNS = [
+    ("arn", re.compile(r"arn:aws[a-z\-]*:[^\s'\"]+")),
+    (
+        "resource_id",
+        re.compile(
+            r"\b(?:i|vol|sg|subnet|vpc|ami|snap|eni|igw|rtb|nat|acl|lt|eipalloc)-[0-9a-f]{8,17}\b"
+        ),
+    ),
+    (
+        "region",
+        re.compile(
+            r"\b(?:us|eu|ap|sa|ca|me|af|il|mx)-(?:gov-)?(?:north|south|east|west|central|northeast|southeast|northwest|southwest)-\d\b"
+        ),
+    ),
+    ("quoted", re.compile(r"'([^']{3,})'|\"([^\"]{3,})\"")),
+]
+
+# Queries leaning on earlier chat turns can't be answered from a template.
+REFERENTIAL_WORDS = {
+    "same",
+    "that",
+    "those",
+    "them",
+    "it",
+    "its",
+    "again",
+    "previous",
+    "above",
+    "these",
+}
+
+# Timestamps in a plan tie it to when it was generated
+TIMESTAMP_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}")
+
+SLOT_FORMAT = "<<{}_{}>>"
+
+# Words of a query that could name something, e.g. a bucket or load balancer
+QUERY_WORD_REGEX = re.compile(r"[A-Za-z0-9][\w\-./:]{2,}")
+
+
+def normalize_intent(query: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Lowercases a query and replaces its entities with typed slots. Returns the
+    normalized intent, and the (kind, value) of every slot in order.
+    """
+    slots: List[Tuple[str, str]] = []
+    normalized = query.strip()
+
+    for kind, pattern in ENTITY_PATTERNS:
+
+        def replace(match: re.Match) -> str:
+            value = next((group for group in match.groups() if group), match.group(0))
+            slots.append((kind, value))
+            return f"<{kind}>"
+
+        normalized = pattern.sub(replace, normalized)
+
+    normalized = " ".join(re.findall(r"<[a-z_]+>|[a-z0-9]+", normalized.lower()))
+    return normalized, slots
+
+
+def slot_signature(slots: List[Tuple[str, str]]) -> List[str]:
+    """
+    The slot kinds of an intent, which a cached template must match exactly.
+    """
+    return sorted(kind for kind, _ in slots)
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """
+    Cosine similarity of two equal length vectors.
+    """
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm > 0 else 0.0
+
+
+class IntentTemplateCache:
+    """
+    Maps normalized execution intents to parameterized plans learned from
+    successful executions, so common requests skip plan generation.
+
+    A new query is normalized, then matched against cached intents, first
+    exactly and otherwise by embedding similarity above a threshold. The
+    template's slots are filled with the entities lifted from the new query.
+    Only read only plans without literal timestamps are learned, and only if
+    every value the query put into them is a slot.
+
+    Templates are scoped, e.g. to a user, and only match queries in their
+    scope, since a plan can hold names from the chat it was generated in.
+    """
+
+    def __init__(
+        self,
+        path: str = INTENT_CACHE_PATH,
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_ENTRIES,
+    ) -> None:
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Loads cached templates from disk, if there are any.
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as fp:
+                return json.load(fp)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Couldn't load intent cache from {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        """
+        Writes templates to disk atomically. Assumes the lock is held.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            json.dump(self._entries, fp)
+        os.replace(tmp_path, self.path)
+
+    def _embed(self, intent: str, llm: AbstractLLMClient) -> Union[List[float], None]:
+        """
+        Embeds an intent, or returns None if the embedding call failed.
+        """
+        embedding = llm.generate_embeddings(intent)
+        if not isinstance(embedding, list) or len(embedding) == 0:
+            print(f"Couldn't embed intent: {embedding}")
+            return None
+
+        return embedding
+
+    def is_cacheable(self, query: str) -> bool:
+        """
+        Queries referring back to earlier turns depend on context we don't key on.
+        """
+        words = set(re.findall(r"[a-z]+", query.lower()))
+        return len(words & REFERENTIAL_WORDS) == 0
+
+    def _key(self, scope: str, intent: str) -> str:
+        return f"{scope}|{intent}"
+
+    def lookup(
+        self, scope: str, query: str, llm: AbstractLLMClient
+    ) -> Union[ExecutionPlan, None]:
+        """
+        Returns a filled in plan for the query if a cached template in its
+        scope matches it confidently, else None.
+        """
+        if not self.is_cacheable(query):
+            return None
+
+        intent, slots = normalize_intent(query)
+        signature = slot_signature(slots)
+
+        with self._lock:
+            entry = self._entries.get(self._key(scope, intent))
+            candidates = [
+                e
+                for e in self._entries.values()
+                if e.get(SCOPE) == scope and e[SLOTS] == signature
+            ]
+
+        if entry is None:
+            if len(candidates) == 0:
+                return None
+
+            embedding = self._embed(intent, llm)
+            if embedding is None:
+                return None
+
+            best, best_score = None, self.threshold
+            for candidate in candidates:
+                score = cosine_similarity(embedding, candidate[EMBEDDING])
+                if score >= best_score:
+                    best, best_score = candidate, score
+
+            if best is None:
+                return None
+
+            print(f"Intent '{intent}' matched '{best[INTENT]}' ({best_score:.3f})")
+            entry = best
+
+        try:
+            plan = ExecutionPlan.from_json(self._fill(json.dumps(entry[PLAN]), slots))
+        except InvalidExecutionPlanException as e:
+            print(f"Cached template for '{entry[INTENT]}' is invalid: {e}")
+            return None
+
+        with self._lock:
+            entry[HITS] += 1
+            entry[LAST_USED] = time.time()
+
+        return plan
+
+    def has_unslotted_values(
+        self, query: str, plan: ExecutionPlan, slots: List[Tuple[str, str]]
+    ) -> bool:
+        """
+        Whether a word of the query that isn't a slot, e.g. an unquoted bucket
+        name, appears in the plan's arguments. The template would replay it
+        for any similar query.
+        """
+        slot_values = {value for _, value in slots}
+        words = {
+            word.strip(".:/")
+            for word in QUERY_WORD_REGEX.findall(query)
+            if word not in slot_values
+        }
+
+        for step in plan.steps:
+            try:
+                tokens = shlex.split(step.command)
+            except ValueError:
+                return True
+
+            # aws <service> <operation>, then options and their values
+            arguments = " ".join(t for t in tokens[3:] if not t.startswith("--"))
+            for word in words:
+                pattern = rf"(?<![\w\-]){re.escape(word)}(?![\w\-])"
+                if len(word) > 0 and re.search(pattern, arguments) is not None:
+                    return True
+
+        return False
+
+    def learn(
+        self, scope: str, query: str, plan: ExecutionPlan, llm: AbstractLLMClient
+    ):
+        """
+        Stores the plan that successfully answered a query as a template in
+        the query's scope.
+        """
+        if not self.is_cacheable(query) or not plan.is_read_only():
+            return
+
+        plan_str = json.dumps(plan.to_json())
+        if TIMESTAMP_REGEX.search(plan_str):
+            return
+
+        intent, slots = normalize_intent(query)
+        key = self._key(scope, intent)
+        with self._lock:
+            if key in self._entries:
+                return
+
+        if self.has_unslotted_values(query, plan, slots):
+            print(f"Not caching plan for '{intent}': it has values that aren't slots")
+            return
+
+        embedding = self._embed(intent, llm)
+        if embedding is None:
+            return
+
+        entry = {
+            SCOPE: scope,
+            INTENT: intent,
+            SLOTS: slot_signature(slots),
+            PLAN: json.loads(self._parameterize(plan_str, slots)),
+            EMBEDDING: embedding,
+            HITS: 0,
+            LAST_USED: time.time(),
+        }
+
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                # Evict the least recently used template
+                stale = min(self._entries, key=lambda k: self._entries[k][LAST_USED])
+                del self._entries[stale]
+
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Couldn't persist intent cache: {e}")
+
+    def _slot_names(self, slots: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Names each slot by its kind and position among slots of that kind, e.g.
+        the second region is <<region_1>>. Returns (name, value) pairs.
+        """
+        counts: Dict[str, int] = {}
+        names = []
+        for kind, value in slots:
+            index = counts.get(kind, 0)
+            counts[kind] = index + 1
+            names.append((SLOT_FORMAT.format(kind, index), value))
+
+        return names
+
+    def _parameterize(self, plan_str: str, slots: List[Tuple[str, str]]) -> str:
+        """
+        Replaces the query's entity values in a serialized plan with slot names.
+        Longer values go first so one value can't clobber part of another.
+        """
+        named = sorted(self._slot_names(slots), key=lambda s: len(s[1]), reverse=True)
+        for name, value in named:
+            value = json.dumps(value)[1:-1]
+            pattern = re.compile(rf"(?<![\w\-]){re.escape(value)}(?![\w\-])")
+            plan_str = pattern.sub(lambda _: name, plan_str)
+
+        return plan_str
+
+    def _fill(self, plan_str: str, slots: List[Tuple[str, str]]) -> str:
+        """
+        Fills slot names in a serialized template with the query's entity values.
+        """
+        for name, value in self._slot_names(slots):
+            plan_str = plan_str.replace(name, json.dumps(value)[1:-1])
+
+        return plan_str
+
+
+_default_caches: Dict[str, IntentTemplateCache] = {}
+_default_caches_lock = threading.Lock()
+
+
+def get_intent_cache(path: str = INTENT_CACHE_PATH) -> IntentTemplateCache:
+    """
+    Returns the process wide cache for a path, so templates are loaded once.
+    """
+    with _default_caches_lock:
+        if path not in _default_caches:
+            _default_caches[path] = IntentTemplateCache(path)
+
+        return _default_caches[path]
@@ -0,0 +1,344 @@
+from typing import Any, Dict, List, Set, Tuple, Union
+import difflib
+import re
+
+from src.model.hcl import (
+    Block,
+    ParsedConfig,
+    get_parse_cache,
+    BUILTIN_ROOTS,
+    NAMED_ROOTS,
+    RESOURCE,
+    DATA,
+)
+from src.model.patch import unresolved_references
+from src.actions.precheck import (
+    normalize_diagnostic,
+    format_diagnostic,
+    ERROR_SEVERITY,
+    SEVERITY,
+    SUMMARY,
+    DETAIL,
+    ADDRESS,
+    LINE,
+)
+from src.actions.provider_schema import (
+    ProviderSchemaIndex,
+    SOURCE as PROVIDER_SOURCE,
+    get_provider_schema,
+    RESOURCES,
+    DATA_SOURCES,
+    ATTRIBUTES,
+    BLOCKS,
+    REQUIRED_BLOCKS,
+    ATTRIBUTE_TYPES,
+    REQUIRED,
+    COMPUTED,
+)
+
+# Which check reported a diagnostic
+LINT = "lint"
+
+# Arguments and blocks terraform itself accepts in resources and data sources
+META_ARGUMENTS = frozenset(["count", "for_each", "provider", "depends_on"])
+META_BLOCKS = frozenset(["lifecycle", "provisioner", "connection"])
+DYNAMIC_BLOCK = "dynamic"
+
+UNDECLARED_SUMMARIES = {
+    "var": "Reference to undeclared input variable",
+    "local": "Reference to undeclared local value",
+    "module": "Reference to undeclared module",
+}
+
+# type.name.attribute or data.type.name.attribute, with an optional index
+ATTRIBUTE_REFERENCE_REGEX = re.compile(
+    r"(?<![\w.\-])(data\.)?([A-Za-z_][\w\-]*)\.([A-Za-z_][\w\-]*)"
+    r"(?:\[[^\]]*\])?\.([A-Za-z_][\w\-]*)"
+)
+
+
+def _line(template: str, offset: int) -> int:
+    return template.count("\n", 0, offset) + 1
+
+
+def _suggestion(name: str, options: List[str]) -> str:
+    matches = difflib.get_close_matches(name, options, n=1)
+    return f' Did you mean "{matches[0]}"?' if len(matches) > 0 else ""
+
+
+class Linter:
+    """
+    Checks a config against the provider schema index without running
+    terraform: resource and data source types exist, arguments and nested
+    blocks are known and configurable, required ones are set, and references
+    point at something that exists. Diagnostics are normalized like
+    terraform's, so they read the same as validate and plan ones.
+
+    Only types of indexed providers are checked, so a missing or partial
+    index produces no false positives, just fewer diagnostics.
+    """
+
+    def __init__(self, schema: Union[ProviderSchemaIndex, None] = None) -> None:
+        self.schema = schema if schema is not None else get_provider_schema()
+
+    def _diagnostic(
+        self,
+        template: str,
+        offset: int,
+        address: Union[str, None],
+        summary: str,
+        detail: str,
+    ) -> Dict[str, Any]:
+        diagnostic = normalize_diagnostic(
+            {SUMMARY: summary, DETAIL: detail, ADDRESS: address}, LINT
+        )
+        diagnostic[LINE] = _line(template, offset)
+        return diagnostic
+
+    def _check_block(
+        self,
+        template: str,
+        block: Block,
+        schema: Dict[str, Any],
+        address: str,
+        path: str,
+        diagnostics: List[Dict[str, Any]],
+    ):
+        """
+        Checks a block's arguments and nested blocks against its schema,
+        recursively. path is the nested block's position, e.g. ingress.
+        """
+        top_level = path == ""
+        attributes = schema[ATTRIBUTES]
+        blocks = schema[BLOCKS]
+        # Lists and sets of objects can be written as blocks, e.g. ingress { ... }
+        block_attributes = {
+            name
+            for name in schema.get(ATTRIBUTE_TYPES, {})
+            if attributes.get(name) != COMPUTED
+        }
+
+        for name, attribute in block.attributes.items():
+            if top_level and name in META_ARGUMENTS:
+                continue
+            flag = attributes.get(name)
+            if flag is None:
+                hint = (
+                    f' "{name}" is a block, written {name} {{ ... }}.'
+                    if name in blocks
+                    else _suggestion(name, list(attributes))
+                )
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        attribute.start,
+                        address,
+                        "Unsupported argument",
+                        f'An argument named "{path}{name}" is not expected here.{hint}',
+                    )
+                )
+            elif flag == COMPUTED:
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        attribute.start,
+                        address,
+                        "Value for unconfigurable attribute",
+                        f'Can\'t configure a value for "{path}{name}": '
+                        "its value is decided by the provider.",
+                    )
+                )
+
+        present = {nested.type for nested in block.blocks}
+        for nested in block.blocks:
+            if nested.type == DYNAMIC_BLOCK:
+                if len(nested.labels) == 1:
+                    present.add(nested.labels[0])
+                continue
+            if top_level and nested.type in META_BLOCKS:
+                continue
+            if nested.type in block_attributes:
+                continue
+
+            nested_schema = blocks.get(nested.type)
+            if nested_schema is None:
+                hint = (
+                    f' "{nested.type}" is an argument, written {nested.type} = ...'
+                    if nested.type in attributes
+                    else _suggestion(nested.type, list(blocks))
+                )
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        nested.start,
+                        address,
+                        "Unsupported block type",
+                        f'Blocks of type "{path}{nested.type}" are not expected '
+                        f"here.{hint}",
+                    )
+                )
+                continue
+
+            self._check_block(
+                template,
+                nested,
+                nested_schema,
+                address,
+                f"{path}{nested.type}.",
+                diagnostics,
+            )
+
+        for name, flag in attributes.items():
+            is_set = name in block.attributes or name in present
+            if flag == REQUIRED and not is_set:
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        block.start,
+                        address,
+                        "Missing required argument",
+                        f'The argument "{path}{name}" is required, but no '
+                        "definition was found.",
+                    )
+                )
+        for name in schema.get(REQUIRED_BLOCKS, []):
+            if name not in present:
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        block.start,
+                        address,
+                        "Insufficient blocks",
+                        f'At least 1 "{path}{name}" block is required.',
+                    )
+                )
+
+    def _check_references(
+        self, template: str, parsed: ParsedConfig, diagnostics: List[Dict[str, Any]]
+    ):
+        """
+        References must point at something declared in the config, and
+        resource and data source references at an attribute their type has.
+        """
+        dangling = unresolved_references(parsed)
+        reported: Set[Tuple[str, str]] = set()
+
+        for block in parsed.blocks:
+            missing = sorted(block.references & dangling)
+            for reference in missing:
+                root = reference.split(".")[0]
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        block.start,
+                        block.address,
+                        UNDECLARED_SUMMARIES.get(
+                            root, "Reference to undeclared resource"
+                        ),
+                        f'A reference to "{reference}" has been made, but it '
+                        "isn't declared in the config.",
+                    )
+                )
+
+            for match in ATTRIBUTE_REFERENCE_REGEX.finditer(
+                parsed.masked, block.body_start, block.body_end
+            ):
+                is_data, type_name, name, attribute = match.groups()
+                if not is_data and (
+                    type_name in BUILTIN_ROOTS or type_name in NAMED_ROOTS
+                ):
+                    continue
+
+                kind = DATA_SOURCES if is_data else RESOURCES
+                target = (
+                    f"{DATA}.{type_name}.{name}" if is_data else f"{type_name}.{name}"
+                )
+                schema = self.schema.schema(kind, type_name)
+                if (
+                    schema is None
+                    or parsed.get(target) is None
+                    or attribute == "id"
+                    or attribute in schema[ATTRIBUTES]
+                    or attribute in schema[BLOCKS]
+                    or (block.address, match.group(0)) in reported
+                ):
+                    continue
+
+                reported.add((block.address, match.group(0)))
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        match.start(),
+                        block.address,
+                        "Unsupported attribute",
+                        f'{target} has no attribute "{attribute}".'
+                        + _suggestion(attribute, list(schema[ATTRIBUTES])),
+                    )
+                )
+
+    def lint(self, template: str) -> List[Dict[str, Any]]:
+        """
+        All diagnostics for a config, in config order per check. Every one is
+        an error, since each would fail terraform validate or plan.
+        """
+        parsed = get_parse_cache().parse(template)
+        diagnostics: List[Dict[str, Any]] = []
+
+        for block in parsed.blocks:
+            if block.type not in (RESOURCE, DATA) or len(block.labels) != 2:
+                continue
+
+            type_name = block.labels[0]
+            kind = RESOURCES if block.type == RESOURCE else DATA_SOURCES
+            provider = self.schema.provider(type_name)
+            if provider is None:
+                continue
+
+            schema = provider[kind].get(type_name)
+            if schema is None:
+                noun = "resource" if block.type == RESOURCE else "data source"
+                diagnostics.append(
+                    self._diagnostic(
+                        template,
+                        block.start,
+                        block.address,
+                        f"Invalid {noun} type",
+                        f"The provider {provider[PROVIDER_SOURCE]} does"
+                        f" not support "
+                        f'{noun} type "{type_name}".'
+                        + _suggestion(type_name, list(provider[kind])),
+                    )
+                )
+                continue
+
+            self._check_block(template, block, schema, block.address, "", diagnostics)
+
+        self._check_references(template, parsed, diagnostics)
+        return diagnostics
+
+
+def lint_errors(template: str) -> List[Dict[str, Any]]:
+    """
+    The error diagnostics for a config from the process wide linter.
+    """
+    return [d for d in Linter().lint(template) if d[SEVERITY] == ERROR_SEVERITY]
+
+
+def new_lint_errors(original: str, changed: str) -> List[Dict[str, Any]]:
+    """
+    The lint errors in changed that original didn't have, so a change is only
+    held to account for problems it introduced.
+    """
+
+    def key(diagnostic: Dict[str, Any]) -> Tuple[str, str, str]:
+        return diagnostic[SUMMARY], diagnostic[DETAIL], diagnostic[ADDRESS]
+
+    before = {key(d) for d in lint_errors(original)}
+    return [d for d in lint_errors(changed) if key(d) not in before]
+
+
+def format_lint_errors(diagnostics: List[Dict[str, Any]]) -> str:
+    """
+    Lint diagnostics one per line, for logs and llm feedback.
+    """
+    return "\n".join(format_diagnostic(d) for d in diagnostics)
@@ -0,0 +1,274 @@
+from typing import Any, Dict, List, Tuple, Union
+import json
+import re
+
+# Plan json keys
+STEPS = "steps"
+STEP_ID = "id"
+COMMAND = "command"
+DEPENDS_ON = "depends_on"
+
+# A reference to a previous step's output, e.g. {{list_instances}}
+PLACEHOLDER_REGEX = re.compile(r"\{\{\s*([A-Za-z0-9_\-]+)\s*\}\}")
+
+# Operations that only read state, so they can safely run concurrently.
+READ_ONLY_PREFIXES = (
+    "describe-",
+    "list-",
+    "get-",
+    "lookup-",
+    "search-",
+    "head-",
+    "batch-get-",
+    "query",
+    "scan",
+    "filter-log-events",
+)
+
+MAX_PLAN_STEPS = 10
+MAX_FAN_OUT = 20
+
+
+class InvalidExecutionPlanException(Exception):
+    """
+    Represents a generated plan that can't be executed, e.g. with unknown
+    or cyclic dependencies.
+    """
+
+    pass
+
+
+def is_read_only(command: str) -> bool:
+    """
+    Returns true if the aws cli command only reads state. Expects commands in
+    the form `aws <service> <operation> ...`.
+    """
+    parts = command.split()
+    if len(parts) < 3:
+        return False
+
+    return parts[2].startswith(READ_ONLY_PREFIXES)
+
+
+class PlanStep:
+    """
+    A single aws cli command in an execution plan, and the steps it depends on.
+    """
+
+    def __init__(self, step_id: str, command: str, depends_on: List[str]) -> None:
+        self.step_id = step_id
+        self.command = command
+        self.depends_on = depends_on
+
+    def references(self) -> List[str]:
+        """
+        The step ids whose output this step's command refers to.
+        """
+        return PLACEHOLDER_REGEX.findall(self.command)
+
+    def is_read_only(self) -> bool:
+        """
+        Whether this step only reads state.
+        """
+        return is_read_only(self.command)
+
+
+class ExecutionPlan:
+    """
+    An ordered set of aws cli commands with declared dependencies. A step may
+    refer to the output of a step it depends on with {{step_id}}.
+    """
+
+    def __init__(self, steps: List[PlanStep]) -> None:
+        self.steps = steps
+        self.validate()
+
+    @classmethod
+    def from_json(cls, plan: Union[str, Dict[str, Any]]) -> "ExecutionPlan":
+        """
+        Builds a plan from the llm's json output, e.g.
+
+        ```json
+        {
+            "steps": [
+                {"id": "east", "command": "aws s3api list-buckets --region us-east-1", "depends_on": []},
+                {"id": "west", "command": "aws s3api list-buckets --region us-west-2", "depends_on": []}
+            ]
+        }
+        ```
+        """
+        if isinstance(plan, str):
+            try:
+                plan = json.loads(plan)
+            except json.JSONDecodeError as e:
+                raise InvalidExecutionPlanException(f"Plan isn't valid json: {e}")
+
+        try:
+            steps = [
+                PlanStep(
+                    str(step[STEP_ID]),
+                    str(step[COMMAND]).strip(),
+                    [str(dep) for dep in step.get(DEPENDS_ON, [])],
+                )
+                for step in plan[STEPS]
+            ]
+        except (KeyError, TypeError) as e:
+            raise InvalidExecutionPlanException(f"Malformed plan: {e}")
+
+        return cls(steps)
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        The inverse of from_json.
+        """
+        return {
+            STEPS: [
+                {
+                    STEP_ID: step.step_id,
+                    COMMAND: step.command,
+                    DEPENDS_ON: step.depends_on,
+                }
+                for step in self.steps
+            ]
+        }
+
+    def is_read_only(self) -> bool:
+        """
+        Whether every step in the plan only reads state.
+        """
+        return all(step.is_read_only() for step in self.steps)
+
+    def validate(self):
+        """
+        Checks ids are unique, dependencies exist, placeholders only refer to
+        dependencies, and that there are no cycles.
+        """
+        if len(self.steps) == 0:
+            raise InvalidExecutionPlanException("Plan has no steps")
+        if len(self.steps) > MAX_PLAN_STEPS:
+            raise InvalidExecutionPlanException(
+                f"Plan has {len(self.steps)} steps, the limit is {MAX_PLAN_STEPS}"
+            )
+
+        ids = [step.step_id for step in self.steps]
+        if len(set(ids)) != len(ids):
+            raise InvalidExecutionPlanException("Plan has duplicate step ids")
+
+        for step in self.steps:
+            for dep in step.depends_on:
+                if dep not in ids:
+                    raise InvalidExecutionPlanException(
+                        f"Step {step.step_id} depends on unknown step {dep}"
+                    )
+            for ref in step.references():
+                if ref not in step.depends_on:
+                    raise InvalidExecutionPlanException(
+                        f"Step {step.step_id} uses output of {ref} without depending on it"
+                    )
+
+        self.layers()
+
+    def layers(self) -> List[List[PlanStep]]:
+        """
+        Groups steps into layers, where every step only depends on steps in
+        earlier layers. Steps within a layer are independent of each other.
+        """
+        remaining = {step.step_id: step for step in self.steps}
+        done = set()
+        layers = []
+
+        while len(remaining) > 0:
+            layer = [
+                step
+                for step in remaining.values()
+                if all(dep in done for dep in step.depends_on)
+            ]
+            if len(layer) == 0:
+                raise InvalidExecutionPlanException("Plan has cyclic dependencies")
+
+            for step in layer:
+                del remaining[step.step_id]
+                done.add(step.step_id)
+            layers.append(layer)
+
+        return layers
+
+
+def output_values(output: str) -> List[str]:
+    """
+    Breaks a step's output into the values a dependent step can use. JSON
+    lists are flattened, anything else is split on whitespace like xargs.
+    """
+    try:
+        parsed = json.loads(output)
+    except json.JSONDecodeError:
+        return output.split()
+
+    values = []
+
+    def flatten(obj: Any):
+        if isinstance(obj, list):
+            for item in obj:
+                flatten(item)
+        elif isinstance(obj, dict):
+            values.append(json.dumps(obj))
+        elif obj is not None:
+            values.append(str(obj))
+
+    flatten(parsed)
+    return values
+
+
+def expand_command(
+    argv: List[str], outputs: Dict[str, str]
+) -> Tuple[List[List[str]], int]:
+    """
+    Substitutes {{step_id}} placeholders in a split command with the outputs of
+    earlier steps. A placeholder making up a whole argument expands into one
+    argument per value, e.g. --instance-ids {{ids}}. A placeholder embedded in a
+    larger argument fans the command out, once per value, e.g.
+    --dimensions Name=InstanceId,Value={{ids}}. Fan out stops at MAX_FAN_OUT
+    values. Returns the commands to run, none if a placeholder has no values,
+    and how many values were left out of the fan out.
+    """
+    commands = [[]]
+    fanned_out = False
+    truncated = 0
+
+    for arg in argv:
+        match = PLACEHOLDER_REGEX.fullmatch(arg)
+        if match:
+            values = output_values(outputs[match.group(1)])
+            if len(values) == 0:
+                return [], 0
+
+            for command in commands:
+                command.extend(values)
+            continue
+
+        refs = PLACEHOLDER_REGEX.findall(arg)
+        if len(refs) == 0:
+            for command in commands:
+                command.append(arg)
+            continue
+
+        if fanned_out or len(set(refs)) > 1:
+            raise InvalidExecutionPlanException(
+                f"Only one embedded placeholder is supported per command: {argv}"
+            )
+
+        values = output_values(outputs[refs[0]])
+        if len(values) == 0:
+            return [], 0
+
+        truncated = max(len(values) - MAX_FAN_OUT, 0)
+        values = values[:MAX_FAN_OUT]
+
+        fanned_out = True
+        commands = [
+            command + [PLACEHOLDER_REGEX.sub(lambda _: value, arg)]
+            for command in commands
+            for value in values
+        ]
+
+    return commands, truncated
@@ -0,0 +1,254 @@
+from typing import Any, Dict, List, Tuple, Union
+from collections import OrderedDict
+import threading
+import json
+import os
+
+from python_terraform import Terraform, IsFlagged
+
+PLAN_CACHE_SIZE = 64
+PLANS_DIR = "plans"
+PLAN_SUFFIX = ".tfplan"
+
+# Normalized diagnostic keys
+SEVERITY = "severity"
+SUMMARY = "summary"
+DETAIL = "detail"
+ADDRESS = "address"
+FILENAME = "filename"
+LINE = "line"
+SOURCE = "source"
+
+# Which command reported a diagnostic
+VALIDATE = "validate"
+PLAN = "plan"
+
+ERROR_SEVERITY = "error"
+
+# plan -json message types we care about
+DIAGNOSTIC_MESSAGE = "diagnostic"
+CHANGE_SUMMARY_MESSAGE = "change_summary"
+
+
+def normalize_diagnostic(diagnostic: Dict[str, Any], source: str) -> Dict[str, Any]:
+    """
+    Flattens a terraform json diagnostic into the fields the diagnoser uses.
+    """
+    range_ = diagnostic.get("range") or {}
+    return {
+        SEVERITY: diagnostic.get(SEVERITY, ERROR_SEVERITY),
+        SUMMARY: diagnostic.get(SUMMARY, ""),
+        DETAIL: diagnostic.get(DETAIL, ""),
+        ADDRESS: diagnostic.get(ADDRESS),
+        FILENAME: range_.get(FILENAME),
+        LINE: (range_.get("start") or {}).get(LINE),
+        SOURCE: source,
+    }
+
+
+def parse_validate_output(stdout: str) -> Tuple[bool, List[Dict[str, Any]]]:
+    """
+    Parses the output of `terraform validate -json`. Returns whether the config
+    is valid, and its diagnostics.
+    """
+    try:
+        result = json.loads(stdout)
+    except json.JSONDecodeError:
+        return False, [
+            normalize_diagnostic(
+                {SUMMARY: "Couldn't parse validate output", DETAIL: stdout}, VALIDATE
+            )
+        ]
+
+    diagnostics = [
+        normalize_diagnostic(diagnostic, VALIDATE)
+        for diagnostic in result.get("diagnostics", [])
+    ]
+    return bool(result.get("valid", False)), diagnostics
+
+
+def parse_plan_output(
+    stdout: str,
+) -> Tuple[List[Dict[str, Any]], Union[Dict[str, int], None]]:
+    """
+    Parses the json lines streamed by `terraform plan -json`. Returns the plan's
+    diagnostics, and its change summary if it got that far.
+    """
+    diagnostics = []
+    changes = None
+
+    for line in stdout.splitlines():
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+        if message.get("type") == DIAGNOSTIC_MESSAGE:
+            diagnostics.append(normalize_diagnostic(message[DIAGNOSTIC_MESSAGE], PLAN))
+        elif message.get("type") == CHANGE_SUMMARY_MESSAGE:
+            changes = message.get("changes")
+
+    return diagnostics, changes
+
+
+def format_diagnostic(diagnostic: Dict[str, Any]) -> str:
+    """
+    A diagnostic as a single json line, as stored in the diagnoser's logs cache.
+    """
+    return json.dumps({k: v for k, v in diagnostic.items() if v not in (None, "")})
+
+
+class PlanResult:
+    """
+    The outcome of validating and planning one template. plan_path is the
+    saved plan to apply, if planning succeeded.
+    """
+
+    def __init__(
+        self,
+        ok: bool,
+        diagnostics: List[Dict[str, Any]],
+        plan_path: Union[str, None] = None,
+        changes: Union[Dict[str, int], None] = None,
+    ) -> None:
+        self.ok = ok
+        self.diagnostics = diagnostics
+        self.plan_path = plan_path
+        self.changes = changes
+
+    def errors(self) -> List[Dict[str, Any]]:
+        """
+        The diagnostics that failed the precheck.
+        """
+        return [d for d in self.diagnostics if d[SEVERITY] == ERROR_SEVERITY]
+
+
+class PlanCache:
+    """
+    An LRU of precheck results keyed by template hash, so a template that's
+    already been rejected is rejected again without running terraform, and a
+    saved plan isn't recomputed before it's applied.
+    """
+
+    def __init__(self, max_entries: int = PLAN_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[PlanResult, None]:
+        """
+        Returns the cached result for a key. Saved plans that have since been
+        deleted or applied are treated as misses.
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                return None
+
+            if result.plan_path is not None and not os.path.exists(result.plan_path):
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: str, result: PlanResult):
+        """
+        Caches a result, evicting the least recently used one if full.
+        """
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, key: str):
+        """
+        Drops a result, e.g. once its saved plan has been applied.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def parse_state_resources(stdout: str) -> Dict[str, bool]:
+    """
+    Parses the output of `terraform show -json` on a state. Returns every
+    resource address in it, and whether that resource is tainted, e.g. by a
+    failed create.
+    """
+    try:
+        state = json.loads(stdout)
+    except json.JSONDecodeError:
+        return {}
+
+    resources = {}
+    modules = [(state.get("values") or {}).get("root_module") or {}]
+    while len(modules) > 0:
+        module = modules.pop()
+        for resource in module.get("resources", []):
+            resources[resource["address"]] = bool(resource.get("tainted", False))
+        modules.extend(module.get("child_modules", []))
+
+    return resources
+
+
+def has_changes(changes: Union[Dict[str, int], None]) -> bool:
+    """
+    Whether a plan's change summary adds, changes, or removes anything.
+    Unknown summaries are assumed to have changes.
+    """
+    if changes is None:
+        return True
+
+    return any(changes.get(kind, 0) > 0 for kind in ("add", "change", "remove"))
+
+
+def run_precheck(
+    tf: Terraform,
+    plan_path: str,
+    targets: Union[List[str], None] = None,
+    lock: bool = True,
+) -> PlanResult:
+    """
+    Runs `terraform validate`, then a saved `terraform plan`, limited to targets
+    and their dependencies if given. Neither touches cloud resources, so a
+    broken config is rejected in seconds. Plans that are never applied can
+    skip the state lock.
+    """
+    _, stdout, stderr = tf.cmd("validate", json=IsFlagged, no_color=IsFlagged)
+    valid, diagnostics = parse_validate_output(stdout or stderr)
+    if not valid:
+        return PlanResult(False, diagnostics)
+
+    os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+
+    # detailed exit codes: 0 no changes, 1 error, 2 changes present
+    return_code, stdout, stderr = tf.plan(
+        out=plan_path,
+        json=IsFlagged,
+        input=False,
+        detailed_exitcode=IsFlagged,
+        target=targets or [],
+        lock=lock,
+    )
+    plan_diagnostics, changes = parse_plan_output(stdout)
+    diagnostics.extend(plan_diagnostics)
+
+    if return_code not in (0, 2):
+        if len(plan_diagnostics) == 0:
+            diagnostics.append(
+                normalize_diagnostic({SUMMARY: "Plan failed", DETAIL: stderr}, PLAN)
+            )
+        return PlanResult(False, diagnostics)
+
+    return PlanResult(True, diagnostics, plan_path, changes)
+
+
+_default_cache = PlanCache()
+
+
+def get_plan_cache() -> PlanCache:
+    """
+    Returns the process wide plan cache.
+    """
+    return _default_cache
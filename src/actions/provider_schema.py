@@ -0,0 +1,223 @@
+from typing import Any, Dict, Union
+import threading
+import gzip
+import json
+import sys
+import os
+
+from python_terraform import IsFlagged, Terraform
+
+PROVIDER_SCHEMA_PATH = os.environ.get(
+    "PROVIDER_SCHEMA_PATH", "include/data/provider_schema.json.gz"
+)
+
+FORMAT_VERSION = 2
+
+# Index keys
+PROVIDERS = "providers"
+SOURCE = "source"
+RESOURCES = "resources"
+DATA_SOURCES = "data_sources"
+# Per block: attributes by name, nested block schemas by type, the nested
+# block types that must appear at least once, and the types of attributes
+# that can also be written as blocks
+ATTRIBUTES = "a"
+BLOCKS = "b"
+REQUIRED_BLOCKS = "rb"
+ATTRIBUTE_TYPES = "t"
+
+# Attribute flags
+REQUIRED = "r"
+OPTIONAL = "o"
+COMPUTED = "c"
+
+
+class ProviderSchemaException(Exception):
+    """
+    Represents a provider schema that can't be generated.
+    """
+
+    pass
+
+
+def is_object_collection(attribute_type: Any) -> bool:
+    """
+    Whether an attribute type is a list or set of objects, e.g. ingress on
+    aws_security_group. Terraform also accepts those written as blocks.
+    """
+    return (
+        isinstance(attribute_type, list)
+        and len(attribute_type) == 2
+        and attribute_type[0] in ("list", "set")
+        and isinstance(attribute_type[1], list)
+        and len(attribute_type[1]) > 0
+        and attribute_type[1][0] == "object"
+    )
+
+
+def compact_block(block: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Keeps only what linting needs from a terraform block schema: each
+    attribute's flag, the type of attributes that can be written as blocks,
+    and nested blocks, recursively.
+    """
+    attributes, attribute_types = {}, {}
+    for name, attribute in (block.get("attributes") or {}).items():
+        if attribute.get("required"):
+            attributes[name] = REQUIRED
+        elif attribute.get("optional"):
+            attributes[name] = OPTIONAL
+        else:
+            attributes[name] = COMPUTED
+
+        if is_object_collection(attribute.get("type")):
+            attribute_types[name] = attribute["type"]
+
+    blocks, required_blocks = {}, []
+    for name, block_type in (block.get("block_types") or {}).items():
+        blocks[name] = compact_block(block_type.get("block") or {})
+        if (block_type.get("min_items") or 0) > 0:
+            required_blocks.append(name)
+
+    compacted = {ATTRIBUTES: attributes, BLOCKS: blocks}
+    if len(required_blocks) > 0:
+        compacted[REQUIRED_BLOCKS] = required_blocks
+    if len(attribute_types) > 0:
+        compacted[ATTRIBUTE_TYPES] = attribute_types
+
+    return compacted
+
+
+def compact_schemas(schemas: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compacts the output of `terraform providers schema -json` into an index
+    keyed by provider name, e.g. aws for registry.terraform.io/hashicorp/aws,
+    which is also the prefix of its resource types.
+    """
+    providers = {}
+    for source, schema in (schemas.get("provider_schemas") or {}).items():
+        providers[source.split("/")[-1]] = {
+            SOURCE: source,
+            RESOURCES: {
+                name: compact_block(resource.get("block") or {})
+                for name, resource in (schema.get("resource_schemas") or {}).items()
+            },
+            DATA_SOURCES: {
+                name: compact_block(data.get("block") or {})
+                for name, data in (schema.get("data_source_schemas") or {}).items()
+            },
+        }
+
+    return {"format_version": FORMAT_VERSION, PROVIDERS: providers}
+
+
+def generate(working_dir: str, path: str = PROVIDER_SCHEMA_PATH) -> Dict[str, Any]:
+    """
+    Generates the index from the providers installed in an initialized
+    working dir, e.g. a warmed workspace pool dir, and writes it gzipped.
+    """
+    tf = Terraform(working_dir=working_dir)
+    return_code, stdout, stderr = tf.cmd("providers schema", json=IsFlagged)
+    if return_code != 0:
+        raise ProviderSchemaException(stderr)
+
+    index = compact_schemas(json.loads(stdout))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf8") as fp:
+        json.dump(index, fp, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+    return index
+
+
+class ProviderSchemaIndex:
+    """
+    The resource and data source schemas of the indexed providers. Types of
+    providers that aren't indexed are unknown, rather than invalid.
+    """
+
+    def __init__(self, index: Dict[str, Any]) -> None:
+        self.providers: Dict[str, Dict[str, Any]] = index.get(PROVIDERS, {})
+
+    @classmethod
+    def load(cls, path: str = PROVIDER_SCHEMA_PATH) -> "ProviderSchemaIndex":
+        """
+        Loads the index, or an empty one if it hasn't been generated.
+        """
+        if not os.path.exists(path):
+            print(f"No provider schema index at {path}. Linting is disabled.")
+            return cls({})
+
+        try:
+            with gzip.open(path, "rt", encoding="utf8") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError) as e:
+            print(f"Couldn't load provider schema index from {path}: {e}")
+            return cls({})
+
+        if index.get("format_version") != FORMAT_VERSION:
+            print(
+                f"Provider schema index at {path} is out of date. Regenerate it"
+                " to enable linting."
+            )
+            return cls({})
+
+        return cls(index)
+
+    def __len__(self) -> int:
+        return len(self.providers)
+
+    def provider(self, type_name: str) -> Union[Dict[str, Any], None]:
+        """
+        The indexed provider a resource or data source type belongs to, by
+        its prefix, e.g. aws for aws_instance.
+        """
+        return self.providers.get(type_name.split("_")[0])
+
+    def schema(self, kind: str, type_name: str) -> Union[Dict[str, Any], None]:
+        """
+        The block schema of a type of kind RESOURCES or DATA_SOURCES, or None
+        if its provider is indexed but has no such type.
+        """
+        provider = self.provider(type_name)
+        if provider is None:
+            return None
+
+        return provider[kind].get(type_name)
+
+
+_default_index: Union[ProviderSchemaIndex, None] = None
+_default_index_lock = threading.Lock()
+
+
+def get_provider_schema() -> ProviderSchemaIndex:
+    """
+    Returns the process wide provider schema index, loading it once.
+    """
+    global _default_index
+
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = ProviderSchemaIndex.load()
+
+    return _default_index
+
+
+if __name__ == "__main__":
+    # Generates the index offline, from an initialized working dir if one is
+    # given, else from a warmed workspace pool dir
+    from src.actions.tf_workspace import get_default_pool
+
+    if len(sys.argv) > 1:
+        generate(sys.argv[1])
+    else:
+        pool = get_default_pool()
+        working_dir = pool.acquire()
+        try:
+            generate(working_dir)
+        finally:
+            pool.release(working_dir)
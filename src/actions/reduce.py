@@ -0,0 +1,249 @@
+from typing import Any, List, Set, Union
+import json
+import re
+
+from include.utils import estimate_tokens, truncate_to_tokens
+
+# Token budget for api output embedded in the clean_response prompt
+OUTPUT_TOKEN_BUDGET = 4000
+
+# Array sample sizes tried, largest first, until the output fits the budget
+SAMPLE_SIZES = [20, 10, 5, 3, 1]
+MAX_DEPTHS = [8, 5, 3]
+MAX_STRING_CHARS = 500
+
+# Keys that identify a resource. These are kept whatever the query is about.
+IDENTIFYING_KEY_PARTS = (
+    "id",
+    "name",
+    "arn",
+    "state",
+    "status",
+    "type",
+    "region",
+    "zone",
+    "count",
+)
+
+# Keywords shorter than this only match whole parts of a key
+MIN_SUBSTRING_MATCH = 4
+
+STOPWORDS = {
+    "a",
+    "an",
+    "at",
+    "by",
+    "do",
+    "i",
+    "in",
+    "is",
+    "it",
+    "me",
+    "my",
+    "of",
+    "on",
+    "or",
+    "to",
+    "up",
+    "the",
+    "and",
+    "for",
+    "with",
+    "what",
+    "whats",
+    "which",
+    "how",
+    "many",
+    "much",
+    "are",
+    "all",
+    "any",
+    "can",
+    "you",
+    "your",
+    "show",
+    "list",
+    "get",
+    "give",
+    "tell",
+    "about",
+    "there",
+    "have",
+    "from",
+    "this",
+    "that",
+    "does",
+    "aws",
+}
+
+WORD_REGEX = re.compile(r"[a-z0-9]+")
+CAMEL_REGEX = re.compile(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])")
+
+ARRAY_SUMMARY_COUNT = "total_count"
+ARRAY_SUMMARY_SAMPLE = "sample"
+ELIDED = "..."
+
+
+def query_keywords(query: str) -> Set[str]:
+    """
+    The meaningful words in a user's query, used to decide which fields matter.
+    """
+    words = WORD_REGEX.findall(query.lower())
+    keywords = set()
+    for word in words:
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        keywords.add(word)
+        # crude singularization, so "instances" matches "Instance"
+        if word.endswith("s") and len(word) > 3:
+            keywords.add(word[:-1])
+
+    return keywords
+
+
+def key_parts(key: str) -> List[str]:
+    """
+    Splits a camel case api key like InstanceType into lowercase parts.
+    """
+    return [part.lower() for part in CAMEL_REGEX.findall(key)]
+
+
+class OutputReducer:
+    """
+    Shrinks raw aws api output before it's handed to an llm. JSON output is
+    projected down to the fields relevant to the query, long arrays are
+    summarized with their count and a sample, and the result is made to fit
+    a token budget. Output that already fits is passed through untouched.
+    """
+
+    def __init__(self, token_budget: int = OUTPUT_TOKEN_BUDGET) -> None:
+        self.token_budget = token_budget
+
+    def _is_identifying_key(self, key: str) -> bool:
+        """
+        Whether the key names or identifies a resource, e.g. InstanceId.
+        """
+        return any(part in IDENTIFYING_KEY_PARTS for part in key_parts(key))
+
+    def _is_relevant_key(self, key: str, keywords: Set[str]) -> bool:
+        """
+        A key is relevant if the query mentions it. Short keywords must match a
+        whole part of the key, so "ip" matches PrivateIpAddress but not Description.
+        """
+        parts = key_parts(key)
+        lowered = key.lower()
+
+        return any(
+            keyword in parts
+            or (len(keyword) >= MIN_SUBSTRING_MATCH and keyword in lowered)
+            for keyword in keywords
+        )
+
+    def project(self, obj: Any, keywords: Set[str], matched: bool = False) -> Any:
+        """
+        Keeps the fields of obj relevant to the keywords, plus the identifying
+        fields of any object that has relevant fields. Objects under a relevant
+        key (e.g. everything in Instances, for a query about instances) keep
+        their identifying fields too. Returns None if nothing in obj is relevant.
+        """
+        if isinstance(obj, list):
+            items = [self.project(item, keywords, matched) for item in obj]
+            kept = [item for item in items if item is not None]
+            return kept if len(kept) > 0 else None
+
+        if not isinstance(obj, dict):
+            return obj
+
+        projected = {}
+        for key, value in obj.items():
+            relevant = self._is_relevant_key(key, keywords)
+            if isinstance(value, (dict, list)):
+                nested = self.project(value, keywords, matched or relevant)
+                if nested is not None:
+                    projected[key] = nested
+            elif relevant:
+                projected[key] = value
+
+        if len(projected) == 0 and not matched:
+            return None
+
+        for key, value in obj.items():
+            if key in projected or not self._is_identifying_key(key):
+                continue
+            if isinstance(value, (dict, list)):
+                value = self.project(value, keywords, True)
+            if value is not None:
+                projected[key] = value
+
+        return projected if len(projected) > 0 else None
+
+    def summarize(self, obj: Any, sample_size: int, max_depth: int) -> Any:
+        """
+        Replaces arrays longer than sample_size with their count and a sample,
+        shortens long strings, and cuts off nesting deeper than max_depth.
+        """
+        if max_depth == 0:
+            if isinstance(obj, (dict, list)):
+                return ELIDED
+            return obj
+
+        if isinstance(obj, list):
+            items = [
+                self.summarize(item, sample_size, max_depth - 1)
+                for item in obj[:sample_size]
+            ]
+            if len(obj) > sample_size:
+                return {ARRAY_SUMMARY_COUNT: len(obj), ARRAY_SUMMARY_SAMPLE: items}
+            return items
+
+        if isinstance(obj, dict):
+            return {
+                key: self.summarize(value, sample_size, max_depth - 1)
+                for key, value in obj.items()
+            }
+
+        if isinstance(obj, str) and len(obj) > MAX_STRING_CHARS:
+            return obj[:MAX_STRING_CHARS] + ELIDED
+
+        return obj
+
+    def reduce(
+        self, output: str, query: str, token_budget: Union[int, None] = None
+    ) -> str:
+        """
+        Reduces a raw api output to fit within token_budget, keeping what's most
+        relevant to the query.
+        """
+        if token_budget is None:
+            token_budget = self.token_budget
+
+        if estimate_tokens(output) <= token_budget:
+            return output
+
+        try:
+            parsed = json.loads(output)
+        except json.JSONDecodeError:
+            return truncate_to_tokens(output, token_budget)
+
+        reduced = self.project(parsed, query_keywords(query))
+        if reduced is None:
+            # Nothing matched, so the query doesn't tell us what to drop.
+            reduced = parsed
+        compact = _dumps(reduced)
+        if estimate_tokens(compact) <= token_budget:
+            return compact
+
+        for max_depth in MAX_DEPTHS:
+            for sample_size in SAMPLE_SIZES:
+                compact = _dumps(self.summarize(reduced, sample_size, max_depth))
+                if estimate_tokens(compact) <= token_budget:
+                    return compact
+
+        return truncate_to_tokens(compact, token_budget)
+
+
+def _dumps(obj: Any) -> str:
+    """
+    Compact JSON, without the cli's indentation.
+    """
+    return json.dumps(obj, separators=(",", ":"), default=str)
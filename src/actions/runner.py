@@ -0,0 +1,217 @@
+from typing import List, Tuple, Union, Callable, Coroutine, Any
+import asyncio
+import subprocess
+import threading
+import shlex
+
+# Execution limits
+DEFAULT_TIMEOUT_S = 60.0
+MAX_CONCURRENT_COMMANDS = 8
+OUTPUT_CAP_BYTES = 1 << 20
+READ_CHUNK_BYTES = 1 << 14
+
+# Tokens that only make sense to a shell. Since commands are never run
+# through one, these are rejected up front instead of silently misbehaving.
+SHELL_OPERATORS = {"|", "||", "&", "&&", ";", ">", ">>", "<", "<<"}
+SHELL_SUBSTITUTIONS = ("$(", "`")
+
+
+class UnsafeCommandException(Exception):
+    """
+    Represents a command that relies on shell features (pipes, substitutions,
+    redirects), and so can't be executed as a plain argument vector.
+    """
+
+    pass
+
+
+class CommandResult:
+    """
+    The outcome of a single subprocess execution.
+    """
+
+    def __init__(
+        self,
+        argv: List[str],
+        returncode: int,
+        stdout: str,
+        stderr: str,
+        stdout_truncated: bool = False,
+        stderr_truncated: bool = False,
+    ) -> None:
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stdout_truncated = stdout_truncated
+        self.stderr_truncated = stderr_truncated
+
+    def check_returncode(self):
+        """
+        Raises a CalledProcessError if the command exited with a nonzero code.
+        """
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(
+                self.returncode, self.argv, self.stdout, self.stderr
+            )
+
+
+def split_command(command: str) -> List[str]:
+    """
+    Splits a command string into an argument vector, rejecting anything
+    that would require a shell to run.
+    """
+    # Single quoted text is literal to a shell, and jmespath queries use
+    # backticks for literals, so only look for substitutions outside of it.
+    in_single_quotes = False
+    for i, char in enumerate(command):
+        if char == "'":
+            in_single_quotes = not in_single_quotes
+        elif not in_single_quotes and command.startswith(SHELL_SUBSTITUTIONS, i):
+            raise UnsafeCommandException(f"Command uses shell substitution: {command}")
+
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    argv = list(lexer)
+
+    for token in argv:
+        if token in SHELL_OPERATORS:
+            raise UnsafeCommandException(
+                f"Command uses shell operator '{token}': {command}"
+            )
+
+    if len(argv) == 0:
+        raise UnsafeCommandException("Empty command")
+
+    return argv
+
+
+async def _read_capped(stream: asyncio.StreamReader, cap: int) -> Tuple[bytes, bool]:
+    """
+    Reads a stream to EOF, keeping at most cap bytes. The remainder is
+    drained and dropped so the child never blocks on a full pipe.
+    Returns the kept bytes, and whether anything was dropped.
+    """
+    kept = bytearray()
+    truncated = False
+
+    while chunk := await stream.read(READ_CHUNK_BYTES):
+        remaining = cap - len(kept)
+        if remaining > 0:
+            kept.extend(chunk[:remaining])
+        if len(chunk) > remaining:
+            truncated = True
+
+    return bytes(kept), truncated
+
+
+class AsyncCommandRunner:
+    """
+    Runs commands as asyncio subprocesses, without a shell. Every call is bounded
+    by a timeout, and a single semaphore caps how many commands run at once
+    across all callers.
+
+    The runner owns its own event loop on a daemon thread, so synchronous callers
+    (e.g. fastapi sync endpoints running in a threadpool) share the same
+    concurrency limit via run_sync.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENT_COMMANDS,
+        timeout: float = DEFAULT_TIMEOUT_S,
+        output_cap: int = OUTPUT_CAP_BYTES,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.output_cap = output_cap
+
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="command-runner", daemon=True
+        )
+        self._thread.start()
+
+    async def run(
+        self, argv: List[str], timeout: Union[float, None] = None
+    ) -> CommandResult:
+        """
+        Runs argv and captures stdout and stderr separately. Raises
+        subprocess.TimeoutExpired if the command doesn't finish in time, after
+        killing it. Must be awaited on the runner's own loop, see submit.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        async with self._semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+            try:
+                (stdout, out_truncated), (stderr, err_truncated), _ = (
+                    await asyncio.wait_for(
+                        asyncio.gather(
+                            _read_capped(proc.stdout, self.output_cap),
+                            _read_capped(proc.stderr, self.output_cap),
+                            proc.wait(),
+                        ),
+                        timeout,
+                    )
+                )
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise subprocess.TimeoutExpired(argv, timeout)
+
+        return CommandResult(
+            argv,
+            proc.returncode,
+            stdout.decode("utf8", errors="replace"),
+            stderr.decode("utf8", errors="replace"),
+            out_truncated,
+            err_truncated,
+        )
+
+    async def run_blocking(self, fn: Callable, *args) -> Any:
+        """
+        Runs a blocking callable in a worker thread, under the same concurrency
+        limit as subprocesses. Must be awaited on the runner's own loop.
+        """
+        async with self._semaphore:
+            return await asyncio.to_thread(fn, *args)
+
+    def submit(self, coro: Coroutine) -> Any:
+        """
+        Schedules a coroutine on the runner's loop and blocks until it's done.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def run_sync(
+        self, argv: List[str], timeout: Union[float, None] = None
+    ) -> CommandResult:
+        """
+        Blocking wrapper around run, for synchronous callers.
+        """
+        return self.submit(self.run(argv, timeout))
+
+
+_default_runner: Union[AsyncCommandRunner, None] = None
+_default_runner_lock = threading.Lock()
+
+
+def get_default_runner() -> AsyncCommandRunner:
+    """
+    Returns the process wide runner, creating it on first use.
+    """
+    global _default_runner
+
+    with _default_runner_lock:
+        if _default_runner is None:
+            _default_runner = AsyncCommandRunner()
+
+    return _default_runner
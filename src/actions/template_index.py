@@ -0,0 +1,332 @@
+from typing import Dict, Iterator, List, Tuple, Union
+import threading
+import shutil
+import json
+import time
+import os
+
+import numpy as np
+
+from include.llm.base import AbstractLLMClient
+from include.utils import hash_str
+from src.model.compact import minify
+from src.model.hcl import get_parse_cache
+
+TEMPLATE_CORPUS_PATH = os.environ.get("TEMPLATE_CORPUS_PATH", "include/cfrepo")
+TEMPLATE_INDEX_PATH = os.environ.get(
+    "TEMPLATE_INDEX_PATH", "include/data/template_index"
+)
+TEMPLATE_INDEX_TOP_K = int(os.environ.get("TEMPLATE_INDEX_TOP_K", "2"))
+# Templates less similar to a query than this aren't worth the prompt space
+MIN_SIMILARITY = float(os.environ.get("TEMPLATE_INDEX_MIN_SIMILARITY", "0.35"))
+
+EMBEDDINGS_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.json"
+# Names the version dir holding the current embeddings and metadata
+CURRENT_FILE = "CURRENT"
+# Versions kept on disk, so readers of the one before the latest can finish
+KEPT_VERSIONS = 2
+# Longest text embedded per template, well inside embedding models' limits
+MAX_EMBED_CHARS = 6000
+
+# Only terraform templates are indexed. The corpus also holds cloudformation
+# templates, which aren't references for writing terraform.
+TEMPLATE_EXTENSIONS = (".tf",)
+
+# Metadata keys
+ENTRIES = "entries"
+PATH = "path"
+HASH = "hash"
+DIMENSION = "dimension"
+
+
+class TemplateIndexException(Exception):
+    """
+    Represents a template index that can't be built or updated.
+    """
+
+    pass
+
+
+def corpus_templates(
+    corpus_path: str = TEMPLATE_CORPUS_PATH,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Walks the template corpus like Extractor.extract_templates does, but for
+    terraform files. Yields each template's path relative to the corpus, and
+    its text, in a stable order.
+    """
+    for root, dirs, files in os.walk(corpus_path):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith(TEMPLATE_EXTENSIONS):
+                continue
+
+            path = os.path.join(root, file)
+            try:
+                with open(path, "r", encoding="utf8") as fp:
+                    text = fp.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+
+            if len(text.strip()) > 0:
+                yield os.path.relpath(path, corpus_path), text
+
+
+def embedding_text(path: str, template: str) -> str:
+    """
+    What's embedded for a template: its resource types, which is most of what
+    a description names, then as much of its compacted text as fits.
+    """
+    parsed = get_parse_cache().parse(template)
+    types = sorted({block.labels[0] for block in parsed.resources()})
+    text = f"Resources: {', '.join(types)}\n{minify(template)}"
+
+    return text[:MAX_EMBED_CHARS]
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+class TemplateIndex:
+    """
+    An embedding index over the template corpus, used to show construction
+    the vetted templates nearest a description.
+
+    Embeddings are unit rows of a float32 matrix saved as a .npy file and
+    memory mapped on load, so the index costs no memory until queried, and a
+    query is one matrix vector product. The metadata file lists each row's
+    template path and content hash. Updates only embed templates that are
+    new or changed. Each update writes both files to a new version dir, then
+    swaps the CURRENT pointer to it, so a reader never pairs one version's
+    rows with another's metadata.
+    """
+
+    def __init__(
+        self,
+        index_path: str = TEMPLATE_INDEX_PATH,
+        corpus_path: str = TEMPLATE_CORPUS_PATH,
+    ) -> None:
+        self.index_path = index_path
+        self.corpus_path = corpus_path
+        self._lock = threading.Lock()
+        self.embeddings, self.entries = self._load()
+
+    def _load(self) -> Tuple[Union[np.ndarray, None], List[Dict[str, str]]]:
+        """
+        Maps the current version of the saved index, if there is one.
+        """
+        try:
+            with open(
+                os.path.join(self.index_path, CURRENT_FILE), "r", encoding="utf8"
+            ) as fp:
+                version_path = os.path.join(self.index_path, fp.read().strip())
+        except FileNotFoundError:
+            return None, []
+
+        embeddings_path = os.path.join(version_path, EMBEDDINGS_FILE)
+        metadata_path = os.path.join(version_path, METADATA_FILE)
+        try:
+            with open(metadata_path, "r", encoding="utf8") as fp:
+                entries = json.load(fp)[ENTRIES]
+            embeddings = np.load(embeddings_path, mmap_mode="r")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Couldn't load template index from {self.index_path}: {e}")
+            return None, []
+
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(entries):
+            print(f"Template index at {self.index_path} is inconsistent, ignoring it")
+            return None, []
+
+        return embeddings, entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _embed(self, text: str, llm: AbstractLLMClient) -> Union[np.ndarray, None]:
+        """
+        Embeds text, or returns None if the embedding call failed.
+        """
+        embedding = llm.generate_embeddings(text)
+        if not isinstance(embedding, list) or len(embedding) == 0:
+            print(f"Couldn't embed text: {embedding}")
+            return None
+
+        return np.asarray(embedding, dtype=np.float32)
+
+    def _save(self, embeddings: np.ndarray, entries: List[Dict[str, str]]):
+        """
+        Writes the index to a new version dir, then points CURRENT at it with
+        an atomic rename. Readers mapping an older version keep reading it.
+        Versions older than the last KEPT_VERSIONS are removed.
+        """
+        version = f"v{time.time_ns()}-{os.getpid()}"
+        version_path = os.path.join(self.index_path, version)
+        os.makedirs(version_path)
+
+        np.save(os.path.join(version_path, EMBEDDINGS_FILE), embeddings)
+        with open(
+            os.path.join(version_path, METADATA_FILE), "w", encoding="utf8"
+        ) as fp:
+            json.dump({DIMENSION: int(embeddings.shape[1]), ENTRIES: entries}, fp)
+
+        current_path = os.path.join(self.index_path, CURRENT_FILE)
+        tmp_path = f"{current_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            fp.write(version)
+        os.replace(tmp_path, current_path)
+
+        versions = sorted(
+            name
+            for name in os.listdir(self.index_path)
+            if name.startswith("v")
+            and os.path.isdir(os.path.join(self.index_path, name))
+        )
+        for name in versions[:-KEPT_VERSIONS]:
+            if name != version:
+                shutil.rmtree(os.path.join(self.index_path, name), ignore_errors=True)
+
+    def update(self, llm: AbstractLLMClient) -> Tuple[int, int]:
+        """
+        Brings the index in line with the corpus. Unchanged templates keep
+        their rows, new and changed ones are embedded, and removed ones are
+        dropped. Returns how many templates were embedded, and how many rows
+        were dropped, changed templates counting as both.
+        """
+        with self._lock:
+            rows = {entry[PATH]: i for i, entry in enumerate(self.entries)}
+            # Kept rows go first in the new matrix, then newly embedded ones
+            kept_rows, kept_entries = [], []
+            new_vectors, new_entries = [], []
+
+            for path, template in corpus_templates(self.corpus_path):
+                digest = hash_str(template)
+                row = rows.get(path)
+                if row is not None and self.entries[row][HASH] == digest:
+                    kept_rows.append(row)
+                    kept_entries.append(self.entries[row])
+                    continue
+
+                vector = self._embed(embedding_text(path, template), llm)
+                if vector is None:
+                    continue
+                new_vectors.append(vector)
+                new_entries.append({PATH: path, HASH: digest})
+
+            embedded = len(new_entries)
+            removed = len(self.entries) - len(kept_rows)
+            if embedded == 0 and removed == 0:
+                return 0, 0
+
+            parts = []
+            if len(kept_rows) > 0:
+                parts.append(np.asarray(self.embeddings[kept_rows], dtype=np.float32))
+            if len(new_vectors) > 0:
+                dimensions = {v.shape[0] for v in new_vectors}
+                if len(parts) > 0:
+                    dimensions.add(parts[0].shape[1])
+                if len(dimensions) != 1:
+                    raise TemplateIndexException(
+                        f"Embeddings have mixed dimensions {sorted(dimensions)}"
+                    )
+                parts.append(_normalize(np.stack(new_vectors)))
+
+            entries = kept_entries + new_entries
+            if len(parts) == 0:
+                embeddings = np.zeros((0, 0), dtype=np.float32)
+            else:
+                embeddings = np.concatenate(parts).astype(np.float32)
+
+            self._save(embeddings, entries)
+            self.embeddings, self.entries = self._load()
+
+        print(
+            f"Template index updated: {embedded} embedded, {removed} removed, "
+            f"{len(entries)} total"
+        )
+        return embedded, removed
+
+    def search(
+        self,
+        query: str,
+        llm: AbstractLLMClient,
+        k: int = TEMPLATE_INDEX_TOP_K,
+        min_similarity: float = MIN_SIMILARITY,
+    ) -> List[Tuple[str, float]]:
+        """
+        The paths of the k templates most similar to a query, by cosine
+        similarity, with their scores. Empty if the index is empty or the
+        query can't be embedded.
+        """
+        with self._lock:
+            embeddings, entries = self.embeddings, self.entries
+
+        if embeddings is None or len(entries) == 0 or k <= 0:
+            return []
+
+        vector = self._embed(query, llm)
+        if vector is None or vector.shape[0] != embeddings.shape[1]:
+            return []
+
+        scores = embeddings @ _normalize(vector)
+        k = min(k, len(entries))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            (entries[i][PATH], float(scores[i]))
+            for i in top
+            if scores[i] >= min_similarity
+        ]
+
+    def template(self, path: str) -> Union[str, None]:
+        """
+        The text of a template in the corpus.
+        """
+        try:
+            with open(os.path.join(self.corpus_path, path), "r", encoding="utf8") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def examples(
+        self, query: str, llm: AbstractLLMClient, k: int = TEMPLATE_INDEX_TOP_K
+    ) -> List[Tuple[str, str]]:
+        """
+        The nearest templates to a query as (path, text) pairs, to show as
+        references when constructing a config.
+        """
+        examples = []
+        for path, score in self.search(query, llm, k):
+            template = self.template(path)
+            if template is not None:
+                print(f"Using reference template {path} ({score:.3f})")
+                examples.append((path, template))
+
+        return examples
+
+
+_default_index: Union[TemplateIndex, None] = None
+_default_index_lock = threading.Lock()
+
+
+def get_template_index() -> TemplateIndex:
+    """
+    Returns the process wide template index, mapping it once.
+    """
+    global _default_index
+
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = TemplateIndex()
+
+    return _default_index
+
+
+if __name__ == "__main__":
+    # Builds or updates the index offline, e.g. after adding templates
+    from include.llm.gpt import GPTClient
+
+    get_template_index().update(GPTClient())
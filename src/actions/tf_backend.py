@@ -0,0 +1,175 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Union
+import os
+
+# Which backend session state is kept in, per environment
+LOCAL_BACKEND = "local"
+SHARED_FS_BACKEND = "shared_fs"
+PG_BACKEND = "pg"
+TF_STATE_BACKEND = os.environ.get("TF_STATE_BACKEND", LOCAL_BACKEND)
+
+# A filesystem every deploy worker mounts, e.g. efs or nfs with lock support
+TF_STATE_SHARED_ROOT = os.environ.get("TF_STATE_SHARED_ROOT", "/mnt/cirroe/tfstate")
+TF_STATE_PG_CONN_STR = os.environ.get("TF_STATE_PG_CONN_STR")
+TF_STATE_PG_SCHEMA = os.environ.get("TF_STATE_PG_SCHEMA", "terraform_remote_state")
+# How long a command waits for another worker's state lock before failing
+TF_STATE_LOCK_TIMEOUT = os.environ.get("TF_STATE_LOCK_TIMEOUT", "120s")
+
+# Merged over the session's config, so the backend wins even if the config
+# declares its own. Terraform only merges files ending in _override.tf.
+BACKEND_OVERRIDE_FILE = "cirroe_backend_override.tf"
+LOCKING_COMMANDS = ["plan", "apply", "destroy", "refresh", "import"]
+
+
+class UnknownStateBackendException(Exception):
+    """
+    Represents a TF_STATE_BACKEND that isn't one of the supported backends.
+    """
+
+    pass
+
+
+class AbstractStateBackend(ABC):
+    """
+    Where terraform keeps session state. Sessions are still told apart by
+    workspace, named after the chat session. With a shared backend, state
+    doesn't live in any one working dir, so any deploy worker can serve
+    any session, and terraform's own state lock keeps two workers from
+    applying to the same session at once.
+    """
+
+    name: str
+
+    @abstractmethod
+    def backend_block(self) -> Union[str, None]:
+        """
+        The backend block written into working dirs, or None to keep state
+        in the working dir itself.
+        """
+        pass
+
+    @abstractmethod
+    def backend_config(self) -> Dict[str, str]:
+        """
+        Non secret settings passed to init as -backend-config.
+        """
+        pass
+
+    def is_shared(self) -> bool:
+        """
+        Whether state lives outside the working dir.
+        """
+        return self.backend_block() is not None
+
+    def env(self) -> Dict[str, str]:
+        """
+        Environment for terraform processes using this backend. Secrets go here
+        rather than into backend config, which terraform writes to disk.
+        Commands that take the state lock wait for it instead of failing.
+        """
+        if not self.is_shared():
+            return {}
+
+        return {
+            f"TF_CLI_ARGS_{command}": f"-lock-timeout={TF_STATE_LOCK_TIMEOUT}"
+            for command in LOCKING_COMMANDS
+        }
+
+    def configure(self, working_dir: str):
+        """
+        Points a working dir at this backend, before it's initialized.
+        """
+        path = os.path.join(working_dir, BACKEND_OVERRIDE_FILE)
+        block = self.backend_block()
+        if block is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        with open(path, "w", encoding="utf8") as fp:
+            fp.write(f"terraform {{\n  {block}\n}}\n")
+
+
+class LocalStateBackend(AbstractStateBackend):
+    """
+    State in the working dir, synced back to the session's dir. Every action
+    on a session has to run on the box that holds it, so this is for local
+    development and tests.
+    """
+
+    name = LOCAL_BACKEND
+
+    def backend_block(self) -> Union[str, None]:
+        return None
+
+    def backend_config(self) -> Dict[str, str]:
+        return {}
+
+
+class SharedFSStateBackend(AbstractStateBackend):
+    """
+    State on a filesystem shared by every worker, locked by terraform with
+    fcntl locks on the state file.
+    """
+
+    name = SHARED_FS_BACKEND
+
+    def __init__(self, root: str = TF_STATE_SHARED_ROOT) -> None:
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def backend_block(self) -> Union[str, None]:
+        return 'backend "local" {}'
+
+    def backend_config(self) -> Dict[str, str]:
+        return {
+            "path": os.path.join(self.root, "terraform.tfstate"),
+            "workspace_dir": self.root,
+        }
+
+
+class PostgresStateBackend(AbstractStateBackend):
+    """
+    State in postgres, one row per workspace, locked with advisory locks.
+    """
+
+    name = PG_BACKEND
+
+    def __init__(
+        self,
+        conn_str: Union[str, None] = TF_STATE_PG_CONN_STR,
+        schema: str = TF_STATE_PG_SCHEMA,
+    ) -> None:
+        if conn_str is None:
+            raise UnknownStateBackendException(
+                "The pg state backend needs TF_STATE_PG_CONN_STR"
+            )
+
+        self.conn_str = conn_str
+        self.schema = schema
+
+    def backend_block(self) -> Union[str, None]:
+        return 'backend "pg" {}'
+
+    def backend_config(self) -> Dict[str, str]:
+        return {"schema_name": self.schema}
+
+    def env(self) -> Dict[str, str]:
+        env = super().env()
+        env["PG_CONN_STR"] = self.conn_str
+
+        return env
+
+
+def get_state_backend(name: str = TF_STATE_BACKEND) -> AbstractStateBackend:
+    """
+    Returns the state backend configured for this environment.
+    """
+    if name == LOCAL_BACKEND:
+        return LocalStateBackend()
+    elif name == SHARED_FS_BACKEND:
+        return SharedFSStateBackend()
+    elif name == PG_BACKEND:
+        return PostgresStateBackend()
+
+    raise UnknownStateBackendException(f"Unknown state backend {name}")
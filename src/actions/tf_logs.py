@@ -0,0 +1,286 @@
+from typing import Any, Dict, Iterable, List, Union
+from collections import OrderedDict
+import json
+import re
+
+from include.utils import estimate_tokens, truncate_to_tokens
+from src.actions.precheck import (
+    SEVERITY,
+    SUMMARY,
+    DETAIL,
+    ADDRESS,
+    FILENAME,
+    LINE,
+    ERROR_SEVERITY,
+)
+
+# Token budget for deployment logs embedded in the fix prompt
+LOG_TOKEN_BUDGET = 1500
+
+# Detail lengths tried, longest first, until the errors fit the budget
+DETAIL_CHARS = [600, 300, 120, 0]
+MAX_FALLBACK_LINES = 40
+
+# Reduced error keys
+SIGNATURE = "signature"
+RESOURCE_TYPE = "resource_type"
+ERROR_CODE = "error_code"
+COUNT = "count"
+ADDRESSES = "addresses"
+
+ANSI_REGEX = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]|\x1b\][^\x07]*\x07")
+# Terraform wraps diagnostics in box drawing characters, e.g. "│ Error: ..."
+BOX_REGEX = re.compile(r"^\s*[│╷╵]\s?", re.MULTILINE)
+
+ERROR_START_REGEX = re.compile(r"^(Error|Warning): (.*)$")
+WITH_REGEX = re.compile(r"^\s*with ([\w\-.\[\]\"]+),\s*$")
+ON_REGEX = re.compile(r"^\s*on (\S+) line (\d+)")
+# Source lines quoted under a diagnostic, e.g. "  12: resource ..."
+SNIPPET_REGEX = re.compile(r"^\s*\d+: ")
+# Per request noise that's useless to the llm
+REQUEST_ID_REGEX = re.compile(r",?\s*RequestID: [\w\-]+")
+AWS_ERROR_CODE_REGEX = re.compile(
+    r"(?:api error|Code:?|error code:?)\s*([A-Z][A-Za-z0-9]*(?:\.[A-Za-z0-9]+)*)"
+)
+
+# Values that vary between otherwise identical errors, most specific first
+VARIABLE_PATTERNS = [
+    (re.compile(r"arn:aws[a-z\-]*:[^\s'\",)]+"), "<arn>"),
+    (
+        re.compile(
+            r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.I
+        ),
+        "<uuid>",
+    ),
+    (re.compile(r"\b[a-z]+-[0-9a-f]{8,17}\b"), "<id>"),
+    (re.compile(r"\"[^\"]*\"|'[^']*'|\[[^\]]*\]"), "<value>"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "<n>"),
+]
+
+
+def strip_ansi(text: str) -> str:
+    """
+    Removes terminal color codes and terraform's diagnostic box drawing.
+    """
+    return BOX_REGEX.sub("", ANSI_REGEX.sub("", text))
+
+
+def resource_type(address: Union[str, None]) -> Union[str, None]:
+    """
+    The resource type of an address, e.g. aws_instance for module.a.aws_instance.web[0].
+    """
+    if address is None:
+        return None
+
+    parts = [part for part in address.split(".") if part != "data"]
+    while len(parts) >= 2 and parts[0] == "module":
+        parts = parts[2:]
+
+    return parts[0] if len(parts) > 0 else None
+
+
+def normalize_message(message: str) -> str:
+    """
+    Replaces values that vary between occurrences of the same error, like ids,
+    names and request ids, so the same error always normalizes the same way.
+    """
+    for pattern, replacement in VARIABLE_PATTERNS:
+        message = pattern.sub(replacement, message)
+
+    return " ".join(message.split())
+
+
+def error_signature(error: Dict[str, Any]) -> str:
+    """
+    A stable signature for an error, e.g.
+    aws_s3_bucket: creating S3 Bucket (<value>): BucketAlreadyExists
+    """
+    summary = normalize_message(error.get(SUMMARY) or "")
+    code = error.get(ERROR_CODE)
+    if code is not None and code not in summary:
+        summary = f"{summary}: {code}"
+
+    rtype = error.get(RESOURCE_TYPE)
+    return f"{rtype}: {summary}" if rtype is not None else summary
+
+
+def _finish(error: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fills in the derived fields of an extracted error.
+    """
+    error[RESOURCE_TYPE] = resource_type(error.get(ADDRESS))
+    match = AWS_ERROR_CODE_REGEX.search(
+        f"{error.get(SUMMARY) or ''} {error.get(DETAIL) or ''}"
+    )
+    error[ERROR_CODE] = match.group(1) if match else None
+    error[SIGNATURE] = error_signature(error)
+
+    return error
+
+
+def parse_error_blocks(text: str) -> List[Dict[str, Any]]:
+    """
+    Extracts the Error: blocks from terraform's human readable output, along
+    with the resource address and location each refers to.
+    """
+    errors = []
+    current = None
+    detail_lines: List[str] = []
+
+    def close():
+        if current is not None:
+            current[DETAIL] = "\n".join(detail_lines).strip()
+            errors.append(_finish(current))
+
+    for line in strip_ansi(text).splitlines():
+        start = ERROR_START_REGEX.match(line.strip())
+        if start:
+            close()
+            current = {
+                SEVERITY: start.group(1).lower(),
+                SUMMARY: REQUEST_ID_REGEX.sub("", start.group(2)).strip(),
+                ADDRESS: None,
+                FILENAME: None,
+                LINE: None,
+            }
+            detail_lines = []
+            continue
+
+        if current is None:
+            continue
+
+        with_match = WITH_REGEX.match(line)
+        on_match = ON_REGEX.match(line)
+        if with_match and current[ADDRESS] is None:
+            current[ADDRESS] = with_match.group(1)
+        elif on_match and current[FILENAME] is None:
+            current[FILENAME] = on_match.group(1)
+            current[LINE] = int(on_match.group(2))
+        elif not SNIPPET_REGEX.match(line):
+            detail_lines.append(line.rstrip())
+
+    close()
+    return errors
+
+
+def extract_errors(log: str) -> List[Dict[str, Any]]:
+    """
+    Extracts errors from a cached log, which is either a json diagnostic line
+    or raw terraform output.
+    """
+    try:
+        diagnostic = json.loads(log)
+    except json.JSONDecodeError:
+        return parse_error_blocks(log)
+
+    if not isinstance(diagnostic, dict) or SUMMARY not in diagnostic:
+        return parse_error_blocks(log)
+
+    error = {
+        SEVERITY: diagnostic.get(SEVERITY, ERROR_SEVERITY),
+        SUMMARY: REQUEST_ID_REGEX.sub("", strip_ansi(diagnostic.get(SUMMARY, ""))),
+        DETAIL: strip_ansi(diagnostic.get(DETAIL, "")),
+        ADDRESS: diagnostic.get(ADDRESS),
+        FILENAME: diagnostic.get(FILENAME),
+        LINE: diagnostic.get(LINE),
+    }
+    return [_finish(error)]
+
+
+class LogReducer:
+    """
+    Reduces deployment logs to the distinct errors in them before they're
+    handed to an llm. Errors are deduplicated by signature, so the same
+    failure repeated across retries or resources only appears once with a
+    count. If no errors can be found, the deduplicated tail of the logs is
+    used instead. Either way the result fits a token budget.
+    """
+
+    def __init__(self, token_budget: int = LOG_TOKEN_BUDGET) -> None:
+        self.token_budget = token_budget
+
+    def errors(self, logs: Iterable[str]) -> List[Dict[str, Any]]:
+        """
+        The distinct errors in the logs, in the order they first appeared, each
+        with the number of times it occurred and every resource it occurred on.
+        Warnings are dropped.
+        """
+        distinct: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        for log in logs:
+            for error in extract_errors(str(log)):
+                if error[SEVERITY] != ERROR_SEVERITY:
+                    continue
+
+                seen = distinct.get(error[SIGNATURE])
+                if seen is None:
+                    error[COUNT] = 0
+                    error[ADDRESSES] = []
+                    seen = distinct[error[SIGNATURE]] = error
+
+                seen[COUNT] += 1
+                address = error.get(ADDRESS)
+                if address is not None and address not in seen[ADDRESSES]:
+                    seen[ADDRESSES].append(address)
+
+        return list(distinct.values())
+
+    def signatures(self, logs: Iterable[str]) -> List[str]:
+        """
+        The distinct error signatures in the logs, e.g. for indexing fixes.
+        """
+        return list(OrderedDict.fromkeys(e[SIGNATURE] for e in self.errors(logs)))
+
+    def format_error(self, error: Dict[str, Any], detail_chars: int) -> str:
+        """
+        Formats an error for a prompt, with its detail cut to detail_chars.
+        """
+        header = f"Error: {error[SUMMARY]}"
+        if error[COUNT] > 1:
+            header += f" (x{error[COUNT]})"
+
+        lines = [header]
+        if len(error[ADDRESSES]) > 0:
+            lines.append(f"  resources: {', '.join(error[ADDRESSES])}")
+        if error.get(FILENAME) is not None:
+            lines.append(f"  at: {error[FILENAME]} line {error.get(LINE)}")
+
+        detail = " ".join((error.get(DETAIL) or "").split())
+        if detail_chars > 0 and len(detail) > 0:
+            if len(detail) > detail_chars:
+                detail = detail[:detail_chars] + "..."
+            lines.append(f"  detail: {detail}")
+
+        return "\n".join(lines)
+
+    def fallback(self, logs: Iterable[str]) -> str:
+        """
+        Deduplicated, cleaned log lines, for logs without recognizable errors.
+        """
+        lines = OrderedDict()
+        for log in logs:
+            for line in strip_ansi(str(log)).splitlines():
+                line = line.strip()
+                if len(line) > 0:
+                    lines[line] = None
+
+        return "\n".join(list(lines)[-MAX_FALLBACK_LINES:])
+
+    def reduce(self, logs: Iterable[str], token_budget: Union[int, None] = None) -> str:
+        """
+        Reduces the logs to their distinct errors, within token_budget.
+        """
+        if token_budget is None:
+            token_budget = self.token_budget
+
+        logs = list(logs)
+        errors = self.errors(logs)
+        if len(errors) == 0:
+            return truncate_to_tokens(self.fallback(logs), token_budget)
+
+        reduced = ""
+        for detail_chars in DETAIL_CHARS:
+            reduced = "\n\n".join(self.format_error(e, detail_chars) for e in errors)
+            if estimate_tokens(reduced) <= token_budget:
+                return reduced
+
+        return truncate_to_tokens(reduced, token_budget)
@@ -0,0 +1,297 @@
+from typing import Any, Callable, Dict, List, Tuple, Union
+from collections import deque
+import subprocess
+import threading
+import signal
+import json
+import os
+
+from python_terraform import Terraform, IsFlagged, TerraformCommandError
+
+from src.actions.precheck import normalize_diagnostic, ERROR_SEVERITY, SEVERITY
+
+EVENT_HISTORY = 200
+STOP_GRACE_S = 300
+
+# Normalized event keys
+TYPE = "type"
+LEVEL = "level"
+MESSAGE = "message"
+ADDRESS = "address"
+ACTION = "action"
+DIAGNOSTIC = "diagnostic"
+CHANGES = "changes"
+
+# Event types. Most come straight from terraform's -json output, e.g.
+# apply_start, apply_progress, apply_complete, apply_errored, change_summary.
+# Lines that aren't json become log events.
+LOG_EVENT = "log"
+DIAGNOSTIC_EVENT = "diagnostic"
+APPLY_ERRORED_EVENT = "apply_errored"
+CHANGE_SUMMARY_EVENT = "change_summary"
+STOPPED_EVENT = "stopped"
+
+ERROR_LEVEL = "error"
+INFO_LEVEL = "info"
+
+# Ambient credential sources terraform must never fall back to. The server's
+# own keys, and the shared credentials file holding every user's profile.
+ISOLATED_ENV_VARS = (
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_SESSION_TOKEN",
+    "AWS_SECURITY_TOKEN",
+    "AWS_PROFILE",
+    "AWS_DEFAULT_PROFILE",
+    "AWS_REGION",
+    "AWS_DEFAULT_REGION",
+    "AWS_ROLE_ARN",
+    "AWS_WEB_IDENTITY_TOKEN_FILE",
+    "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI",
+    "AWS_CONTAINER_CREDENTIALS_FULL_URI",
+)
+ISOLATED_FILE_ENV_VARS = ("AWS_SHARED_CREDENTIALS_FILE", "AWS_CONFIG_FILE")
+
+EventCallback = Callable[[Dict[str, Any]], None]
+
+
+def parse_event(line: str, source: str) -> Union[Dict[str, Any], None]:
+    """
+    Parses a line of terraform -json output into a normalized event. Blank
+    lines are dropped, and anything that isn't json is kept as a log event.
+    """
+    line = line.strip()
+    if len(line) == 0:
+        return None
+
+    try:
+        message = json.loads(line)
+    except json.JSONDecodeError:
+        return {TYPE: LOG_EVENT, LEVEL: INFO_LEVEL, MESSAGE: line}
+
+    if not isinstance(message, dict):
+        return {TYPE: LOG_EVENT, LEVEL: INFO_LEVEL, MESSAGE: line}
+
+    hook = message.get("hook") or {}
+    event = {
+        TYPE: message.get("type", LOG_EVENT),
+        LEVEL: message.get("@level", INFO_LEVEL),
+        MESSAGE: message.get("@message", ""),
+    }
+
+    resource = hook.get("resource") or {}
+    if "addr" in resource:
+        event[ADDRESS] = resource["addr"]
+    if ACTION in hook:
+        event[ACTION] = hook[ACTION]
+
+    if event[TYPE] == DIAGNOSTIC_EVENT:
+        event[DIAGNOSTIC] = normalize_diagnostic(message[DIAGNOSTIC], source)
+        if event[DIAGNOSTIC][ADDRESS] is not None:
+            event[ADDRESS] = event[DIAGNOSTIC][ADDRESS]
+    elif event[TYPE] == CHANGE_SUMMARY_EVENT:
+        event[CHANGES] = message.get(CHANGES)
+
+    return event
+
+
+def is_error(event: Dict[str, Any]) -> bool:
+    """
+    Whether an event reports a failure.
+    """
+    if event[TYPE] == DIAGNOSTIC_EVENT:
+        return event[DIAGNOSTIC][SEVERITY] == ERROR_SEVERITY
+
+    return event[TYPE] == APPLY_ERRORED_EVENT or event[LEVEL] == ERROR_LEVEL
+
+
+def credentials_env(secret: str, access: str, region: str) -> Dict[str, str]:
+    """
+    The environment a user's terraform processes authenticate to aws with.
+    """
+    return {
+        "AWS_SECRET_ACCESS_KEY": secret,
+        "AWS_ACCESS_KEY_ID": access,
+        "AWS_DEFAULT_REGION": region,
+        "AWS_REGION": region,
+    }
+
+
+class ProgressChannel:
+    """
+    Fans terraform events out to subscribers as they arrive, e.g. the job
+    progress record the status endpoint serves. Keeps a bounded history so
+    late subscribers can catch up.
+    """
+
+    def __init__(self, history: int = EVENT_HISTORY) -> None:
+        self.history: deque = deque(maxlen=history)
+        self._subscribers: List[EventCallback] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: EventCallback, replay: bool = False):
+        """
+        Registers a callback for every future event, and optionally the history.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+            past = list(self.history) if replay else []
+
+        for event in past:
+            callback(event)
+
+    def unsubscribe(self, callback: EventCallback):
+        """
+        Stops sending events to a callback.
+        """
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def publish(self, event: Dict[str, Any]):
+        """
+        Sends an event to every subscriber. A failing subscriber doesn't stop
+        the others, or the command producing the events.
+        """
+        with self._lock:
+            self.history.append(event)
+            subscribers = list(self._subscribers)
+
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Progress subscriber failed: {e}")
+
+
+class StreamingTerraform(Terraform):
+    """
+    A Terraform client that can stream a command's -json output line by line,
+    rather than only returning it once the process exits.
+
+    Every command runs with its own environment: the server's, without any
+    ambient aws credentials, plus env. Credentials are never written to
+    os.environ, so clients for different users can run concurrently in one
+    process without seeing each other's keys.
+    """
+
+    def __init__(self, *args, env: Union[Dict[str, str], None] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.env = env if env is not None else {}
+
+    def cmd(self, cmd, *args, **kwargs):
+        """
+        Runs a terraform command to completion, as Terraform.cmd does, but in
+        this client's environment. Returns the return code, stdout and stderr.
+        """
+        capture_output = kwargs.pop("capture_output", True)
+        raise_on_error = kwargs.pop("raise_on_error", False)
+        output = subprocess.PIPE if capture_output is True else None
+
+        argv = self.generate_cmd_string(cmd, *args, **kwargs)
+        try:
+            process = subprocess.run(
+                argv,
+                stdout=output,
+                stderr=output,
+                cwd=self.working_dir,
+                env=self.command_env(),
+                text=True,
+            )
+        finally:
+            self.temp_var_files.clean_up()
+
+        if process.returncode == 0:
+            self.read_state_file()
+        elif raise_on_error:
+            raise TerraformCommandError(
+                process.returncode,
+                " ".join(argv),
+                out=process.stdout,
+                err=process.stderr,
+            )
+
+        return process.returncode, process.stdout, process.stderr
+
+    def stream(
+        self,
+        cmd: str,
+        *args,
+        on_event: Union[EventCallback, None] = None,
+        stop_on_error: bool = False,
+        **kwargs,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Runs a terraform command with -json, calling on_event with each parsed
+        event as it arrives. If stop_on_error is set, the command is interrupted
+        at the first error, which lets terraform finish in flight operations
+        and save state before exiting. Returns the return code, and the error
+        events.
+        """
+        kwargs["json"] = IsFlagged
+        kwargs.setdefault("no_color", IsFlagged)
+        argv = self.generate_cmd_string(cmd, *args, **kwargs)
+
+        errors = []
+        stopped = False
+
+        process = subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.working_dir,
+            env=self.command_env(),
+            text=True,
+            bufsize=1,
+        )
+
+        try:
+            for line in process.stdout:
+                event = parse_event(line, cmd)
+                if event is None:
+                    continue
+
+                if is_error(event):
+                    errors.append(event)
+                if on_event is not None:
+                    on_event(event)
+
+                if stop_on_error and len(errors) > 0 and not stopped:
+                    print(f"terraform {cmd} failed, stopping early: {event[MESSAGE]}")
+                    process.send_signal(signal.SIGINT)
+                    stopped = True
+                    if on_event is not None:
+                        on_event(
+                            {
+                                TYPE: STOPPED_EVENT,
+                                LEVEL: INFO_LEVEL,
+                                MESSAGE: f"Stopping terraform {cmd} after the first error",
+                            }
+                        )
+
+            return_code = process.wait(timeout=STOP_GRACE_S)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            return_code = process.wait()
+        finally:
+            self.temp_var_files.clean_up()
+
+        if return_code == 0:
+            self.read_state_file()
+
+        return return_code, errors
+
+    def command_env(self) -> Dict[str, str]:
+        """
+        The environment terraform commands run with. Ambient aws credentials are
+        stripped, and shared credential files are pointed at nothing, so a
+        missing key fails loudly instead of falling back to someone else's.
+        """
+        env = os.environ.copy() if self.is_env_vars_included else {}
+        for name in ISOLATED_ENV_VARS:
+            env.pop(name, None)
+        for name in ISOLATED_FILE_ENV_VARS:
+            env[name] = os.devnull
+
+        env.update(self.env)
+        return env
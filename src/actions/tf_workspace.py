@@ -0,0 +1,436 @@
+from typing import Dict, List, Union
+from collections import deque
+import threading
+import fcntl
+import shutil
+import time
+import uuid
+import os
+
+from python_terraform import Terraform
+
+from src.actions.tf_stream import StreamingTerraform
+
+# Shared, on disk provider cache. Every working dir links providers from here
+# instead of downloading them again.
+TF_PLUGIN_CACHE_DIR = os.environ.get(
+    "TF_PLUGIN_CACHE_DIR", os.path.expanduser("~/.terraform.d/plugin-cache")
+)
+# Optional local provider mirror, e.g. populated with `terraform providers mirror`
+TF_PROVIDER_MIRROR_DIR = os.environ.get("TF_PROVIDER_MIRROR_DIR")
+TF_WORKSPACE_POOL_ROOT = os.environ.get(
+    "TF_WORKSPACE_POOL_ROOT", "/tmp/cirroe/tf-workspaces"
+)
+TF_WORKSPACE_POOL_SIZE = int(os.environ.get("TF_WORKSPACE_POOL_SIZE", "4"))
+# The most working dirs the pool grows to under load. Past it, acquire waits
+# for a dir to be released.
+TF_WORKSPACE_POOL_MAX_SIZE = int(os.environ.get("TF_WORKSPACE_POOL_MAX_SIZE", "16"))
+TF_WORKSPACE_ACQUIRE_TIMEOUT_S = float(
+    os.environ.get("TF_WORKSPACE_ACQUIRE_TIMEOUT_S", "300")
+)
+ACQUIRE_POLL_S = 1
+
+CLI_CONFIG_FILE = "cli.tfrc"
+WARMUP_FILE = "_warmup.tf"
+WARMUP_CONFIG = """terraform {
+  required_providers {
+    aws = {
+      source = "hashicorp/aws"
+    }
+  }
+}
+"""
+
+# Markers in a pooled dir. A dir is handed out only once it's ready, and the
+# lease is created exclusively, so several processes can share one pool root.
+READY_MARKER = ".ready"
+LEASE_MARKER = ".lease"
+# Held while reclaiming leases of crashed processes, or adding a working dir,
+# so processes sharing the pool root don't race each other
+RECLAIM_LOCK_FILE = ".reclaim.lock"
+# A lease without a readable pid is only stale once it's this old, since its
+# holder may still be writing it
+LEASE_GRACE_S = 60
+
+# What survives recycling: installed providers. The dependency lock file is a
+# session's, so it's copied in and out with the session's config instead.
+DOT_TERRAFORM = ".terraform"
+LOCK_FILE = ".terraform.lock.hcl"
+PROVIDERS_DIR = "providers"
+
+TIMING_HISTORY = 100
+
+# Files copied into a leased working dir, and where local workspace state lives
+TF_FILE_SUFFIXES = (".tf", ".tfvars", ".tf.json")
+TF_STATE_DIR = "terraform.tfstate.d"
+
+
+class WorkspaceInitException(Exception):
+    """
+    Represents a failure to initialize a terraform working dir.
+    """
+
+    pass
+
+
+class WorkspacePoolExhaustedException(Exception):
+    """
+    Represents a pool at its max size with no working dir released in time.
+    """
+
+    pass
+
+
+class TFWorkspacePool:
+    """
+    A pool of pre-initialized terraform working dirs sharing one provider
+    plugin cache. Providers are installed once when a dir is warmed, so
+    handing it out only costs a near instant init against the installed
+    providers. Dirs are recycled after use, keeping only their providers.
+    The pool grows past size under load, up to max_size working dirs.
+    """
+
+    def __init__(
+        self,
+        root: str = TF_WORKSPACE_POOL_ROOT,
+        size: int = TF_WORKSPACE_POOL_SIZE,
+        max_size: int = TF_WORKSPACE_POOL_MAX_SIZE,
+        plugin_cache_dir: str = TF_PLUGIN_CACHE_DIR,
+        provider_mirror_dir: Union[str, None] = TF_PROVIDER_MIRROR_DIR,
+    ) -> None:
+        self.root = root
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.plugin_cache_dir = plugin_cache_dir
+        self.provider_mirror_dir = provider_mirror_dir
+        self.init_timings: deque = deque(maxlen=TIMING_HISTORY)
+        self._lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.plugin_cache_dir, exist_ok=True)
+        self.configure_env()
+
+    def configure_env(self):
+        """
+        Points every terraform process spawned from here at the shared plugin
+        cache, and the provider mirror if there is one. None of this is secret.
+        """
+        os.environ["TF_PLUGIN_CACHE_DIR"] = self.plugin_cache_dir
+        os.environ["TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE"] = "true"
+        os.environ["TF_IN_AUTOMATION"] = "true"
+
+        if self.provider_mirror_dir is not None:
+            cli_config = os.path.join(self.root, CLI_CONFIG_FILE)
+            with open(cli_config, "w", encoding="utf8") as fp:
+                fp.write(
+                    "provider_installation {\n"
+                    f'  filesystem_mirror {{\n    path = "{self.provider_mirror_dir}"\n  }}\n'
+                    "  direct {}\n"
+                    "}\n"
+                )
+            os.environ["TF_CLI_CONFIG_FILE"] = cli_config
+
+    def _slot_dirs(self) -> List[str]:
+        """
+        All working dirs in the pool, ready or not.
+        """
+        return [
+            os.path.join(self.root, name)
+            for name in sorted(os.listdir(self.root))
+            if os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def _try_lease(self, path: str) -> bool:
+        """
+        Atomically claims a working dir. Returns false if someone else holds it.
+        """
+        try:
+            fd = os.open(
+                os.path.join(path, LEASE_MARKER), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+            )
+        except FileExistsError:
+            return False
+
+        os.write(fd, str(os.getpid()).encode("utf8"))
+        os.close(fd)
+        return True
+
+    def _lease_is_stale(self, path: str) -> bool:
+        """
+        Whether a working dir's lease was left by a process that's gone.
+        """
+        lease = os.path.join(path, LEASE_MARKER)
+        try:
+            with open(lease, "r", encoding="utf8") as fp:
+                pid = int(fp.read().strip())
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            try:
+                return time.time() - os.path.getmtime(lease) > LEASE_GRACE_S
+            except OSError:
+                return False
+
+        return not _pid_alive(pid)
+
+    def reclaim_stale(self) -> int:
+        """
+        Returns working dirs leased by crashed processes to the pool. Dirs that
+        never finished warming are removed. Returns how many were reclaimed.
+        """
+        reclaimed = 0
+        lock_path = os.path.join(self.root, RECLAIM_LOCK_FILE)
+        with open(lock_path, "w", encoding="utf8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for path in self._slot_dirs():
+                if not self._lease_is_stale(path):
+                    continue
+
+                print(f"Reclaiming terraform working dir {path} from a dead process")
+                if os.path.exists(os.path.join(path, READY_MARKER)):
+                    self.release(path)
+                else:
+                    _remove(path)
+                reclaimed += 1
+
+        return reclaimed
+
+    def init(
+        self,
+        path: str,
+        env: Union[Dict[str, str], None] = None,
+        backend_config: Union[Dict[str, str], None] = None,
+    ) -> Terraform:
+        """
+        Runs terraform init in a working dir, recording how long it took. env
+        holds anything the init needs beyond the server's, e.g. backend
+        credentials, and backend_config the state backend's settings.
+        """
+        tf = StreamingTerraform(working_dir=path, env=env)
+
+        start = time.perf_counter()
+        return_code, _, stderr = tf.init(backend_config=backend_config, input=False)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.init_timings.append(elapsed)
+        print(f"terraform init in {path} took {elapsed:.2f}s")
+
+        if return_code != 0:
+            raise WorkspaceInitException(stderr)
+
+        return tf
+
+    def warm(self, path: str):
+        """
+        Installs the aws provider into a working dir, then marks it ready.
+        """
+        warmup_file = os.path.join(path, WARMUP_FILE)
+        with open(warmup_file, "w", encoding="utf8") as fp:
+            fp.write(WARMUP_CONFIG)
+
+        try:
+            self.init(path)
+        finally:
+            os.remove(warmup_file)
+
+        open(os.path.join(path, READY_MARKER), "w", encoding="utf8").close()
+
+    def _new_slot(self) -> Union[str, None]:
+        """
+        Creates, leases, and warms a new working dir. Returns None if the pool
+        is already at its max size. A dir that fails to warm is removed.
+        """
+        lock_path = os.path.join(self.root, RECLAIM_LOCK_FILE)
+        with open(lock_path, "w", encoding="utf8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if len(self._slot_dirs()) >= self.max_size:
+                return None
+
+            path = os.path.join(self.root, uuid.uuid4().hex)
+            os.makedirs(path)
+            self._try_lease(path)
+
+        try:
+            self.warm(path)
+        except Exception:
+            _remove(path)
+            raise
+
+        return path
+
+    def prewarm(self):
+        """
+        Tops the pool up to its size with ready, unleased working dirs.
+        """
+        self.reclaim_stale()
+        idle = [
+            path
+            for path in self._slot_dirs()
+            if os.path.exists(os.path.join(path, READY_MARKER))
+            and not os.path.exists(os.path.join(path, LEASE_MARKER))
+        ]
+
+        for _ in range(self.size - len(idle)):
+            path = self._new_slot()
+            if path is None:
+                break
+            self.release(path)
+
+    def prewarm_in_background(self) -> threading.Thread:
+        """
+        Runs prewarm on a daemon thread, e.g. at server startup.
+        """
+        thread = threading.Thread(target=self.prewarm, name="tf-prewarm", daemon=True)
+        thread.start()
+
+        return thread
+
+    def _lease_ready(self) -> Union[str, None]:
+        """
+        Leases any ready working dir that's free.
+        """
+        for path in self._slot_dirs():
+            is_ready = os.path.exists(os.path.join(path, READY_MARKER))
+            if is_ready and self._try_lease(path):
+                return path
+
+        return None
+
+    def acquire(self, timeout: float = TF_WORKSPACE_ACQUIRE_TIMEOUT_S) -> str:
+        """
+        Leases a ready working dir. If none is free and no dirs of crashed
+        processes can be reclaimed, a new one is warmed, unless the pool is at
+        its max size, in which case this waits up to timeout for a release.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            path = self._lease_ready()
+            if path is not None:
+                return path
+
+            if self.reclaim_stale() > 0:
+                continue
+
+            path = self._new_slot()
+            if path is not None:
+                print("Terraform workspace pool exhausted. Warmed a new working dir.")
+                return path
+
+            if time.monotonic() > deadline:
+                raise WorkspacePoolExhaustedException(
+                    f"No terraform working dir was released within {timeout}s"
+                )
+            time.sleep(ACQUIRE_POLL_S)
+
+    def recycle(self, path: str):
+        """
+        Removes everything from a working dir except its installed providers,
+        so the next user starts clean. The lock file goes too, so the next
+        session's init picks provider versions by its own constraints, or its
+        own lock file.
+        """
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if name in (READY_MARKER, LEASE_MARKER):
+                continue
+            if name == DOT_TERRAFORM:
+                for inner in os.listdir(full_path):
+                    if inner != PROVIDERS_DIR:
+                        _remove(os.path.join(full_path, inner))
+                continue
+
+            _remove(full_path)
+
+    def release(self, path: str):
+        """
+        Recycles a leased working dir and returns it to the pool.
+        """
+        self.recycle(path)
+        os.remove(os.path.join(path, LEASE_MARKER))
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Init timing stats over the recent history, in seconds.
+        """
+        with self._lock:
+            timings = sorted(self.init_timings)
+
+        if len(timings) == 0:
+            return {"count": 0}
+
+        return {
+            "count": len(timings),
+            "mean": sum(timings) / len(timings),
+            "p50": timings[len(timings) // 2],
+            "max": timings[-1],
+        }
+
+
+def seed_working_dir(source_dir: str, working_dir: str):
+    """
+    Copies a session's config files, dependency lock file and workspace state
+    into a working dir.
+    """
+    for name in os.listdir(source_dir):
+        path = os.path.join(source_dir, name)
+        is_session_file = name.endswith(TF_FILE_SUFFIXES) or name == LOCK_FILE
+        if is_session_file and os.path.isfile(path):
+            shutil.copy2(path, working_dir)
+
+    state_dir = os.path.join(source_dir, TF_STATE_DIR)
+    if os.path.isdir(state_dir):
+        shutil.copytree(
+            state_dir, os.path.join(working_dir, TF_STATE_DIR), dirs_exist_ok=True
+        )
+
+
+def select_workspace(tf: Terraform, workspace: str):
+    """
+    Switches an initialized working dir to a workspace, creating it if needed.
+    """
+    return_code, _, _ = tf.create_workspace(workspace)
+    if return_code != 0:
+        # Already exists from a previous action on this session
+        tf.set_workspace(workspace)
+
+
+def _pid_alive(pid: int) -> bool:
+    """
+    Whether a process with a pid is running on this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def _remove(path: str):
+    """
+    Removes a file or directory tree.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+_default_pool: Union[TFWorkspacePool, None] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> TFWorkspacePool:
+    """
+    Returns the process wide workspace pool, creating it on first use.
+    """
+    global _default_pool
+
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = TFWorkspacePool()
+
+    return _default_pool
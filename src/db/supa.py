@@ -16,6 +16,9 @@ TF_CONFIG_COL_NAME = "config"
 STATE_COL_NAME = "state"
 COST_LIMITER_COL_NAME = "cost_limiter"
 STACK_NAME_COL = "config_name"
+DRIFT_SUMMARY_COL_NAME = "drift_summary"
+DRIFT_CHECKED_AT_COL_NAME = "drift_checked_at"
+SESSION_USER_ID_COL_NAME = "UserId"
 ID = "id"
 
 USER_MSG = "user_msg"
@@ -219,6 +222,46 @@ class SupaClient:
 
         return response.data[0][COST_LIMITER_COL_NAME]
 
+    def get_sessions_by_state(
+        self, state: ChatSessionState, limit: int, offset: int = 0
+    ) -> List[Dict[str, str]]:
+        """
+        Get a page of the chat sessions of every user in a state, least recently
+        drift checked first, with sessions that were never checked ahead of the rest.
+        """
+
+        response = (
+            self.supabase.table(Table.CHAT_SESSIONS)
+            .select(ID, SESSION_USER_ID_COL_NAME, DRIFT_CHECKED_AT_COL_NAME)
+            .eq(STATE_COL_NAME, state.name)
+            .order(DRIFT_CHECKED_AT_COL_NAME, nullsfirst=True)
+            .range(offset, offset + limit - 1)
+            .execute()
+        )
+
+        return response.data
+
+    def update_drift_summary(
+        self, chat_session_id: UUID, summary: Dict, checked_at: str
+    ):
+        """
+        Record the result of a chat session's latest drift check
+        """
+
+        response = (
+            self.supabase.table(Table.CHAT_SESSIONS)
+            .update(
+                {
+                    DRIFT_SUMMARY_COL_NAME: summary,
+                    DRIFT_CHECKED_AT_COL_NAME: checked_at,
+                }
+            )
+            .eq(ID, chat_session_id)
+            .execute()
+        )
+
+        return response
+
     def get_user_aws_preferences(self) -> Tuple[str, str, str]:
         """
         Returns the user's aws credentials in the following format:
@@ -0,0 +1,327 @@
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+import threading
+import json
+
+from src.model.patch import PatchFailedException, set_attribute
+from src.model.hcl import (
+    ParsedConfig,
+    classify,
+    get_parse_cache,
+    mask,
+    parse,
+    CODE,
+    LITERAL,
+    OPENERS,
+    CLOSERS,
+    RESOURCE,
+    DATA,
+    MODULE,
+)
+
+PROVIDER_DEFAULTS_PATH = "include/data/provider_defaults.json"
+
+# Stands in for the body of a block left out of a compacted config
+ELIDED_BODY = "..."
+# Only these blocks are elided. Variables, locals and providers are short,
+# and referenced everywhere.
+ELIDABLE_TYPES = (RESOURCE, DATA, MODULE)
+
+# Tells an llm how to read, and write back, a config with elided blocks
+ELIDED_NOTE = (
+    "Blocks whose body is just `...` are unchanged blocks left out for brevity. "
+    "Copy them into your response exactly as they appear, with `...` as their "
+    "body, unless you need to change them."
+)
+
+
+def minify(template: str) -> str:
+    """
+    Strips comments, indentation, alignment, trailing whitespace and blank
+    lines, keeping the newlines terraform needs between attributes. String
+    contents and heredoc bodies are kept verbatim.
+    """
+    kinds = classify(template)
+    out: List[str] = []
+    space = False
+    for char, kind in zip(template, kinds):
+        if kind == LITERAL:
+            out.append(char)
+            space = False
+        elif kind != CODE:
+            continue
+        elif char == "\n":
+            if len(out) > 0 and out[-1] != "\n":
+                out.append("\n")
+            space = False
+        elif char in " \t\r":
+            space = len(out) > 0 and out[-1] != "\n"
+        else:
+            if space:
+                out.append(" ")
+                space = False
+            out.append(char)
+
+    return "".join(out).rstrip() + "\n"
+
+
+def indent(template: str, width: int = 2) -> str:
+    """
+    Re-indents a config by bracket depth, e.g. after an llm wrote back a
+    minified one. Only leading whitespace changes. Heredoc bodies are left
+    as they are.
+    """
+    kinds = classify(template)
+    masked = mask(template)
+
+    lines = []
+    depth = 0
+    start = 0
+    for line in template.split("\n"):
+        end = start + len(line)
+        code = masked[start:end]
+        if start > 0 and kinds[start - 1] == LITERAL:
+            # Inside a heredoc, or its closing marker
+            lines.append(line)
+        else:
+            stripped = code.lstrip()
+            closers = len(stripped) - len(stripped.lstrip(CLOSERS))
+            level = max(depth - closers, 0)
+            lines.append(" " * width * level + line.strip() if line.strip() else "")
+
+        depth += sum(code.count(c) for c in OPENERS)
+        depth = max(depth - sum(code.count(c) for c in CLOSERS), 0)
+        start = end + 1
+
+    return "\n".join(lines)
+
+
+def _literal(value: Any) -> str:
+    """
+    How a json default is written in hcl.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return json.dumps(value)
+
+    return str(value)
+
+
+def related_addresses(parsed: ParsedConfig, addresses: Iterable[str]) -> Set[str]:
+    """
+    The addresses, plus what they directly depend on and what directly
+    depends on them.
+    """
+    related = set()
+    for address in addresses:
+        if parsed.get(address) is None:
+            continue
+        related.add(address)
+        related.update(parsed.dependencies_of(address))
+        related.update(parsed.dependents_of(address))
+
+    return related
+
+
+class CompactConfig:
+    """
+    A config compacted for a prompt, with what was taken out of it: the
+    original text of elided blocks, and the provider default attributes
+    dropped from each block, both by address. minified is whether comments
+    and layout were stripped too.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        stubs: Dict[str, str],
+        dropped: Dict[str, Dict[str, str]],
+        original_chars: int,
+        minified: bool = True,
+    ) -> None:
+        self.text = text
+        self.stubs = stubs
+        self.dropped = dropped
+        self.original_chars = original_chars
+        self.minified = minified
+
+    def ratio(self) -> float:
+        """
+        Compacted size over original size.
+        """
+        return len(self.text) / max(self.original_chars, 1)
+
+    def _restore_stubs(self, output: str, parsed: ParsedConfig) -> str:
+        replacements: List[Tuple[int, int, str]] = []
+        seen = set()
+        for block in parsed.blocks:
+            address = block.address
+            if address not in self.stubs:
+                continue
+            seen.add(address)
+            if output[block.body_start : block.body_end].strip() == ELIDED_BODY:
+                replacements.append((block.start, block.end, self.stubs[address]))
+
+        for start, end, text in reversed(replacements):
+            output = output[:start] + text + output[end:]
+
+        missing = [text for address, text in self.stubs.items() if address not in seen]
+        if len(missing) > 0:
+            output = output.rstrip() + "\n\n" + "\n\n".join(missing) + "\n"
+
+        return output
+
+    def _restore_defaults(self, output: str) -> str:
+        for address, attributes in self.dropped.items():
+            for name, value in attributes.items():
+                block = get_parse_cache().parse(output).get(address)
+                if block is None or name in block.attributes:
+                    continue
+                try:
+                    output = set_attribute(output, address, name, value)
+                except PatchFailedException:
+                    continue
+
+        return output
+
+    def expand(self, output: str) -> str:
+        """
+        Turns an llm's config written from the compacted one back into a full
+        one. Elided blocks are restored wherever it copied their stub back, and
+        appended if it left them out altogether, since they were elided as not
+        relevant. Dropped defaults it didn't set otherwise are put back, which
+        doesn't change what's deployed but keeps diffs against the original
+        down to the llm's changes. Finally it's re-indented, if it was written
+        from a minified config.
+        """
+        parsed = parse(output)
+        if len(parsed.blocks) == 0:
+            return output
+
+        if len(self.stubs) > 0:
+            output = self._restore_stubs(output, parsed)
+        output = self._restore_defaults(output)
+
+        return indent(output) if self.minified else output
+
+
+class Compactor:
+    """
+    Shrinks configs before they're embedded in prompts: drops attributes set
+    to their provider default, elides blocks that aren't relevant to a task
+    down to a stub, and minifies what's left. Compacted configs are only for
+    prompts. Configs an llm writes back from them are expanded before use.
+    """
+
+    def __init__(self, defaults: Dict[str, Dict[str, Any]]) -> None:
+        self.defaults = {
+            resource_type: {name: _literal(v) for name, v in attributes.items()}
+            for resource_type, attributes in defaults.items()
+        }
+
+    @classmethod
+    def load(cls, path: str = PROVIDER_DEFAULTS_PATH) -> "Compactor":
+        with open(path, "r", encoding="utf8") as fp:
+            return cls(json.load(fp)["resources"])
+
+    def drop_defaults(self, template: str) -> Tuple[str, Dict[str, Dict[str, str]]]:
+        """
+        Removes top level resource attributes set to their provider default,
+        when they have a line to themselves. Returns the text and the dropped
+        attributes by block address.
+        """
+        parsed = get_parse_cache().parse(template)
+
+        spans = []
+        dropped: Dict[str, Dict[str, str]] = {}
+        for block in parsed.resources():
+            defaults = self.defaults.get(block.labels[0])
+            if defaults is None:
+                continue
+            for name, attribute in block.attributes.items():
+                if defaults.get(name) != attribute.value.strip():
+                    continue
+                if attribute.line_start <= block.body_start:
+                    # Shares the block's opening line
+                    continue
+                spans.append((attribute.line_start, attribute.line_end))
+                dropped.setdefault(block.address, {})[name] = attribute.value
+
+        for start, end in sorted(spans, reverse=True):
+            template = template[:start] + template[end:]
+
+        return template, dropped
+
+    def elide(self, template: str, keep: Iterable[str]) -> Tuple[str, Dict[str, str]]:
+        """
+        Replaces every resource, data source and module not in keep with a
+        stub holding just its header. Returns the text and the elided blocks'
+        original text by address.
+        """
+        keep = set(keep)
+        parsed = get_parse_cache().parse(template)
+
+        stubs: Dict[str, str] = {}
+        replacements = []
+        for block in parsed.blocks:
+            address = block.address
+            if block.type not in ELIDABLE_TYPES or address is None or address in keep:
+                continue
+            header = template[block.start : block.body_start - 1].strip()
+            stubs[address] = template[block.start : block.end]
+            replacements.append(
+                (block.start, block.end, f"{header} {{\n{ELIDED_BODY}\n}}")
+            )
+
+        for start, end, stub in reversed(replacements):
+            template = template[:start] + stub + template[end:]
+
+        return template, stubs
+
+    def compact(
+        self,
+        template: str,
+        keep: Union[Iterable[str], None] = None,
+        minified: bool = True,
+    ) -> CompactConfig:
+        """
+        Compacts a config for a prompt. If keep is given, only those blocks
+        keep their bodies. Without minified, comments and layout are kept,
+        for prompts whose response replaces the user's file.
+        """
+        stubs: Dict[str, str] = {}
+        text = template
+        if keep is not None:
+            text, stubs = self.elide(text, keep)
+
+        text, dropped = self.drop_defaults(text)
+        if minified:
+            text = minify(text)
+
+        return CompactConfig(text, stubs, dropped, len(template), minified)
+
+
+_default_compactor: Union[Compactor, None] = None
+_default_compactor_lock = threading.Lock()
+
+
+def get_compactor() -> Compactor:
+    """
+    Returns the process wide compactor, loading the provider defaults once.
+    """
+    global _default_compactor
+
+    with _default_compactor_lock:
+        if _default_compactor is None:
+            _default_compactor = Compactor.load()
+
+    return _default_compactor
+
+
+def compact(
+    template: str, keep: Union[Iterable[str], None] = None, minified: bool = True
+) -> CompactConfig:
+    """
+    Compacts a config with the process wide compactor.
+    """
+    return get_compactor().compact(template, keep, minified)
@@ -0,0 +1,206 @@
+from typing import Dict, List, Tuple, Union
+
+from src.model.hcl import Block, ParsedConfig, LOCALS
+
+# Longest attribute value shown in a formatted diff
+MAX_VALUE_CHARS = 120
+# Longest nested block shown in a formatted diff, e.g. an added ingress rule
+MAX_BLOCK_CHARS = 400
+
+# Change keys
+PATH = "path"
+OLD = "old"
+NEW = "new"
+# Whether a change adds or removes a whole nested block
+BLOCK = "block"
+
+
+def _normalize(value: str) -> str:
+    return " ".join(value.split())
+
+
+def _short(value: Union[str, None], max_chars: int = MAX_VALUE_CHARS) -> str:
+    value = _normalize(value or "")
+    if len(value) > max_chars:
+        return value[:max_chars] + "..."
+
+    return value
+
+
+def render_body(block: Block) -> str:
+    """
+    A block's body on one line, nested blocks included, e.g.
+    { from_port = 22 cidr_blocks = ["10.0.0.0/16"] }
+    """
+    parts = [f"{name} = {_normalize(a.value)}" for name, a in block.attributes.items()]
+    parts.extend(f"{nested.type} {render_body(nested)}" for nested in block.blocks)
+
+    return "{ " + " ".join(parts) + " }" if len(parts) > 0 else "{}"
+
+
+def block_key(block: Block) -> str:
+    """
+    A block's address, or its type and labels if it has none, e.g. terraform.
+    """
+    return block.address or " ".join([block.type] + block.labels)
+
+
+def _named_blocks(parsed: ParsedConfig) -> Dict[str, Block]:
+    """
+    Every top level block by key. Locals are compared as values instead.
+    """
+    return {block_key(b): b for b in parsed.blocks if b.type != LOCALS}
+
+
+def _locals(parsed: ParsedConfig) -> Dict[str, str]:
+    values = {}
+    for block in parsed.blocks:
+        if block.type == LOCALS:
+            for name, attribute in block.attributes.items():
+                values[f"local.{name}"] = attribute.value
+
+    return values
+
+
+def diff_blocks(old: Block, new: Block, prefix: str = "") -> List[Dict[str, str]]:
+    """
+    The attribute level changes between two versions of a block, including
+    in nested blocks, which are matched up by type and position. Whitespace
+    only changes aren't counted.
+    """
+    changes = []
+    for name in list(old.attributes) + [
+        n for n in new.attributes if n not in old.attributes
+    ]:
+        before = old.attributes.get(name)
+        after = new.attributes.get(name)
+        old_value = before.value if before is not None else None
+        new_value = after.value if after is not None else None
+        if old_value is not None and new_value is not None:
+            if _normalize(old_value) == _normalize(new_value):
+                continue
+        changes.append({PATH: prefix + name, OLD: old_value, NEW: new_value})
+
+    types = list(dict.fromkeys([b.type for b in old.blocks + new.blocks]))
+    for block_type in types:
+        old_nested, new_nested = old.nested(block_type), new.nested(block_type)
+        for i in range(max(len(old_nested), len(new_nested))):
+            path = f"{prefix}{block_type}[{i}]"
+            if i >= len(old_nested):
+                changes.append(
+                    {
+                        PATH: path,
+                        OLD: None,
+                        NEW: render_body(new_nested[i]),
+                        BLOCK: True,
+                    }
+                )
+            elif i >= len(new_nested):
+                changes.append(
+                    {
+                        PATH: path,
+                        OLD: render_body(old_nested[i]),
+                        NEW: None,
+                        BLOCK: True,
+                    }
+                )
+            else:
+                changes.extend(diff_blocks(old_nested[i], new_nested[i], path + "."))
+
+    return changes
+
+
+class ConfigDiff:
+    """
+    What changed between two versions of a config: the blocks added and
+    removed, by address, and the attribute changes in blocks in both.
+    """
+
+    def __init__(
+        self,
+        added: List[Block],
+        removed: List[Block],
+        modified: List[Tuple[str, List[Dict[str, str]]]],
+    ) -> None:
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def is_empty(self) -> bool:
+        return len(self.added) + len(self.removed) + len(self.modified) == 0
+
+    def format(self, max_value_chars: int = MAX_VALUE_CHARS) -> str:
+        """
+        A compact, line per change rendering, e.g.
+        + aws_eip.ip
+            instance = aws_instance.web.id
+        ~ aws_instance.web
+            instance_type: "t3.micro" -> "t3.large"
+        ~ aws_security_group.web
+            + ingress[1] { from_port = 22 to_port = 22 }
+        - aws_s3_bucket.logs
+        """
+        max_block_chars = max_value_chars * MAX_BLOCK_CHARS // MAX_VALUE_CHARS
+        if self.is_empty():
+            return "No changes."
+
+        lines = []
+        for block in self.added:
+            lines.append(f"+ {block_key(block)}")
+            for name, attribute in block.attributes.items():
+                lines.append(f"    {name} = {_short(attribute.value, max_value_chars)}")
+            for nested in block.blocks:
+                body = _short(render_body(nested), max_block_chars)
+                lines.append(f"    {nested.type} {body}")
+
+        for key, changes in self.modified:
+            lines.append(f"~ {key}")
+            for change in changes:
+                if change.get(BLOCK):
+                    sign = "+" if change[OLD] is None else "-"
+                    body = _short(change[NEW] or change[OLD], max_block_chars)
+                    lines.append(f"    {sign} {change[PATH]} {body}")
+                elif change[OLD] is None:
+                    new = _short(change[NEW], max_value_chars)
+                    lines.append(f"    + {change[PATH]} = {new}")
+                elif change[NEW] is None:
+                    lines.append(f"    - {change[PATH]}")
+                else:
+                    old = _short(change[OLD], max_value_chars)
+                    new = _short(change[NEW], max_value_chars)
+                    lines.append(f"    {change[PATH]}: {old} -> {new}")
+
+        for block in self.removed:
+            lines.append(f"- {block_key(block)}")
+
+        return "\n".join(lines)
+
+
+def diff_configs(old: ParsedConfig, new: ParsedConfig) -> ConfigDiff:
+    """
+    Structurally diffs two parsed configs. Blocks are matched by address, so
+    reordering blocks or reformatting them isn't a change.
+    """
+    old_blocks, new_blocks = _named_blocks(old), _named_blocks(new)
+
+    added = [b for k, b in new_blocks.items() if k not in old_blocks]
+    removed = [b for k, b in old_blocks.items() if k not in new_blocks]
+    modified = []
+    for key, block in new_blocks.items():
+        if key in old_blocks:
+            changes = diff_blocks(old_blocks[key], block)
+            if len(changes) > 0:
+                modified.append((key, changes))
+
+    old_locals, new_locals = _locals(old), _locals(new)
+    local_changes = [
+        {PATH: name, OLD: old_locals.get(name), NEW: new_locals.get(name)}
+        for name in list(old_locals) + [n for n in new_locals if n not in old_locals]
+        if old_locals.get(name) is None
+        or new_locals.get(name) is None
+        or _normalize(old_locals[name]) != _normalize(new_locals[name])
+    ]
+    if len(local_changes) > 0:
+        modified.append((LOCALS, local_changes))
+
+    return ConfigDiff(added, removed, modified)
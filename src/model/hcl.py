@@ -0,0 +1,537 @@
+from typing import Dict, List, Set, Tuple, Union
+from collections import OrderedDict, deque
+import threading
+import re
+
+from include.utils import hash_str
+
+# Parsed configs kept, by template hash
+PARSE_CACHE_SIZE = 128
+
+IDENT_REGEX = re.compile(r"[A-Za-z_][\w\-]*")
+HEREDOC_REGEX = re.compile(r"<<-?([A-Za-z_][\w\-]*)[ \t]*\n")
+# a.b or a.b.c, not preceded by another traversal or identifier
+REFERENCE_REGEX = re.compile(
+    r"(?<![\w.\-])([A-Za-z_][\w\-]*)\.([A-Za-z_][\w\-]*)(?:\.([A-Za-z_][\w\-]*))?"
+)
+
+# Top level block types
+RESOURCE = "resource"
+DATA = "data"
+MODULE = "module"
+VARIABLE = "variable"
+OUTPUT = "output"
+LOCALS = "locals"
+PROVIDER = "provider"
+TERRAFORM = "terraform"
+
+# Reference roots that don't point at another block
+BUILTIN_ROOTS = frozenset(["each", "count", "self", "path", "terraform"])
+# Reference roots whose addresses only take one name
+NAMED_ROOTS = {"var": "var", "local": "local", "module": "module"}
+
+OPENERS = "{[("
+CLOSERS = "}])"
+
+# Character classes
+CODE = 0
+COMMENT = 1
+LITERAL = 2
+
+
+def classify(template: str) -> bytearray:
+    """
+    Classifies every character of a template as CODE, COMMENT or LITERAL,
+    i.e. literal string contents and heredoc bodies. Quotes, interpolations
+    and heredoc markers are code.
+    """
+    kinds = bytearray(len(template))
+    n = len(template)
+    i = 0
+    # Interpolation depth at which each open string started
+    strings: List[int] = []
+    depth = 0
+
+    def mark(start: int, end: int, kind: int):
+        kinds[start:end] = bytes([kind]) * (min(end, n) - start)
+
+    while i < n:
+        char = template[i]
+        in_string = len(strings) > 0 and strings[-1] == depth
+
+        if in_string:
+            if char == "\\":
+                mark(i, i + 2, LITERAL)
+                i += 2
+            elif template.startswith("$${", i) or template.startswith("%%{", i):
+                # Escaped, so a literal ${ rather than an interpolation
+                mark(i, i + 3, LITERAL)
+                i += 3
+            elif char == '"':
+                strings.pop()
+                i += 1
+            elif template.startswith("${", i) or template.startswith("%{", i):
+                depth += 1
+                i += 2
+            else:
+                kinds[i] = LITERAL
+                i += 1
+            continue
+
+        if char == "#" or template.startswith("//", i):
+            end = template.find("\n", i)
+            end = n if end == -1 else end
+            mark(i, end, COMMENT)
+            i = end
+        elif template.startswith("/*", i):
+            end = template.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            mark(i, end, COMMENT)
+            i = end
+        elif char == '"':
+            strings.append(depth)
+            i += 1
+        elif template.startswith("<<", i) and HEREDOC_REGEX.match(template, i):
+            marker = HEREDOC_REGEX.match(template, i)
+            end_match = re.compile(
+                rf"^[ \t]*{re.escape(marker.group(1))}[ \t]*$", re.MULTILINE
+            ).search(template, marker.end())
+            end = n if end_match is None else end_match.start()
+            mark(marker.end() - 1, end, LITERAL)
+            i = n if end_match is None else end_match.end()
+        elif char == "{" and depth > 0:
+            depth += 1
+            i += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            i += 1
+        else:
+            i += 1
+
+    return kinds
+
+
+def mask(template: str) -> str:
+    """
+    A copy of template with comments and literal string contents blanked out,
+    keeping quotes, interpolations and offsets, so structure can be scanned
+    without tripping over braces or references in strings. Heredoc bodies are
+    blanked including their newlines, so a heredoc reads as one line.
+    """
+    kinds = classify(template)
+    return "".join(
+        char if kind == CODE or (kind == COMMENT and char == "\n") else " "
+        for char, kind in zip(template, kinds)
+    )
+
+
+def references(expression: str) -> Set[str]:
+    """
+    The addresses a masked expression refers to, e.g. aws_vpc.main for
+    aws_vpc.main.id, var.region for var.region, data.aws_ami.ubuntu for
+    data.aws_ami.ubuntu.id.
+    """
+    found = set()
+    for root, name, attribute in REFERENCE_REGEX.findall(expression):
+        if root in BUILTIN_ROOTS:
+            continue
+        if root == DATA:
+            if attribute:
+                found.add(f"{DATA}.{name}.{attribute}")
+        elif root in NAMED_ROOTS:
+            found.add(f"{NAMED_ROOTS[root]}.{name}")
+        else:
+            found.add(f"{root}.{name}")
+
+    return found
+
+
+def _line_end(text: str, i: int) -> int:
+    end = text.find("\n", i)
+    return len(text) if end == -1 else end
+
+
+class Attribute:
+    """
+    An attribute assignment in a block, e.g. ami = "ami-123". start and end
+    span the value in the template, without any trailing comment. line_start
+    and line_end span the whole assignment, including its indentation and
+    newline if it has a line to itself.
+    """
+
+    __slots__ = (
+        "name",
+        "value",
+        "start",
+        "end",
+        "line_start",
+        "line_end",
+        "references",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        value: str,
+        start: int,
+        end: int,
+        line_start: int,
+        line_end: int,
+        references: Set[str],
+    ) -> None:
+        self.name = name
+        self.value = value
+        self.start = start
+        self.end = end
+        self.line_start = line_start
+        self.line_end = line_end
+        self.references = references
+
+    def is_multiline(self) -> bool:
+        return "\n" in self.value
+
+
+class Block:
+    """
+    A block, e.g. resource "aws_instance" "web" { ... }. start and end span the
+    whole block, body_start and body_end the text between its braces.
+    """
+
+    __slots__ = (
+        "type",
+        "labels",
+        "start",
+        "end",
+        "body_start",
+        "body_end",
+        "attributes",
+        "blocks",
+        "references",
+    )
+
+    def __init__(self, block_type: str, labels: List[str], start: int) -> None:
+        self.type = block_type
+        self.labels = labels
+        self.start = start
+        self.end = start
+        self.body_start = start
+        self.body_end = start
+        self.attributes: "OrderedDict[str, Attribute]" = OrderedDict()
+        self.blocks: List[Block] = []
+        self.references: Set[str] = set()
+
+    @property
+    def address(self) -> Union[str, None]:
+        """
+        How the rest of the config refers to this block, if it can.
+        """
+        if self.type == RESOURCE and len(self.labels) == 2:
+            return f"{self.labels[0]}.{self.labels[1]}"
+        if self.type == DATA and len(self.labels) == 2:
+            return f"{DATA}.{self.labels[0]}.{self.labels[1]}"
+        if self.type == MODULE and len(self.labels) == 1:
+            return f"{MODULE}.{self.labels[0]}"
+        if self.type == VARIABLE and len(self.labels) == 1:
+            return f"var.{self.labels[0]}"
+        if self.type == OUTPUT and len(self.labels) == 1:
+            return f"{OUTPUT}.{self.labels[0]}"
+        if self.type == PROVIDER and len(self.labels) == 1:
+            address = f"{PROVIDER}.{self.labels[0]}"
+            alias = self.attributes.get("alias")
+            if alias is not None:
+                address += "." + alias.value.strip('"')
+            return address
+
+        return None
+
+    def nested(self, block_type: str) -> List["Block"]:
+        """
+        The nested blocks of a type, e.g. ingress blocks of a security group.
+        """
+        return [block for block in self.blocks if block.type == block_type]
+
+
+class _Parser:
+    """
+    A recursive descent parser over a masked template. It only recognizes
+    blocks and attributes, and treats expressions as opaque text, which is
+    all the structure local analyses need.
+    """
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        self.masked = mask(template)
+        self.n = len(template)
+
+    def skip_space(self, i: int, newlines: bool = True) -> int:
+        while i < self.n and (
+            self.masked[i] in " \t\r" or (newlines and self.masked[i] == "\n")
+        ):
+            i += 1
+        return i
+
+    def expression_end(self, i: int) -> int:
+        """
+        Where an attribute value starting at i ends: the end of its line, or
+        the block's closing brace, outside of brackets.
+        """
+        depth = 0
+        while i < self.n:
+            char = self.masked[i]
+            if char in OPENERS:
+                depth += 1
+            elif char in CLOSERS:
+                if depth == 0:
+                    break
+                depth -= 1
+            elif char == "\n" and depth == 0:
+                break
+            i += 1
+        return i
+
+    def body(self, i: int, parent: Union[Block, None]) -> Tuple[List[Block], int]:
+        """
+        Parses statements from i up to a closing brace, or the end of the
+        template at the top level. Returns the blocks, and where parsing stopped.
+        """
+        blocks = []
+        while True:
+            i = self.skip_space(i)
+            if i < self.n and self.masked[i] == "}" and parent is None:
+                # A stray closing brace at the top level
+                i += 1
+                continue
+            if i >= self.n or self.masked[i] == "}":
+                return blocks, i
+
+            line_start = self.masked.rfind("\n", 0, i) + 1
+            if self.masked[line_start:i].strip():
+                # Shares its line with something before it
+                line_start = i
+            name = IDENT_REGEX.match(self.masked, i)
+            if name is None:
+                # Not a statement we understand. Skip the line.
+                i = _line_end(self.masked, i) + 1
+                continue
+
+            j = self.skip_space(name.end(), newlines=False)
+            if (
+                j < self.n
+                and self.masked[j] == "="
+                and self.masked[j + 1 : j + 2] != "="
+            ):
+                start = self.skip_space(j + 1, newlines=False)
+                end = self.expression_end(start)
+                value_end = start + len(self.masked[start:end].rstrip())
+                line_end = value_end
+                if end < self.n and self.masked[end] == "\n":
+                    line_end = end + 1
+                if parent is not None:
+                    parent.attributes[name.group(0)] = Attribute(
+                        name.group(0),
+                        self.template[start:value_end],
+                        start,
+                        value_end,
+                        line_start,
+                        line_end,
+                        references(self.masked[start:value_end]),
+                    )
+                i = end
+                continue
+
+            labels = []
+            while j < self.n and self.masked[j] != "{":
+                if self.masked[j] == '"':
+                    close = self.masked.find('"', j + 1)
+                    if close == -1:
+                        break
+                    labels.append(self.template[j + 1 : close])
+                    j = self.skip_space(close + 1, newlines=False)
+                    continue
+                label = IDENT_REGEX.match(self.masked, j)
+                if label is None:
+                    break
+                labels.append(label.group(0))
+                j = self.skip_space(label.end(), newlines=False)
+
+            if j >= self.n or self.masked[j] != "{":
+                i = _line_end(self.masked, j) + 1
+                continue
+
+            block = Block(name.group(0), labels, line_start)
+            block.body_start = j + 1
+            block.blocks, k = self.body(j + 1, block)
+            block.body_end = k
+            block.end = min(k + 1, self.n)
+            block.references = references(self.masked[block.body_start : k])
+            blocks.append(block)
+            i = block.end
+
+
+class ParsedConfig:
+    """
+    The blocks of a terraform config, indexed by address, with the
+    dependency graph between them. Addresses follow terraform's, e.g.
+    aws_instance.web, data.aws_ami.ubuntu, var.region and local.tags.
+    """
+
+    __slots__ = (
+        "template",
+        "masked",
+        "blocks",
+        "by_address",
+        "dependencies",
+        "dependents",
+    )
+
+    def __init__(
+        self, template: str, blocks: List[Block], masked: Union[str, None] = None
+    ) -> None:
+        self.template = template
+        # The template with comments and literals blanked, see mask
+        self.masked = masked if masked is not None else mask(template)
+        self.blocks = blocks
+        self.by_address: Dict[str, Block] = {}
+        self.dependencies: Dict[str, Set[str]] = {}
+
+        for block in blocks:
+            if block.type == LOCALS:
+                for name, attribute in block.attributes.items():
+                    address = f"local.{name}"
+                    self.by_address[address] = block
+                    self.dependencies[address] = set(attribute.references)
+                continue
+
+            address = block.address
+            if address is not None:
+                self.by_address[address] = block
+                self.dependencies[address] = set(block.references)
+
+        # Only edges between blocks in this config, e.g. not to modules' outputs
+        self.dependents: Dict[str, Set[str]] = {a: set() for a in self.dependencies}
+        for address, deps in self.dependencies.items():
+            deps.intersection_update(self.by_address)
+            deps.discard(address)
+            for dep in deps:
+                self.dependents[dep].add(address)
+
+    def get(self, address: str) -> Union[Block, None]:
+        return self.by_address.get(address)
+
+    def resources(self) -> List[Block]:
+        """
+        The managed resource blocks, in config order.
+        """
+        return [b for b in self.blocks if b.type == RESOURCE and b.address]
+
+    def resource_addresses(self) -> List[str]:
+        return [b.address for b in self.resources()]
+
+    def text(self, address: str) -> Union[str, None]:
+        """
+        The source of the block at an address.
+        """
+        block = self.get(address)
+        if block is None:
+            return None
+
+        return self.template[block.start : block.end]
+
+    def _walk(self, address: str, edges: Dict[str, Set[str]]) -> Set[str]:
+        seen: Set[str] = set()
+        queue = deque(edges.get(address, ()))
+        while len(queue) > 0:
+            current = queue.popleft()
+            if current not in seen:
+                seen.add(current)
+                queue.extend(edges.get(current, ()))
+
+        return seen
+
+    def dependencies_of(self, address: str, transitive: bool = False) -> Set[str]:
+        """
+        What a block refers to, directly or through other blocks.
+        """
+        if transitive:
+            return self._walk(address, self.dependencies)
+
+        return set(self.dependencies.get(address, ()))
+
+    def dependents_of(self, address: str, transitive: bool = False) -> Set[str]:
+        """
+        What refers to a block, directly or through other blocks.
+        """
+        if transitive:
+            return self._walk(address, self.dependents)
+
+        return set(self.dependents.get(address, ()))
+
+    def topological_order(self) -> List[str]:
+        """
+        Every address, with dependencies before what depends on them. Cycles,
+        which terraform would reject, are broken in config order.
+        """
+        remaining = {a: len(deps) for a, deps in self.dependencies.items()}
+        ready = deque(a for a, count in remaining.items() if count == 0)
+        order = []
+        while len(order) < len(remaining):
+            if len(ready) == 0:
+                ready.append(next(a for a in remaining if a not in order))
+            current = ready.popleft()
+            if current in order:
+                continue
+            order.append(current)
+            for dependent in self.dependents[current]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+
+        return order
+
+
+def parse(template: str) -> ParsedConfig:
+    """
+    Parses a terraform config. Never raises: text that isn't understood is skipped.
+    """
+    parser = _Parser(template)
+    blocks, _ = parser.body(0, None)
+
+    return ParsedConfig(template, blocks, parser.masked)
+
+
+class ParseCache:
+    """
+    An LRU of parsed configs keyed by template hash, so the same template is
+    only parsed once however many configs hold it.
+    """
+
+    def __init__(self, max_entries: int = PARSE_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, template: str) -> ParsedConfig:
+        key = hash_str(template)
+        with self._lock:
+            parsed = self._entries.get(key)
+            if parsed is not None:
+                self._entries.move_to_end(key)
+                return parsed
+
+        parsed = parse(template)
+        with self._lock:
+            self._entries[key] = parsed
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return parsed
+
+
+_default_cache = ParseCache()
+
+
+def get_parse_cache() -> ParseCache:
+    """
+    Returns the process wide parse cache.
+    """
+    return _default_cache
@@ -0,0 +1,283 @@
+from typing import Any, Dict, List, Set, Union
+import json
+
+from src.model.hcl import (
+    Block,
+    ParsedConfig,
+    get_parse_cache,
+    mask,
+    parse,
+    OPENERS,
+    CLOSERS,
+)
+
+# Operation keys
+OP = "op"
+ADDRESS = "address"
+KEY = "key"
+VALUE = "value"
+TEXT = "text"
+
+# Operations
+ADD_BLOCK = "add_block"
+REPLACE_BLOCK = "replace_block"
+REMOVE_BLOCK = "remove_block"
+SET_ATTRIBUTE = "set_attribute"
+REMOVE_ATTRIBUTE = "remove_attribute"
+
+REQUIRED_KEYS = {
+    ADD_BLOCK: (TEXT,),
+    REPLACE_BLOCK: (ADDRESS, TEXT),
+    REMOVE_BLOCK: (ADDRESS,),
+    SET_ATTRIBUTE: (ADDRESS, KEY, VALUE),
+    REMOVE_ATTRIBUTE: (ADDRESS, KEY),
+}
+
+# Local values share their locals block, so they're addressed within it
+LOCAL_PREFIX = "local."
+
+# Values that may be given as json rather than hcl text, e.g. 20 or true
+SCALAR_TYPES = (bool, int, float, type(None))
+
+
+class PatchFailedException(Exception):
+    """
+    Represents a patch that can't be applied cleanly to a config.
+    """
+
+    pass
+
+
+def _block(parsed: ParsedConfig, address: str) -> Block:
+    block = parsed.get(address)
+    if block is None:
+        raise PatchFailedException(f"No block {address} in the config")
+
+    return block
+
+
+def _nested(block: Block, key: str) -> Block:
+    """
+    Follows a dotted key like root_block_device.volume_size to the block
+    holding the attribute. Each part names the first nested block of a type.
+    """
+    for part in key.split(".")[:-1]:
+        nested = block.nested(part)
+        if len(nested) == 0:
+            raise PatchFailedException(f"No nested {part} block")
+        block = nested[0]
+
+    return block
+
+
+def _balanced(text: str) -> bool:
+    masked = mask(text)
+    return sum(masked.count(c) for c in OPENERS) == sum(
+        masked.count(c) for c in CLOSERS
+    )
+
+
+def _parse_block(text: str) -> Block:
+    """
+    Parses the text of a single, complete block.
+    """
+    parsed = parse(text.strip())
+    if len(parsed.blocks) != 1 or not _balanced(text):
+        raise PatchFailedException("Block text isn't exactly one complete block")
+
+    return parsed.blocks[0]
+
+
+def set_attribute(template: str, address: str, key: str, value: str) -> str:
+    """
+    Sets an attribute of a block, keeping the line's alignment and any
+    trailing comment, or adds it before the block's closing brace.
+    """
+    block = _nested(_block(get_parse_cache().parse(template), address), key)
+    name = key.split(".")[-1]
+
+    attribute = block.attributes.get(name)
+    if attribute is not None:
+        return template[: attribute.start] + value + template[attribute.end :]
+
+    # A body that starts on the header line, e.g. output "ip" { value = ... },
+    # is broken onto its own lines, since terraform only allows one argument
+    # in a single line block
+    first_newline = template.find("\n", block.body_start, block.body_end)
+    first_line_end = first_newline if first_newline != -1 else block.body_end
+    opens_inline = template[block.body_start : first_line_end].strip() != ""
+    header_start = template.rfind("\n", 0, block.body_start) + 1
+    header = template[header_start : block.body_start]
+    outer = header[: len(header) - len(header.lstrip())]
+
+    # Insert before the closing brace, at the body's indentation
+    indent = outer + "  "
+    if not opens_inline:
+        for attribute in block.attributes.values():
+            prefix = template[attribute.line_start : attribute.start]
+            indent = prefix[: len(prefix) - len(prefix.lstrip())] or indent
+            break
+
+    line = f"{indent}{name} = {value}"
+    close_line = template.rfind("\n", 0, block.body_end) + 1
+    if (
+        close_line > block.body_start
+        and not template[close_line : block.body_end].strip()
+    ):
+        template = template[:close_line] + line + "\n" + template[close_line:]
+    else:
+        # The closing brace shares a line with the body
+        body = template[: block.body_end].rstrip(" \t")
+        template = body + "\n" + line + "\n" + outer + template[block.body_end :]
+
+    if opens_inline:
+        body = template[block.body_start :].lstrip(" \t")
+        template = template[: block.body_start] + "\n" + indent + body
+
+    return template
+
+
+def remove_attribute(template: str, address: str, key: str) -> str:
+    """
+    Removes an attribute of a block, with its line.
+    """
+    block = _nested(_block(get_parse_cache().parse(template), address), key)
+    attribute = block.attributes.get(key.split(".")[-1])
+    if attribute is None:
+        raise PatchFailedException(f"No attribute {key} in {address}")
+
+    return template[: attribute.line_start] + template[attribute.line_end :]
+
+
+def add_block(template: str, text: str) -> str:
+    """
+    Appends a block to the config.
+    """
+    block = _parse_block(text)
+    address = block.address
+    if address is not None and get_parse_cache().parse(template).get(address):
+        raise PatchFailedException(f"{address} is already in the config")
+
+    return template.rstrip() + "\n\n" + text.strip() + "\n"
+
+
+def replace_block(template: str, address: str, text: str) -> str:
+    """
+    Replaces a whole block in place.
+    """
+    block = _block(get_parse_cache().parse(template), address)
+    if _parse_block(text).address != address:
+        raise PatchFailedException(f"Replacement for {address} has another address")
+
+    return template[: block.start] + text.strip() + template[block.end :]
+
+
+def remove_block(template: str, address: str) -> str:
+    """
+    Removes a whole block, with the blank line after it. For a local value,
+    only its attribute is removed, since the rest of its locals block holds
+    other locals.
+    """
+    if address.startswith(LOCAL_PREFIX):
+        return remove_attribute(template, address, address[len(LOCAL_PREFIX) :])
+
+    block = _block(get_parse_cache().parse(template), address)
+
+    end = block.end
+    while end < len(template) and template[end] in " \t":
+        end += 1
+    for _ in range(2):
+        if template.startswith("\n", end):
+            end += 1
+
+    return template[: block.start] + template[end:]
+
+
+def unresolved_references(parsed: ParsedConfig) -> Set[str]:
+    """
+    References to resources, data sources, variables, locals and modules that
+    aren't defined in the config.
+    """
+    referenced = set()
+    for block in parsed.blocks:
+        referenced.update(block.references)
+
+    return {address for address in referenced if parsed.get(address) is None}
+
+
+def hcl_value(value: Any) -> str:
+    """
+    An operation's value as hcl. Strings are hcl expressions already, and
+    json scalars are written as the hcl literal they're equal to.
+    """
+    if isinstance(value, str):
+        return value
+
+    return json.dumps(value)
+
+
+def apply_operation(template: str, operation: Dict[str, Any]) -> str:
+    """
+    Applies one patch operation to a template.
+    """
+    op = operation.get(OP)
+    if op not in REQUIRED_KEYS:
+        raise PatchFailedException(f"Unknown patch operation {op}")
+    for key in REQUIRED_KEYS[op]:
+        value = operation.get(key, ...)
+        if not isinstance(value, str) and not (
+            key == VALUE and isinstance(value, SCALAR_TYPES)
+        ):
+            raise PatchFailedException(f"Patch operation {op} is missing {key}")
+
+    if op == ADD_BLOCK:
+        return add_block(template, operation[TEXT])
+    elif op == REPLACE_BLOCK:
+        return replace_block(template, operation[ADDRESS], operation[TEXT])
+    elif op == REMOVE_BLOCK:
+        return remove_block(template, operation[ADDRESS])
+    elif op == SET_ATTRIBUTE:
+        return set_attribute(
+            template, operation[ADDRESS], operation[KEY], hcl_value(operation[VALUE])
+        )
+
+    return remove_attribute(template, operation[ADDRESS], operation[KEY])
+
+
+def apply_patch(template: str, operations: List[Dict[str, Any]]) -> str:
+    """
+    Applies patch operations in order, then checks the result still hangs
+    together: brackets balance, and it doesn't refer to anything that isn't
+    defined, unless the original config already did.
+    """
+    patched = template
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise PatchFailedException(f"Patch operation {operation} isn't an object")
+        patched = apply_operation(patched, operation)
+
+    if not _balanced(patched):
+        raise PatchFailedException("Patched config has unbalanced brackets")
+
+    dangling = unresolved_references(
+        get_parse_cache().parse(patched)
+    ) - unresolved_references(get_parse_cache().parse(template))
+    if len(dangling) > 0:
+        raise PatchFailedException(
+            f"Patched config refers to undefined {', '.join(sorted(dangling))}"
+        )
+
+    return patched
+
+
+def parse_operations(response: Union[Dict[str, Any], List[Any]]) -> List[Any]:
+    """
+    The operations in an llm's patch response, either a bare list or an
+    object with an operations list.
+    """
+    if isinstance(response, dict):
+        response = response.get("operations")
+    if not isinstance(response, list):
+        raise PatchFailedException("Patch response has no operations list")
+
+    return response
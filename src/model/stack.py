@@ -2,6 +2,8 @@ from typing import Dict, Any, Union
 from typeguard import typechecked
 import json
 
+from src.model.hcl import ParsedConfig, get_parse_cache
+
 NAME = "name"
 TEMPLATE = "template"
 PROMPT = "prompt"
@@ -12,9 +14,23 @@ CF_STACK_OBJ = "cf_stack_obj"
 class TerraformConfig:
     """A wrapper around a terraform config"""
 
+    __slots__ = ("name", "template", "_parsed")
+
     def __init__(self, template: str, name: str) -> None:
         self.name = name
         self.template = template
+        self._parsed: Union[ParsedConfig, None] = None
+
+    @property
+    def parsed(self) -> ParsedConfig:
+        """
+        The config's blocks, attributes, references and dependency graph. Parsed
+        on first use, and shared by every config with the same template.
+        """
+        if self._parsed is None or self._parsed.template is not self.template:
+            self._parsed = get_parse_cache().parse(self.template)
+
+        return self._parsed
 
 
 @typechecked
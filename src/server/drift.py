@@ -0,0 +1,391 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Union
+from uuid import UUID
+import threading
+import json
+import time
+import os
+
+from python_terraform import IsFlagged
+
+from src.actions.precheck import parse_plan_output, ERROR_SEVERITY, SEVERITY, SUMMARY
+from src.actions.credentials import resolve_account_id
+from src.actions.tf_backend import AbstractStateBackend, get_state_backend
+from src.actions.tf_stream import StreamingTerraform, credentials_env
+from src.actions.tf_workspace import (
+    TFWorkspacePool,
+    WorkspaceInitException,
+    get_default_pool,
+    seed_working_dir,
+    select_workspace,
+)
+from src.db.supa import (
+    SupaClient,
+    ChatSessionState,
+    ID,
+    SESSION_USER_ID_COL_NAME,
+    DRIFT_CHECKED_AT_COL_NAME,
+)
+from src.server.jobs import JobStatus, read_progress, write_session_config, STATUS
+
+DRIFT_SCHEDULER_ENABLED = os.environ.get("DRIFT_SCHEDULER_ENABLED", "false") == "true"
+# How often the scheduler looks for sessions due a check
+DRIFT_SCAN_INTERVAL_S = float(os.environ.get("DRIFT_SCAN_INTERVAL_S", "300"))
+# How long after a check a session is due another
+DRIFT_CHECK_INTERVAL_S = float(os.environ.get("DRIFT_CHECK_INTERVAL_S", "21600"))
+DRIFT_BATCH_SIZE = int(os.environ.get("DRIFT_BATCH_SIZE", "20"))
+DRIFT_MAX_CONCURRENCY = int(os.environ.get("DRIFT_MAX_CONCURRENCY", "4"))
+# Refreshes call read apis on every resource, so each aws account gets at most
+# one running check, and one check per interval.
+DRIFT_ACCOUNT_INTERVAL_S = float(os.environ.get("DRIFT_ACCOUNT_INTERVAL_S", "60"))
+# Most pages of sessions one batch looks through for sessions of other users
+DRIFT_MAX_SCAN_PAGES = int(os.environ.get("DRIFT_MAX_SCAN_PAGES", "25"))
+
+# Sessions are listed across users, so the listing client isn't scoped to one
+SCHEDULER_USER_ID = UUID(int=0)
+
+# Drift summary keys
+DRIFTED = "drifted"
+RESOURCES = "resources"
+ADDRESS = "address"
+ACTION = "action"
+ERRORS = "errors"
+
+RESOURCE_DRIFT_MESSAGE = "resource_drift"
+
+
+def parse_drift_output(stdout: str) -> List[Dict[str, str]]:
+    """
+    The resources `terraform plan -refresh-only -json` found changed or deleted
+    outside of terraform.
+    """
+    drifted = []
+    for line in stdout.splitlines():
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+        if message.get("type") != RESOURCE_DRIFT_MESSAGE:
+            continue
+        change = message.get("change") or {}
+        drifted.append(
+            {
+                ADDRESS: (change.get("resource") or {}).get("addr"),
+                ACTION: change.get(ACTION),
+            }
+        )
+
+    return drifted
+
+
+def _parse_checked_at(value: Union[str, None]) -> float:
+    """
+    A drift_checked_at timestamp as epoch seconds, 0 if never checked.
+    """
+    if value is None:
+        return 0.0
+
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class AccountRateLimiter:
+    """
+    Lets at most one drift check run per aws account at a time, and starts a
+    new one only min_interval_s after the account's last one started.
+    """
+
+    def __init__(self, min_interval_s: float = DRIFT_ACCOUNT_INTERVAL_S) -> None:
+        self.min_interval_s = min_interval_s
+        self._last_started: Dict[str, float] = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, account: str) -> bool:
+        """
+        Claims a check for an account. Returns false if it has to wait.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if account in self._running:
+                return False
+            if now - self._last_started.get(account, -self.min_interval_s) < (
+                self.min_interval_s
+            ):
+                return False
+
+            self._running.add(account)
+            self._last_started[account] = now
+            return True
+
+    def release(self, account: str):
+        """
+        Marks an account's check as finished.
+        """
+        with self._lock:
+            self._running.discard(account)
+
+
+class DriftChecker:
+    """
+    Checks one deployed chat session for drift with a refresh only plan
+    against its state. Nothing is applied and state isn't written, so a
+    check can't change the user's infra.
+    """
+
+    def __init__(
+        self,
+        workspace_pool: Union[TFWorkspacePool, None] = None,
+        state_backend: Union[AbstractStateBackend, None] = None,
+    ) -> None:
+        self.workspace_pool = workspace_pool
+        self.state_backend = (
+            state_backend if state_backend is not None else get_state_backend()
+        )
+
+    def check(self, supa_client: SupaClient, chat_session_id: UUID) -> Dict[str, Any]:
+        """
+        Returns the drift summary of a chat session.
+        """
+        config = supa_client.get_tf_config(chat_session_id)
+        tf_file_dir = write_session_config(chat_session_id, config)
+
+        env = {
+            **self.state_backend.env(),
+            **credentials_env(*supa_client.get_user_aws_preferences()),
+        }
+        backend_config = self.state_backend.backend_config()
+
+        working_dir = tf_file_dir
+        if self.workspace_pool is not None:
+            working_dir = self.workspace_pool.acquire()
+            seed_working_dir(tf_file_dir, working_dir)
+
+        try:
+            self.state_backend.configure(working_dir)
+            tf = StreamingTerraform(working_dir=working_dir, env=env)
+            if self.workspace_pool is not None:
+                self.workspace_pool.init(working_dir, env, backend_config)
+            else:
+                return_code, _, stderr = tf.init(
+                    backend_config=backend_config, input=False
+                )
+                if return_code != 0:
+                    raise WorkspaceInitException(stderr)
+            select_workspace(tf, str(chat_session_id))
+
+            # detailed exit codes: 0 no drift, 1 error, 2 drift
+            return_code, stdout, stderr = tf.plan(
+                refresh_only=IsFlagged,
+                json=IsFlagged,
+                input=False,
+                detailed_exitcode=IsFlagged,
+                lock=False,
+            )
+        finally:
+            if self.workspace_pool is not None:
+                self.workspace_pool.release(working_dir)
+
+        diagnostics, _ = parse_plan_output(stdout)
+        errors = [d[SUMMARY] for d in diagnostics if d[SEVERITY] == ERROR_SEVERITY]
+        if return_code not in (0, 2) and len(errors) == 0:
+            errors.append(stderr or f"terraform plan exited with {return_code}")
+
+        resources = parse_drift_output(stdout)
+        return {DRIFTED: len(resources) > 0, RESOURCES: resources, ERRORS: errors}
+
+
+class DriftScheduler:
+    """
+    Periodically checks deployed chat sessions for drift in the background,
+    in batches, least recently checked first. Each batch runs at most
+    max_concurrency checks at once and respects per account rate limits.
+    Sessions held back by a rate limit, or by a running deployment, are
+    picked up by a later batch.
+    """
+
+    def __init__(
+        self,
+        checker: Union[DriftChecker, None] = None,
+        batch_size: int = DRIFT_BATCH_SIZE,
+        max_concurrency: int = DRIFT_MAX_CONCURRENCY,
+        check_interval_s: float = DRIFT_CHECK_INTERVAL_S,
+        scan_interval_s: float = DRIFT_SCAN_INTERVAL_S,
+        rate_limiter: Union[AccountRateLimiter, None] = None,
+    ) -> None:
+        self.checker = (
+            checker if checker is not None else DriftChecker(get_default_pool())
+        )
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.check_interval_s = check_interval_s
+        self.scan_interval_s = scan_interval_s
+        self.rate_limiter = (
+            rate_limiter if rate_limiter is not None else AccountRateLimiter()
+        )
+        self.held_back = 0
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def due_sessions(self) -> Iterator[Dict[str, str]]:
+        """
+        Succeeded sessions that haven't been checked within check_interval_s,
+        least recently checked first, paging through sessions until none are
+        due. Sessions with a deployment queued or running are left alone.
+        """
+        listing_client = SupaClient(SCHEDULER_USER_ID)
+        page_size = self.batch_size * 4
+
+        now = time.time()
+        for page in range(DRIFT_MAX_SCAN_PAGES):
+            sessions = listing_client.get_sessions_by_state(
+                ChatSessionState.DEPLOYMENT_SUCCEEDED, page_size, page * page_size
+            )
+
+            for session in sessions:
+                checked_at = _parse_checked_at(session.get(DRIFT_CHECKED_AT_COL_NAME))
+                if now - checked_at < self.check_interval_s:
+                    # Sessions come least recently checked first, so none after are due
+                    return
+
+                progress = read_progress(session[ID]) or {}
+                if progress.get(STATUS) in (
+                    JobStatus.QUEUED.name,
+                    JobStatus.RUNNING.name,
+                ):
+                    continue
+
+                yield session
+
+            if len(sessions) < page_size:
+                return
+
+    def check_session(self, session: Dict[str, str]) -> Union[Dict[str, Any], None]:
+        """
+        Checks one session and records its drift summary. Returns None if its
+        account is rate limited.
+        """
+        chat_session_id = UUID(session[ID])
+        supa_client = SupaClient(UUID(session[SESSION_USER_ID_COL_NAME]))
+        try:
+            secret, access, region = supa_client.get_user_aws_preferences()
+        except Exception as e:
+            print(f"Skipping drift check of chat session {chat_session_id}: {e}")
+            return None
+
+        # Several access keys can belong to one account. If the account can't
+        # be resolved, the key stands in for it.
+        account = resolve_account_id(secret, access, region) or access
+
+        if not self.rate_limiter.try_acquire(account):
+            return None
+
+        start = time.perf_counter()
+        try:
+            summary = self.checker.check(supa_client, chat_session_id)
+        except Exception as e:
+            summary = {DRIFTED: False, RESOURCES: [], ERRORS: [str(e)]}
+        finally:
+            self.rate_limiter.release(account)
+
+        print(
+            f"Drift check of chat session {chat_session_id} took "
+            f"{time.perf_counter() - start:.1f}s: {len(summary[RESOURCES])} "
+            f"drifted resource(s), {len(summary[ERRORS])} error(s)"
+        )
+        supa_client.update_drift_summary(
+            chat_session_id, summary, datetime.now(timezone.utc).isoformat()
+        )
+
+        return summary
+
+    def run_batch(self) -> int:
+        """
+        Checks one batch of due sessions. Returns how many were checked, and
+        sets held_back to how many were held back by account rate limits.
+        """
+        # A user's sessions share an aws account, and would only queue up
+        # behind its rate limit, so a batch takes one session per user. Later
+        # pages are looked through, so one user's backlog can't fill a batch.
+        batch, users = [], set()
+        for session in self.due_sessions():
+            user = session[SESSION_USER_ID_COL_NAME]
+            if user not in users:
+                users.add(user)
+                batch.append(session)
+            if len(batch) == self.batch_size:
+                break
+
+        self.held_back = 0
+        if len(batch) == 0:
+            return 0
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="drift"
+        ) as executor:
+            summaries = list(executor.map(self.check_session, batch))
+
+        checked = sum(1 for summary in summaries if summary is not None)
+        self.held_back = len(batch) - checked
+        return checked
+
+    def run(self):
+        """
+        Runs batches until stopped. A batch that checked anything is followed
+        right away by the next. One whose sessions were all held back by rate
+        limits is retried once they've passed, otherwise the scheduler sleeps
+        until the next scan.
+        """
+        while not self._stop.is_set():
+            try:
+                checked = self.run_batch()
+            except Exception as e:
+                print(f"Drift check batch failed: {e}")
+                checked, self.held_back = 0, 0
+
+            if checked > 0:
+                wait_s = 0
+            elif self.held_back > 0:
+                wait_s = min(self.rate_limiter.min_interval_s, self.scan_interval_s)
+            else:
+                wait_s = self.scan_interval_s
+            self._stop.wait(wait_s)
+
+    def start(self) -> threading.Thread:
+        """
+        Runs the scheduler on a daemon thread, e.g. at server startup.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="drift", daemon=True)
+        self._thread.start()
+
+        return self._thread
+
+    def stop(self):
+        """
+        Stops the scheduler after its current batch.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_default_scheduler: Union[DriftScheduler, None] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_drift_scheduler() -> DriftScheduler:
+    """
+    Returns the process wide drift scheduler, creating it on first use.
+    """
+    global _default_scheduler
+
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = DriftScheduler()
+
+    return _default_scheduler
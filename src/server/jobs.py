@@ -0,0 +1,335 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Union
+from uuid import UUID
+from collections import deque
+from enum import Enum
+import multiprocessing
+import threading
+import json
+import time
+import uuid
+import os
+
+from src.actions.deploy import DeployTFConfigAction
+from src.actions.tf_workspace import get_default_pool
+from src.actions.tf_stream import ProgressChannel
+from src.db.supa import SupaClient, ChatSessionState
+from src.model.stack import TerraformConfig
+
+# Every chat session gets a persistent dir for its config, state, and job progress
+DEPLOYMENTS_ROOT = os.environ.get("DEPLOYMENTS_ROOT", "/tmp/cirroe/deployments")
+MAX_CONCURRENT_DEPLOYMENTS = int(os.environ.get("MAX_CONCURRENT_DEPLOYMENTS", "2"))
+# "process" runs each job in a worker process, "thread" runs them in this one.
+# Credentials only live in each terraform process's env, so threads are safe.
+DEPLOYMENT_WORKER_MODE = os.environ.get("DEPLOYMENT_WORKER_MODE", "process")
+THREAD_WORKER_MODE = "thread"
+
+PROGRESS_FILE = "job.json"
+
+# Recent terraform events kept in a job's progress
+PROGRESS_EVENTS = 20
+
+# Progress keys
+JOB_ID = "job_id"
+USER_ID = "user_id"
+CHAT_SESSION_ID = "chat_session_id"
+STATUS = "status"
+STAGE = "stage"
+RESULT = "result"
+SESSION_STATE = "session_state"
+ERROR = "error"
+EVENTS = "events"
+ENQUEUED_AT = "enqueued_at"
+STARTED_AT = "started_at"
+FINISHED_AT = "finished_at"
+UPDATED_AT = "updated_at"
+
+# Stages a job reports while running
+STAGE_QUEUED = "queued"
+STAGE_PREPARING = "preparing workspace"
+STAGE_DEPLOYING = "deploying"
+STAGE_DONE = "done"
+
+
+class JobStatus(Enum):
+    QUEUED = 0
+    RUNNING = 1
+    SUCCEEDED = 2
+    FAILED = 3
+
+
+class DeploymentInProgressException(Exception):
+    """
+    Represents an attempt to enqueue a deployment for a chat session that
+    already has one queued or running.
+    """
+
+    pass
+
+
+def session_dir(chat_session_id: Union[UUID, str]) -> str:
+    """
+    The persistent dir holding a chat session's config, state, and job progress.
+    """
+    return os.path.join(DEPLOYMENTS_ROOT, str(chat_session_id))
+
+
+def read_progress(chat_session_id: Union[UUID, str]) -> Union[Dict[str, Any], None]:
+    """
+    Returns the progress of a chat session's latest deployment job, if it has one.
+    """
+    path = os.path.join(session_dir(chat_session_id), PROGRESS_FILE)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf8") as fp:
+            return json.load(fp)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Couldn't read job progress from {path}: {e}")
+        return None
+
+
+def write_progress(chat_session_id: Union[UUID, str], fields: Dict[str, Any]):
+    """
+    Merges fields into a chat session's job progress. Written atomically, since
+    progress is read from other processes while jobs run.
+    """
+    directory = session_dir(chat_session_id)
+    os.makedirs(directory, exist_ok=True)
+
+    progress = read_progress(chat_session_id) or {}
+    progress.update(fields)
+    progress[UPDATED_AT] = time.time()
+
+    path = os.path.join(directory, PROGRESS_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as fp:
+        json.dump(progress, fp)
+    os.replace(tmp_path, path)
+
+
+def write_session_config(
+    chat_session_id: Union[UUID, str], config: TerraformConfig
+) -> str:
+    """
+    Writes a chat session's latest config into its persistent dir, replacing any
+    config files already there, e.g. from before the stack was renamed. Returns
+    the dir.
+    """
+    directory = session_dir(chat_session_id)
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".tf") and os.path.isfile(path):
+            os.remove(path)
+
+    with open(os.path.join(directory, f"{config.name}.tf"), "w", encoding="utf8") as fp:
+        fp.write(config.template)
+
+    return directory
+
+
+def run_deployment_job(job_id: str, user_id: str, chat_session_id: str):
+    """
+    Runs one deployment in a worker process. The session's latest config is
+    written into its persistent dir, and terraform runs in a working dir
+    leased from the shared pool.
+    """
+    write_progress(
+        chat_session_id,
+        {
+            STATUS: JobStatus.RUNNING.name,
+            STAGE: STAGE_PREPARING,
+            STARTED_AT: time.time(),
+        },
+    )
+
+    chat_session_uuid = UUID(chat_session_id)
+    supa_client = SupaClient(UUID(user_id))
+    config = supa_client.get_tf_config(chat_session_uuid)
+    tf_file_dir = write_session_config(chat_session_id, config)
+
+    # Mirror the latest terraform events into the job's progress as they stream in
+    events = deque(maxlen=PROGRESS_EVENTS)
+    progress = ProgressChannel()
+
+    def record_event(event: Dict[str, Any]):
+        events.append(event)
+        write_progress(chat_session_id, {EVENTS: list(events)})
+
+    progress.subscribe(record_event)
+
+    with DeployTFConfigAction(
+        config,
+        chat_session_uuid,
+        supa_client,
+        tf_file_dir,
+        get_default_pool(),
+        progress,
+    ) as action:
+        write_progress(chat_session_id, {STAGE: STAGE_DEPLOYING})
+        response = action.trigger_action()
+
+    state = supa_client.get_chat_session_state(chat_session_uuid)
+    status = (
+        JobStatus.SUCCEEDED
+        if state == ChatSessionState.DEPLOYMENT_SUCCEEDED
+        else JobStatus.FAILED
+    )
+    write_progress(
+        chat_session_id,
+        {
+            STATUS: status.name,
+            STAGE: STAGE_DONE,
+            RESULT: str(response),
+            SESSION_STATE: state.name,
+            FINISHED_AT: time.time(),
+        },
+    )
+
+
+class DeploymentJobQueue:
+    """
+    Runs deployments in a bounded pool of worker processes, so long applies
+    don't hold up http workers and at most max_workers applies run at once.
+    Jobs beyond that wait in the executor's queue. Each job writes its
+    progress to its chat session's dir, where any process can read it.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_CONCURRENT_DEPLOYMENTS,
+        worker_mode: str = DEPLOYMENT_WORKER_MODE,
+    ) -> None:
+        self.max_workers = max_workers
+        self.worker_mode = worker_mode
+        self.executor = self._new_executor()
+        self._active: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _new_executor(self) -> Executor:
+        """
+        Worker processes are spawned, not forked, since the server process runs
+        background threads.
+        """
+        if self.worker_mode == THREAD_WORKER_MODE:
+            return ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="deployment"
+            )
+
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def enqueue(self, user_id: UUID, chat_session_id: UUID) -> str:
+        """
+        Enqueues a deployment of the chat session's config. Returns the job id.
+        """
+        session = str(chat_session_id)
+
+        with self._lock:
+            active = self._active.get(session)
+            if active is not None and not active.done():
+                raise DeploymentInProgressException(
+                    f"Chat session {session} already has a deployment queued or running"
+                )
+
+            job_id = uuid.uuid4().hex
+            write_progress(
+                session,
+                {
+                    JOB_ID: job_id,
+                    USER_ID: str(user_id),
+                    CHAT_SESSION_ID: session,
+                    STATUS: JobStatus.QUEUED.name,
+                    STAGE: STAGE_QUEUED,
+                    RESULT: None,
+                    SESSION_STATE: None,
+                    ERROR: None,
+                    EVENTS: [],
+                    ENQUEUED_AT: time.time(),
+                    STARTED_AT: None,
+                    FINISHED_AT: None,
+                },
+            )
+
+            try:
+                future = self.executor.submit(
+                    run_deployment_job, job_id, str(user_id), session
+                )
+            except BrokenProcessPool:
+                # A worker died and took the pool with it. Start a fresh one.
+                print("Deployment worker pool is broken. Restarting it.")
+                self.executor = self._new_executor()
+                future = self.executor.submit(
+                    run_deployment_job, job_id, str(user_id), session
+                )
+            self._active[session] = future
+
+        future.add_done_callback(lambda f: self._on_done(session, f))
+        print(f"Enqueued deployment job {job_id} for chat session {session}")
+
+        return job_id
+
+    def _on_done(self, chat_session_id: str, future: Future):
+        """
+        Records jobs that died without reporting, e.g. on an exception or a
+        crashed worker process.
+        """
+        with self._lock:
+            if self._active.get(chat_session_id) is future:
+                del self._active[chat_session_id]
+
+        e = future.exception()
+        if e is None:
+            return
+
+        print(f"Deployment job for chat session {chat_session_id} failed: {e}")
+        write_progress(
+            chat_session_id,
+            {
+                STATUS: JobStatus.FAILED.name,
+                STAGE: STAGE_DONE,
+                ERROR: str(e),
+                FINISHED_AT: time.time(),
+            },
+        )
+
+    def status(
+        self, user_id: UUID, chat_session_id: UUID
+    ) -> Union[Dict[str, Any], None]:
+        """
+        Returns the progress of a chat session's latest deployment job, if the
+        user enqueued it.
+        """
+        progress = read_progress(chat_session_id)
+        if progress is None or progress.get(USER_ID) != str(user_id):
+            return None
+
+        return progress
+
+    def shutdown(self):
+        """
+        Stops accepting jobs and waits for running ones to finish.
+        """
+        self.executor.shutdown(wait=True)
+
+
+_default_queue: Union[DeploymentJobQueue, None] = None
+_default_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> DeploymentJobQueue:
+    """
+    Returns the process wide deployment job queue, creating it on first use.
+    """
+    global _default_queue
+
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = DeploymentJobQueue()
+
+    return _default_queue
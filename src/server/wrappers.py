@@ -1,6 +1,7 @@
 import subprocess
 from src.actions.execute import ExecutionAction
 from uuid import UUID
+from typing import Union
 from src.db.supa import (
     SupaClient,
     ChatSessionState,
@@ -41,10 +42,14 @@ def handle_irrelevant_query(query: str, client: AbstractLLMClient) -> str:
 
 
 def point_execution_wrapper(
-    user_query: str, user_id: UUID, supa_client: SupaClient
+    user_query: str,
+    user_id: UUID,
+    supa_client: SupaClient,
+    raw_query: Union[str, None] = None,
 ) -> str:
     """
     A wrapper around point executions. Check the ExecutionAction class for more info.
+    raw_query is the user's message without chat memory, if available.
     """
 
     secret, access, region = supa_client.get_user_aws_preferences()
@@ -71,7 +76,7 @@ def point_execution_wrapper(
 
     action = ExecutionAction(str(user_id))
 
-    return action.trigger_action(user_query)
+    return action.trigger_action(user_query, raw_query)
 
 
 def query_wrapper(user_query: str, user_id: UUID, chat_session_id: UUID) -> str:
@@ -101,12 +106,12 @@ def query_wrapper(user_query: str, user_id: UUID, chat_session_id: UUID) -> str:
             or execution_action.is_point_execution(memory_powered_query)
         ):
                 response = point_execution_wrapper(
-                    memory_powered_query, user_id, supa_client
+                    memory_powered_query, user_id, supa_client, user_query
                 )
 
         response = handle_irrelevant_query(memory_powered_query, llm_client)
 
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
         # TODO Add metric
         print("Point execution failed")
     except CredentialsNotProvidedException:
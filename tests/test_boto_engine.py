@@ -0,0 +1,110 @@
+import json
+import shlex
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from src.actions.boto_engine import (
+    Boto3ExecutionEngine,
+    UnsupportedCommandException,
+    CLI_SERVICE_ERROR,
+    CLI_PARAM_ERROR,
+)
+
+REGION = "us-east-1"
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    for name in ("AWS_PROFILE", "AWS_DEFAULT_PROFILE", "AWS_SESSION_TOKEN"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def engine(aws):
+    return Boto3ExecutionEngine()
+
+
+def run(engine: Boto3ExecutionEngine, command: str):
+    return engine.execute(shlex.split(command))
+
+
+def test_list_buckets(engine):
+    s3 = boto3.client("s3", region_name=REGION)
+    s3.create_bucket(Bucket="app-logs")
+    s3.create_bucket(Bucket="app-assets")
+
+    result = run(engine, f"aws s3api list-buckets --region {REGION}")
+
+    assert result.returncode == 0
+    names = [bucket["Name"] for bucket in json.loads(result.stdout)["Buckets"]]
+    assert sorted(names) == ["app-assets", "app-logs"]
+
+
+def test_query_and_shorthand_filters(engine):
+    ec2 = boto3.client("ec2", region_name=REGION)
+    ami = ec2.describe_images()["Images"][0]["ImageId"]
+    micro = ec2.run_instances(
+        ImageId=ami, InstanceType="t2.micro", MinCount=2, MaxCount=2
+    )
+    ec2.run_instances(ImageId=ami, InstanceType="t3.large", MinCount=1, MaxCount=1)
+
+    result = run(
+        engine,
+        f"aws ec2 describe-instances --region {REGION} "
+        "--filters Name=instance-type,Values=t2.micro "
+        "--query 'Reservations[].Instances[].InstanceId'",
+    )
+
+    assert result.returncode == 0
+    assert sorted(json.loads(result.stdout)) == sorted(
+        instance["InstanceId"] for instance in micro["Instances"]
+    )
+
+
+def test_paginates_like_the_cli(engine):
+    sqs = boto3.client("sqs", region_name=REGION)
+    for i in range(3):
+        sqs.create_queue(QueueName=f"queue-{i}")
+
+    result = run(engine, f"aws sqs list-queues --region {REGION} --max-results 1")
+
+    assert result.returncode == 0
+    assert len(json.loads(result.stdout)["QueueUrls"]) == 3
+
+
+def test_api_errors_use_cli_exit_codes(engine):
+    result = run(
+        engine,
+        f"aws ec2 describe-instances --region {REGION} --instance-ids i-0123456789abcdef0",
+    )
+    assert result.returncode == CLI_SERVICE_ERROR
+    assert "InvalidInstanceID" in result.stderr
+
+    result = run(engine, f"aws s3api get-object --region {REGION} --bucket app-logs")
+    assert result.returncode == CLI_PARAM_ERROR
+
+    result = run(engine, f"aws sqs list-queues --region {REGION} --max-results abc")
+    assert result.returncode == CLI_PARAM_ERROR
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "aws s3 ls",
+        f"aws ec2 describe-instances --region {REGION} --output table",
+        f"aws ec2 describe-instances --region {REGION} --max-items 5",
+        f"aws ec2 describe-everything --region {REGION}",
+        f"aws ec2 describe-instances --region {REGION} --not-an-option 1",
+    ],
+)
+def test_unsupported_commands_fall_back(engine, command):
+    with pytest.raises(UnsupportedCommandException):
+        run(engine, command)
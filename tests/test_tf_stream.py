@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+from src.actions.tf_stream import (
+    StreamingTerraform,
+    credentials_env,
+    ISOLATED_ENV_VARS,
+    MESSAGE,
+)
+
+TENANTS = 16
+RUNS_PER_TENANT = 2
+
+# Stands in for terraform: reports the aws variables it was started with as
+# a -json log line, after a short sleep so concurrent runs overlap.
+FAKE_TERRAFORM = f"""#!{sys.executable}
+import json, os, random, time
+time.sleep(random.uniform(0, 0.05))
+env = {{k: v for k, v in os.environ.items() if k.startswith("AWS_")}}
+print(json.dumps({{"@level": "info", "@message": json.dumps(env), "type": "log"}}))
+"""
+
+
+@pytest.fixture
+def fake_terraform(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    terraform = bin_dir / "terraform"
+    terraform.write_text(FAKE_TERRAFORM)
+    terraform.chmod(terraform.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    # The server's own credentials, which no tenant's terraform may see
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "SERVERACCESSKEY")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "server-secret")
+    monkeypatch.setenv("AWS_PROFILE", "server")
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "credentials"))
+
+    working_dir = tmp_path / "work"
+    working_dir.mkdir()
+    return str(working_dir)
+
+
+def tenant_credentials(tenant: int):
+    return (
+        f"secret-{tenant}",
+        f"ACCESS{tenant:04d}",
+        ["us-east-1", "us-west-2", "eu-west-1"][tenant % 3],
+    )
+
+
+def assert_only_own_credentials(tenant: int, env):
+    secret, access, region = tenant_credentials(tenant)
+    expected = credentials_env(secret, access, region)
+
+    for name in ISOLATED_ENV_VARS:
+        assert env.get(name) == expected.get(name)
+    assert env["AWS_SHARED_CREDENTIALS_FILE"] == os.devnull
+    assert env["AWS_CONFIG_FILE"] == os.devnull
+
+    for other in range(TENANTS):
+        if other != tenant:
+            other_secret, other_access, _ = tenant_credentials(other)
+            assert other_secret not in env.values()
+            assert other_access not in env.values()
+
+
+def run_cmd(working_dir: str, tenant: int):
+    tf = StreamingTerraform(
+        working_dir=working_dir, env=credentials_env(*tenant_credentials(tenant))
+    )
+    return_code, stdout, stderr = tf.cmd("version")
+    assert return_code == 0, stderr
+
+    return tenant, json.loads(json.loads(stdout)["@message"])
+
+
+def run_stream(working_dir: str, tenant: int):
+    tf = StreamingTerraform(
+        working_dir=working_dir, env=credentials_env(*tenant_credentials(tenant))
+    )
+    events = []
+    return_code, _ = tf.stream("version", on_event=events.append)
+    assert return_code == 0
+
+    return tenant, json.loads(events[0][MESSAGE])
+
+
+@pytest.mark.parametrize("run", [run_cmd, run_stream])
+def test_concurrent_tenants_only_see_their_own_credentials(fake_terraform, run):
+    tenants = [t for t in range(TENANTS) for _ in range(RUNS_PER_TENANT)]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda t: run(fake_terraform, t), tenants))
+
+    assert len(results) == len(tenants)
+    for tenant, env in results:
+        assert_only_own_credentials(tenant, env)
+
+    # Nothing was written to the server's environment along the way
+    assert os.environ["AWS_ACCESS_KEY_ID"] == "SERVERACCESSKEY"
+    assert os.environ["AWS_PROFILE"] == "server"